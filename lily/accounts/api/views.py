@@ -57,7 +57,7 @@ class AccountViewSet(SetTenantUserMixin, ModelViewSet):
     # Set the serializer class for this viewset.
     serializer_class = AccountSerializer
     # Set all filter backends that this viewset uses.
-    filter_backends = (ElasticSearchFilter, OrderingFilter, DjangoFilterBackend, )
+    filter_backends = (OrderingFilter, DjangoFilterBackend, ElasticSearchFilter, )
 
     # ElasticSearchFilter: set the model type.
     model_type = 'accounts_account'
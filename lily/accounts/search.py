@@ -1,6 +1,9 @@
+from django.contrib.contenttypes.models import ContentType
+
 from lily.accounts.models import Website
 from lily.contacts.models import Function
 from lily.search.base_mapping import BaseMapping
+from lily.search.extraction import fetch_many_to_many, fetch_reverse, get_choice_display
 from lily.socialmedia.models import SocialMedia
 from lily.tags.models import Tag
 from lily.utils.models.models import EmailAddress, PhoneNumber, Address
@@ -9,6 +12,20 @@ from .models import Account
 
 
 class AccountMapping(BaseMapping):
+    values_fields = [
+        'id',
+        'tenant',
+        'assigned_to__first_name',
+        'assigned_to__last_name',
+        'created',
+        'customer_id',
+        'description',
+        'modified',
+        'name',
+        'status',
+        'status__name',
+    ]
+
     @classmethod
     def get_model(cls):
         return Account
@@ -141,9 +158,9 @@ class AccountMapping(BaseMapping):
         Maps related models, how to get an instance list from a signal sender.
         """
         return {
-            Function: lambda obj: [obj.account],
+            Function: lambda obj: Account.objects.filter(pk=obj.account_id),
             Tag: lambda obj: [obj.subject],
-            Website: lambda obj: [obj.account],
+            Website: lambda obj: Account.objects.filter(pk=obj.account_id),
             EmailAddress: lambda obj: obj.account_set.all(),
             PhoneNumber: lambda obj: obj.account_set.all(),
             Address: lambda obj: obj.account_set.all(),
@@ -228,3 +245,67 @@ class AccountMapping(BaseMapping):
         }
 
         return doc
+
+    @classmethod
+    def rows_to_docs(cls, rows):
+        """
+        Translate a chunk of rows to index documents, the same as obj_to_doc.
+        """
+        pks = [row['id'] for row in rows]
+        content_type = ContentType.objects.get_for_model(Account)
+
+        addresses = fetch_many_to_many(Account, 'addresses', pks, ['address', 'postal_code', 'city', 'country'])
+        email_addresses = fetch_many_to_many(Account, 'email_addresses', pks, ['id', 'email_address', 'status'])
+        phone_numbers = fetch_many_to_many(Account, 'phone_numbers', pks, ['id', 'number', 'type', 'status'])
+        social_media = fetch_many_to_many(Account, 'social_media', pks, ['id', 'name', 'username', 'profile_url'])
+        tags = fetch_reverse(Tag.objects.filter(content_type=content_type), 'object_id', pks,
+                             ['id', 'name', 'object_id'])
+        websites = fetch_reverse(Website.objects.all(), 'account', pks, ['id', 'website', 'is_primary'])
+
+        docs = []
+        for row in rows:
+            pk = row['id']
+            account_addresses = [dict(address, country=get_choice_display(Address, 'country', address['country'])
+                                      if address['country'] else None) for address in addresses[pk]]
+            account_websites = [Website(website=website['website']) for website in websites[pk]]
+
+            docs.append({
+                'address_full': [u'%s %s %s' % (
+                    address['address'] or '',
+                    address['city'] or '',
+                    address['country'] or '',
+                ) for address in account_addresses],
+                'addresses': account_addresses,
+                'assigned_to': u' '.join([
+                    row['assigned_to__first_name'],
+                    row['assigned_to__last_name'],
+                ]).strip() if row['assigned_to__first_name'] is not None else None,
+                'content_type': content_type.id,
+                'created': row['created'],
+                'customer_id': row['customer_id'],
+                'description': row['description'],
+                'email_addresses': email_addresses[pk],
+                'modified': row['modified'],
+                'name': row['name'],
+                'name_words': row['name'],
+                'phone_numbers': [dict(
+                    phone_number,
+                    status_name=get_choice_display(PhoneNumber, 'status', phone_number['status']),
+                ) for phone_number in phone_numbers[pk]],
+                'status': {
+                    'id': row['status'],
+                    'name': row['status__name'],
+                } if row['status'] else None,
+                'social_media': [dict(
+                    soc,
+                    name=get_choice_display(SocialMedia, 'name', soc['name']),
+                ) for soc in social_media[pk]],
+                'tags': tags[pk],
+                'websites': websites[pk],
+
+                # Fields not returned by the serializer.
+                'domain': [website.full_domain for website in account_websites],
+                'second_level_domain': [website.second_level for website in account_websites],
+            })
+
+        return docs
@@ -4,8 +4,17 @@ from lily.search.lily_search import LilySearch
 
 
 class ElasticSearchFilter(BaseFilterBackend):
+    """
+    Search the list of a view with Elasticsearch, see `ElasticSearchResults`.
+
+    The results are paginated and counted by Elasticsearch, in the order of the search, so this should be the
+    last filter backend of the view. When the list is also ordered or filtered, e.g. with ?ordering=...,
+    the ids of the results are filtered on in the database instead, which orders, filters and counts them.
+    """
     # The URL query parameter used for the search.
     search_param = api_settings.SEARCH_PARAM
+    # The URL query parameter of views without pagination for the number of results.
+    limit_param = 'limit'
 
     def get_search_terms(self, request):
         """
@@ -20,7 +29,8 @@ class ElasticSearchFilter(BaseFilterBackend):
     def filter_queryset(self, request, queryset, view):
         model_type = getattr(view, 'model_type', None)
 
-        if not model_type:
+        # Only lists are paginated by Elasticsearch, other actions look up their objects in the queryset.
+        if not model_type or getattr(view, 'action', 'list') != 'list':
             return queryset
 
         search_terms = self.get_search_terms(request)
@@ -28,21 +38,157 @@ class ElasticSearchFilter(BaseFilterBackend):
         if not search_terms:
             return queryset
 
-        if 'limit' in request.query_params:
-            limit = request.query_params['limit']
+        if self.has_database_params(request, view):
+            if self.limit_param in request.query_params:
+                search = LilySearch(
+                    tenant_id=request.user.tenant_id,
+                    model_type=model_type,
+                    size=int(request.query_params[self.limit_param]),
+                )
+            else:
+                search = LilySearch(
+                    tenant_id=request.user.tenant_id,
+                    model_type=model_type,
+                )
 
+            search.filter_query(' AND '.join(search_terms))
+            ids = [result['id'] for result in search.do_search(['id'])[0]]
+
+            return queryset.filter(id__in=ids)
+
+        offset, size = self.get_page(request, view)
+
+        return ElasticSearchResults(
+            tenant_id=request.user.tenant_id,
+            model_type=model_type,
+            query=' AND '.join(search_terms),
+            queryset=queryset,
+            offset=offset,
+            size=size,
+        )
+
+    def has_database_params(self, request, view):
+        """
+        Returns True when the request has other query parameters than the search and the pagination, e.g. to
+        order or filter the list. Those are applied by the database, so Elasticsearch can't paginate the results.
+        """
+        search_params = set([self.search_param, self.limit_param, api_settings.URL_FORMAT_OVERRIDE])
+        paginator = getattr(view, 'paginator', None)
+        if paginator:
+            search_params.add(getattr(paginator, 'page_query_param', None))
+            search_params.add(getattr(paginator, 'page_size_query_param', None))
+
+        return any(param not in search_params for param in request.query_params)
+
+    def get_page(self, request, view):
+        """
+        Returns the page of results the view is going to return, from the page and page size of its paginator,
+        or the first `limit` results when the view isn't paginated.
+
+        Returns:
+            offset (int): the number of results before the page
+            size (int): the number of results on the page
+        """
+        paginator = getattr(view, 'paginator', None)
+        page_size = paginator.get_page_size(request) if paginator else None
+
+        if page_size:
+            try:
+                page_number = int(request.query_params.get(paginator.page_query_param, 1))
+            except ValueError:
+                # For example the last page, which can't be known before counting the results.
+                page_number = 1
+            return (max(page_number, 1) - 1) * page_size, page_size
+
+        if self.limit_param in request.query_params:
+            return 0, int(request.query_params[self.limit_param])
+
+        return 0, 10
+
+
+class ElasticSearchResults(object):
+    """
+    The results of a search, as a sequence the paginator of a view can count and slice.
+
+    Elasticsearch counts the results and returns the ids of a page, instead of returning the ids of
+    all results for the database to count and slice. The page is read from the database with one query,
+    with the select_related and prefetch_related of the queryset, in the order of the search.
+
+    Counting the results fetches the page the view is expected to return, so a paginated list
+    usually costs one search and one query.
+    """
+
+    def __init__(self, tenant_id, model_type, query, queryset, offset=0, size=10):
+        """
+        Args:
+            tenant_id (int): ID of the tenant
+            model_type (str): the mapping type to search
+            query (str): the query string of the search
+            queryset (QuerySet): the queryset to read the results from
+            offset (int): the number of results before the expected page
+            size (int): the number of results on the expected page
+        """
+        self.tenant_id = tenant_id
+        self.model_type = model_type
+        self.query = query
+        self.queryset = queryset
+        self.offset = offset
+        self.size = size
+
+        # The total number of results, according to Elasticsearch.
+        self.total = None
+        # The fetched pages by (start, stop).
+        self.pages = {}
+
+    def count(self):
+        if self.total is None:
+            self.fetch(self.offset, self.offset + self.size)
+        return self.total
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self.fetch(self.offset, self.offset + self.size))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step is not None:
+                raise ValueError('Search results can not be sliced with a step.')
+            start = key.start or 0
+            stop = key.stop if key.stop is not None else self.count()
+            return self.fetch(start, stop) if stop > start else []
+
+        return self.fetch(key, key + 1)[0]
+
+    def fetch(self, start, stop):
+        """
+        Search the results from start up to stop and read them from the database.
+
+        Returns:
+            objects (list): the model instances, in the order of the search
+        """
+        if (start, stop) not in self.pages:
             search = LilySearch(
-                tenant_id=request.user.tenant_id,
-                model_type=model_type,
-                size=int(limit),
-            )
-        else:
-            search = LilySearch(
-                tenant_id=request.user.tenant_id,
-                model_type=model_type,
+                tenant_id=self.tenant_id,
+                model_type=self.model_type,
+                size=stop - start,
             )
+            search.search = search.search[start:stop]
+            search.filter_query(self.query)
+            hits, facets, self.total, took = search.do_search(['id'])
 
-        search.filter_query(' AND '.join(search_terms))
-        ids = [result['id'] for result in search.do_search(['id'])[0]]
+            self.pages[(start, stop)] = self.get_objects([hit['id'] for hit in hits])
+
+        return self.pages[(start, stop)]
+
+    def get_objects(self, ids):
+        """
+        Read the objects with the given ids from the queryset, in the order of the ids.
+        Ids that aren't in the queryset, e.g. because of the filters of the view, are left out.
+        """
+        if not ids:
+            return []
 
-        return queryset.filter(id__in=ids)
+        objects = dict((obj.id, obj) for obj in self.queryset.filter(id__in=ids))
+        return [objects[pk] for pk in ids if pk in objects]
@@ -5,7 +5,6 @@ from django.apps import AppConfig
 from django.conf import settings
 from django.forms.forms import BaseForm
 
-from lily.search.scan_search import ModelMappings
 from lily.utils.functions import autostrip
 
 
@@ -24,7 +23,6 @@ class LilyConfig(AppConfig):
         local_apps = [app for app in settings.INSTALLED_APPS if app.startswith('lily')]
 
         self.patch_forms(local_apps)
-        self.scan_indexes(local_apps)
 
     def patch_forms(self, local_apps):
         """
@@ -56,9 +54,3 @@ class LilyConfig(AppConfig):
                     if hasattr(form, 'base_fields'):
                         form_class = autostrip(form)
                         setattr(forms_module, form_name, form_class)
-
-    def scan_indexes(self, local_apps):
-        """
-        Scan the installed apps for indexes.
-        """
-        ModelMappings.scan(local_apps)
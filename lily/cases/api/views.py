@@ -76,7 +76,7 @@ class CaseViewSet(SetTenantUserMixin, viewsets.ModelViewSet):
     # Set the serializer class for this viewset.
     serializer_class = CaseSerializer
     # Set all filter backends that this viewset uses.
-    filter_backends = (ElasticSearchFilter, OrderingFilter, DjangoFilterBackend,)
+    filter_backends = (OrderingFilter, DjangoFilterBackend, ElasticSearchFilter,)
 
     # ElasticSearchFilter: set the model type.
     model_type = 'cases_case'
@@ -35,7 +35,7 @@ class ContactViewSet(SetTenantUserMixin, viewsets.ModelViewSet):
     # Set the serializer class for this viewset.
     serializer_class = ContactSerializer
     # Set all filter backends that this viewset uses.
-    filter_backends = (ElasticSearchFilter, OrderingFilter,)
+    filter_backends = (OrderingFilter, ElasticSearchFilter,)
 
     # ElasticSearchFilter: set the model type.
     model_type = 'contacts_contact'
@@ -1,6 +1,9 @@
+from django.contrib.contenttypes.models import ContentType
+
 from lily.accounts.models import Account
 
 from lily.search.base_mapping import BaseMapping
+from lily.search.extraction import fetch_many_to_many, fetch_reverse, get_choice_display
 from lily.tags.models import Tag
 from lily.utils.models.models import EmailAddress, PhoneNumber, Address
 from lily.socialmedia.models import SocialMedia
@@ -9,6 +12,19 @@ from .models import Contact, Function
 
 
 class ContactMapping(BaseMapping):
+    values_fields = [
+        'id',
+        'tenant',
+        'created',
+        'description',
+        'first_name',
+        'gender',
+        'last_name',
+        'modified',
+        'salutation',
+        'title',
+    ]
+
     @classmethod
     def get_model(cls):
         return Contact
@@ -123,8 +139,8 @@ class ContactMapping(BaseMapping):
         Maps related models, how to get an instance list from a signal sender.
         """
         return {
-            Function: lambda obj: [obj.contact],
-            Account: lambda obj: [f.contact for f in obj.functions.all()],
+            Function: lambda obj: Contact.objects.filter(pk=obj.contact_id),
+            Account: lambda obj: Contact.objects.filter(functions__account=obj),
             Tag: lambda obj: [obj.subject],
             EmailAddress: lambda obj: obj.contact_set.all(),
             PhoneNumber: lambda obj: obj.contact_set.all(),
@@ -208,3 +224,60 @@ class ContactMapping(BaseMapping):
             doc.setdefault('accounts', []).append(account)
 
         return doc
+
+    @classmethod
+    def rows_to_docs(cls, rows):
+        """
+        Translate a chunk of rows to index documents, the same as obj_to_doc.
+        """
+        pks = [row['id'] for row in rows]
+        content_type = ContentType.objects.get_for_model(Contact)
+
+        addresses = fetch_many_to_many(Contact, 'addresses', pks, [
+            'address', 'postal_code', 'city', 'state_province', 'country', 'type'])
+        email_addresses = fetch_many_to_many(Contact, 'email_addresses', pks, ['id', 'email_address', 'status'])
+        phone_numbers = fetch_many_to_many(Contact, 'phone_numbers', pks, ['id', 'number', 'type', 'status'])
+        social_media = fetch_many_to_many(Contact, 'social_media', pks, ['id', 'name', 'username', 'profile_url'])
+        tags = fetch_reverse(Tag.objects.filter(content_type=content_type), 'object_id', pks,
+                             ['id', 'name', 'object_id'])
+        functions = fetch_reverse(Function.objects.filter(account__is_deleted=False), 'contact', pks,
+                                  ['account', 'account__name', 'account__customer_id', 'title'])
+
+        docs = []
+        for row in rows:
+            pk = row['id']
+            docs.append({
+                'addresses': [dict(
+                    address,
+                    country=get_choice_display(Address, 'country', address['country']) if address['country'] else None,
+                    type=get_choice_display(Address, 'type', address['type']),
+                ) for address in addresses[pk]],
+                'content_type': content_type.id,
+                'created': row['created'],
+                'description': row['description'],
+                'email_addresses': email_addresses[pk],
+                'first_name': row['first_name'],
+                'full_name': ' '.join([row['first_name'], row['last_name']]).strip(),
+                'gender': get_choice_display(Contact, 'gender', row['gender']),
+                'last_name': row['last_name'],
+                'modified': row['modified'],
+                'phone_numbers': [dict(
+                    phone_number,
+                    status_name=get_choice_display(PhoneNumber, 'status', phone_number['status']),
+                ) for phone_number in phone_numbers[pk]],
+                'salutation': get_choice_display(Contact, 'salutation', row['salutation']),
+                'social_media': [dict(
+                    soc,
+                    name=get_choice_display(SocialMedia, 'name', soc['name']),
+                ) for soc in social_media[pk]],
+                'tags': tags[pk],
+                'title': row['title'],
+                'accounts': [{
+                    'id': function['account'],
+                    'name': function['account__name'] or '',
+                    'customer_id': function['account__customer_id'],
+                    'function': function['title'],
+                } for function in functions[pk]],
+            })
+
+        return docs
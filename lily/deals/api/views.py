@@ -169,7 +169,7 @@ class DealViewSet(SetTenantUserMixin, ModelViewSet):
     # Set the serializer class for this viewset.
     serializer_class = DealSerializer
     # Set all filter backends that this viewset uses.
-    filter_backends = (ElasticSearchFilter, OrderingFilter, DjangoFilterBackend, )
+    filter_backends = (OrderingFilter, DjangoFilterBackend, ElasticSearchFilter, )
 
     # ElasticSearchFilter: set the model type.
     model_type = 'deals_deal'
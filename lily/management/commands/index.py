@@ -1,15 +1,60 @@
+import os
 import traceback
+from multiprocessing import Manager, Pool
 from optparse import make_option
+from Queue import Empty
 import time
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db import connection
+from django.db import connection, connections
+from django.db.models import Max, Min
+from django.utils import timezone
+from dateutil.parser import parse
 
 from lily.search.analyzers import get_analyzers
+from lily.search.checkpoints import IndexCheckpoint
+from lily.search.bulk import BulkIndexer
 from lily.search.connections_utils import get_es_client, get_index_name
-from lily.search.indexing import index_objects
+from lily.search.drift import MISSING, ORPHANED, compare_entries, iter_database_entries, iter_index_entries
+from lily.search.dual_write import (CHECK_INTERVAL as DUAL_WRITE_CHECK_INTERVAL, get_dual_write_alias,
+                                    load_dual_write_index, start_dual_write, stop_dual_write)
+from lily.search.indexing import get_index_queryset, index_modified_since, index_objects, reindex_scope
 from lily.search.scan_search import ModelMappings
+from lily.utils import logutil
+
+
+# The refresh interval of Elasticsearch, for an index that doesn't set one.
+DEFAULT_REFRESH_INTERVAL = '1s'
+
+
+def index_pk_range(args):
+    """
+    Index the instances of a mapping within a pk range, run in a worker process.
+
+    Every worker uses its own database connection and Elasticsearch client,
+    the ones of the parent process can't be shared after forking.
+    """
+    mapping, temp_index_base, pk_from, pk_to, use_rows, create_only, progress_queue = args
+    connections.close_all()
+    es = get_es_client(force_new=True)
+    checkpoint = IndexCheckpoint(mapping)
+
+    start = time.time()
+    queryset = get_index_queryset(mapping).filter(pk__gte=pk_from, pk__lt=pk_to)
+    count = [0]
+
+    def report_progress(chunk_size):
+        count[0] += chunk_size
+        progress_queue.put(chunk_size)
+
+    index_objects(mapping, queryset, temp_index_base, es_client=es, progress_callback=report_progress,
+                  start_pk=checkpoint.get_last_pk(pk_from),
+                  checkpoint_callback=lambda pk: checkpoint.set_last_pk(pk, pk_from), use_rows=use_rows,
+                  create_only=create_only)
+    connections.close_all()
+
+    return os.getpid(), count[0], time.time() - start
 
 
 class Command(BaseCommand):
@@ -31,7 +76,41 @@ The second way is to target a specific model:
     index -t contacts_contact
     index -t lily.contacts
 
-It is possible to specify multiple models, using comma separation."""
+It is possible to specify multiple models, using comma separation.
+
+Large models can be indexed by multiple processes, every process indexing a
+range of primary keys with its own database and Elasticsearch connection:
+
+    index -t emailmessage --workers 8
+
+The progress is saved after every bulk request, so an interrupted run can be
+continued with the index it was building:
+
+    index -t emailmessage --resume
+
+Instead of building a new index, the current index can be updated with the
+instances modified since a given time, or since the last run started. Soft
+deleted instances are removed, hard deleted ones are left to index_drift:
+
+    index --since 2016-11-01T03:00
+    index --since last
+
+Mappings that support it can build their documents from database rows instead
+of model instances, which is a lot faster and uses less memory:
+
+    index -t emailmessage --rows
+
+Without maintenance mode, the new index is built while Lily is in use. Every
+update is written to both the current and the new index until the new index
+is complete, checked against the database and swapped in:
+
+    index --live
+
+The documents of one tenant or one email account can be replaced in the
+current index, without building a new index:
+
+    index --tenant 12
+    index -t emailmessage --email-account 34"""
 
     option_list = BaseCommand.option_list + (
         make_option('-t', '--target',
@@ -55,15 +134,63 @@ It is possible to specify multiple models, using comma separation."""
                     dest='force',
                     help='Force the creation of the new index, removing the old one (leftovers).'
                     ),
+        make_option('-w', '--workers',
+                    action='store',
+                    dest='workers',
+                    type='int',
+                    default=1,
+                    help='Number of processes to index each model with, splitting the primary keys in ranges.'
+                    ),
+        make_option('-r', '--resume',
+                    action='store_true',
+                    dest='resume',
+                    help='Resume the previous run from its checkpoint, if it did not finish.'
+                    ),
+        make_option('-s', '--since',
+                    action='store',
+                    dest='since',
+                    default='',
+                    help='Only update the current index with instances modified (or soft deleted) since this '
+                         'timestamp, or "last" for the start of the previous run. Hard deleted instances are not '
+                         'removed, use index_drift --repair for those.'
+                    ),
+        make_option('--live',
+                    action='store_true',
+                    dest='live',
+                    help='Rebuild while Lily is in use, writing updates to both the current and the new index.'
+                    ),
+        make_option('--rows',
+                    action='store_true',
+                    dest='rows',
+                    help='Build the documents from database rows instead of model instances, '
+                         'for the models that support it.'
+                    ),
+        make_option('--tenant',
+                    action='store',
+                    dest='tenant',
+                    type='int',
+                    help='Only replace the documents of this tenant in the current index.'
+                    ),
+        make_option('--email-account',
+                    action='store',
+                    dest='email_account',
+                    type='int',
+                    help='Only replace the documents of this email account in the current index.'
+                    ),
     )
 
     def handle(self, *args, **kwargs):
-        self.stdout.write('Please remember that Lily needs to be in maintenance mode. \n\n')
-
         try:
             self.handle_args(*args)
             self.handle_kwargs(**kwargs)
 
+            if self.list_mappings:
+                self.list_targets()
+                return
+
+            if not self.live and not self.scoped:
+                self.stdout.write('Please remember that Lily needs to be in maintenance mode. \n\n')
+
             self.es = get_es_client()
             self.index()
 
@@ -104,6 +231,42 @@ It is possible to specify multiple models, using comma separation."""
         # Validate the force kwarg.
         self.force = kwargs['force'] is True
 
+        # Validate the workers kwarg.
+        if kwargs['workers'] < 1:
+            raise Exception('The number of workers should be at least 1.')
+        self.workers = kwargs['workers']
+
+        # Validate the resume kwarg.
+        self.resume = kwargs['resume'] is True
+
+        # Validate the since kwarg, 'last' is resolved per mapping.
+        self.since = kwargs['since']
+        if self.since and self.since != 'last':
+            self.since = parse(self.since)
+            if timezone.is_naive(self.since):
+                self.since = timezone.make_aware(self.since, timezone.get_current_timezone())
+        if self.since and self.resume:
+            raise Exception('Resuming a run and indexing modified instances can not be combined.')
+
+        # Validate the rows kwarg.
+        self.use_rows = kwargs['rows'] is True
+
+        # Validate the live kwarg.
+        self.live = kwargs['live'] is True
+        if self.live and self.since:
+            raise Exception('A live rebuild and indexing modified instances can not be combined.')
+
+        # Validate the tenant and email account kwargs.
+        self.tenant_id = kwargs['tenant']
+        self.email_account_id = kwargs['email_account']
+        self.scoped = bool(self.tenant_id or self.email_account_id)
+        if self.scoped and (self.since or self.resume or self.live):
+            raise Exception('Reindexing a tenant or email account can not be combined with --since, --resume '
+                            'or --live.')
+        if self.email_account_id:
+            # Only the mappings of models that belong to an email account.
+            self.target_list = [mapping for mapping in self.target_list if mapping.has_email_account()]
+
     def validate_targets(self, targets_to_check):
         """
         Validate every target that is passed to the command.
@@ -114,7 +277,7 @@ It is possible to specify multiple models, using comma separation."""
         for target in targets_to_check:
             if target in ModelMappings.app_to_mappings.keys():
                 # Target is an app.
-                target_list.append(ModelMappings.app_to_mappings[target])
+                target_list.extend(ModelMappings.app_to_mappings[target])
                 continue
 
             for mapping in ModelMappings.mappings:
@@ -136,6 +299,17 @@ It is possible to specify multiple models, using comma separation."""
 
         self.target_list = target_list or ModelMappings.mappings
 
+    def list_targets(self):
+        """
+        List the mappings that can be targeted, and how long it took to load them.
+        """
+        for mapping in ModelMappings.mappings:
+            model = mapping.get_model()
+            self.stdout.write('%s (%s.%s)' % (
+                mapping.get_mapping_type_name(), model.__module__, model.__name__.lower()))
+        self.stdout.write('\nLoaded %s mappings in %.1fms.' % (
+            len(ModelMappings.mappings), ModelMappings.load_duration * 1000))
+
     def index(self):
         """
         Do the actual indexing for all specified targets.
@@ -147,6 +321,21 @@ It is possible to specify multiple models, using comma separation."""
 
             self.stdout.write('==> %s' % model_name)
 
+            if self.scoped:
+                self.index_scope(mapping)
+                continue
+
+            checkpoint = IndexCheckpoint(mapping)
+
+            if self.since:
+                self.index_since(mapping, checkpoint)
+                continue
+
+            # Check if the previous run of this mapping can be resumed.
+            resume_index = None
+            if self.resume:
+                resume_index = self.get_resume_index(mapping, checkpoint)
+
             # Check if we currently have an index for this mapping.
             old_index = None
             aliases = self.es.indices.get_aliases(name=main_index)
@@ -165,9 +354,15 @@ It is possible to specify multiple models, using comma separation."""
                 if key == main_index:
                     # This is an auto created index. Will be removed at end of command.
                     continue
-                if not value['aliases']:
+                if key == resume_index:
+                    # This is the index we are going to continue with.
+                    continue
+                # The dual write alias of an index that is being built doesn't make it current.
+                if not set(value['aliases']) - set([get_dual_write_alias(mapping)]):
                     if self.force:
                         self.stdout.write('Removing leftover "%s"' % key)
+                        if load_dual_write_index(mapping, es_client=self.es) == key:
+                            stop_dual_write(mapping, es_client=self.es)
                         self.es.indices.delete(key)
                     else:
                         raise Exception('Found leftover %s, proceed with -f to remove.'
@@ -183,14 +378,39 @@ It is possible to specify multiple models, using comma separation."""
                     'number_of_shards': 1,
                 }
             }
-            temp_index_base = 'index_%s' % (int(time.time()))
-            temp_index = get_index_name(temp_index_base, mapping)
-
-            self.stdout.write('Creating new index "%s"' % temp_index)
-            self.es.indices.create(temp_index, body=index_settings)
-
-            # Index documents.
-            self.index_documents(mapping, temp_index_base)
+            if resume_index:
+                temp_index_base = checkpoint.index_base
+                temp_index = resume_index
+            else:
+                temp_index_base = 'index_%s' % (int(time.time()))
+                temp_index = get_index_name(temp_index_base, mapping)
+
+                self.stdout.write('Creating new index "%s"' % temp_index)
+                self.es.indices.create(temp_index, body=index_settings)
+                checkpoint.start(temp_index_base)
+
+            # Don't refresh while building the index, nobody is searching it yet.
+            refresh_interval = self.disable_refresh(temp_index)
+            try:
+                if self.live:
+                    # From now on every update is written to the new index too, once every process has seen it.
+                    start_dual_write(mapping, temp_index_base, es_client=self.es)
+                    time.sleep(DUAL_WRITE_CHECK_INTERVAL)
+
+                # Index documents.
+                self.index_documents(mapping, temp_index_base, checkpoint)
+            finally:
+                # Also when indexing fails, so an index that is never resumed doesn't stay unrefreshed.
+                self.es.indices.put_settings({'index': {'refresh_interval': refresh_interval}}, index=temp_index)
+
+            # Make the documents searchable.
+            self.es.indices.refresh(temp_index)
+
+            if self.live:
+                self.verify_index(mapping, temp_index_base)
+                if load_dual_write_index(mapping, es_client=self.es) != temp_index:
+                    raise Exception('The dual write alias of "%s" disappeared, so updates may be missing from it. '
+                                    'Run again with --live --resume.' % temp_index)
 
             # Switch aliases.
             if old_index:
@@ -202,6 +422,7 @@ It is possible to specify multiple models, using comma separation."""
                         {'add': {'index': temp_index, 'alias': main_index_base}},
                     ]
                 })
+                stop_dual_write(mapping, es_client=self.es)
                 self.stdout.write('Removing previous index "%s"' % old_index)
                 self.es.indices.delete(old_index)
             else:
@@ -217,20 +438,237 @@ It is possible to specify multiple models, using comma separation."""
                         {'add': {'index': temp_index, 'alias': main_index_base}},
                     ]
                 })
+                stop_dual_write(mapping, es_client=self.es)
+            checkpoint.finish()
             self.stdout.write('')
 
         self.stdout.write('Indexing finished.')
 
-    def index_documents(self, mapping, temp_index_base):
+    def disable_refresh(self, index_name):
+        """
+        Turn off the periodic refresh of the index.
+
+        Returns:
+            refresh_interval (str): the refresh interval of the index to restore afterwards
+        """
+        index_settings = self.es.indices.get_settings(index=index_name, flat_settings=True)
+        refresh_interval = index_settings[index_name]['settings'].get('index.refresh_interval')
+        if refresh_interval in (None, '-1'):
+            # Not set, or left behind by a run that was interrupted before it restored the interval.
+            refresh_interval = DEFAULT_REFRESH_INTERVAL
+        self.es.indices.put_settings({'index': {'refresh_interval': '-1'}}, index=index_name)
+        return refresh_interval
+
+    def get_resume_index(self, mapping, checkpoint):
+        """
+        Returns the index of the previous run to resume, None when there is no run to resume.
+
+        The checkpoint is kept in the cache, which can evict it, so starting over is reported instead of
+        silently indexing everything again.
+        """
+        if not checkpoint.is_resumable():
+            if checkpoint.finished:
+                self.stdout.write('The previous run finished, starting a new run')
+            else:
+                self.stderr.write('Warning: no checkpoint of a previous run was found, it may have been evicted '
+                                  'from the cache. Starting a new run.')
+            return None
+
+        resume_index = get_index_name(checkpoint.index_base, mapping)
+        if not self.es.indices.exists(resume_index):
+            self.stderr.write('Warning: the index "%s" of the previous run does not exist anymore. '
+                              'Starting a new run.' % resume_index)
+            return None
+
+        self.stdout.write('Resuming index "%s"' % resume_index)
+        return resume_index
+
+    def index_since(self, mapping, checkpoint):
+        """
+        Update the current index with the instances that were modified or soft deleted since the given time.
+        """
+        if not mapping.has_modified():
+            self.stdout.write('Skipping, the model has no modified field.\n')
+            return
+
+        since = checkpoint.watermark if self.since == 'last' else self.since
+        if not since:
+            self.stdout.write('Skipping, there is no previous run.\n')
+            return
+
+        # Set the new watermark before reading anything, so nothing falls between two runs.
+        watermark = timezone.now()
+        self.stdout.write('Updating instances modified since %s' % since.isoformat())
+        count = index_modified_since(mapping, since, print_progress=True)
+        if checkpoint.finished or not checkpoint.index_base:
+            # Don't touch the checkpoint of a full run that can still be resumed.
+            checkpoint.finish(watermark=watermark)
+        self.stdout.write('Updated %s instances.\n' % count)
+
+    def index_scope(self, mapping):
+        """
+        Replace the documents of the tenant or email account in the current index.
+        """
+        self.stdout.write('Reindexing the documents of %s' % ' and '.join(
+            '%s %s' % (name, pk) for name, pk in (('tenant', self.tenant_id), ('email account', self.email_account_id))
+            if pk))
+        count = reindex_scope(mapping, tenant_id=self.tenant_id, account_id=self.email_account_id,
+                              print_progress=True, use_rows=self.use_rows)
+        self.stdout.write('Indexed %s documents.\n' % count)
+
+    def index_documents(self, mapping, temp_index_base, checkpoint):
         """
         Index all non deleted objects.
         """
         model = mapping.get_model()
         self.stdout.write('Indexing {0}.{1}'.format(model.__module__, model.__name__).lower())
 
-        if mapping.has_deleted():
-            model_objs = model.objects.filter(is_deleted=False)
+        model_objs = get_index_queryset(mapping)
+
+        if self.workers > 1 or checkpoint.pk_ranges:
+            # A parallel run is resumed with the pk ranges of its checkpoint, also without more workers.
+            self.index_documents_parallel(mapping, model_objs, temp_index_base, checkpoint)
+        else:
+            index_objects(mapping, model_objs, temp_index_base, print_progress=True,
+                          start_pk=checkpoint.get_last_pk(), checkpoint_callback=checkpoint.set_last_pk,
+                          use_rows=self.use_rows, create_only=self.live)
+
+    def verify_index(self, mapping, temp_index_base, attempts=3, chunksize=1000):
+        """
+        Make the new index match the database and check that the number of documents is right.
+
+        While the index was being built, instances could be removed after they were read for indexing,
+        so the ids in the index and the database are compared. Extra documents are removed and missing
+        ones are indexed, which repeats until the counts match, since Lily is still being used.
+
+        The ids are compared in pk order a chunk at a time, like `find_drift` does, so they are never
+        all held in memory.
+        """
+        temp_index = get_index_name(temp_index_base, mapping)
+        model_objs = get_index_queryset(mapping)
+
+        for attempt in range(attempts):
+            indexer = BulkIndexer(es_client=self.es, raise_on_error=True)
+            counts = {MISSING: 0, ORPHANED: 0}
+            pks = {MISSING: [], ORPHANED: []}
+
+            def fix(kind):
+                if kind == MISSING:
+                    index_objects(mapping, model_objs.filter(pk__in=pks[kind]), temp_index_base, es_client=self.es)
+                    counts[kind] += len(pks[kind])
+                else:
+                    # Don't remove documents of instances that were created after the ids were read.
+                    extra = set(pks[kind]) - set(model_objs.filter(pk__in=pks[kind]).values_list('pk', flat=True))
+                    for pk in extra:
+                        indexer.add({
+                            '_op_type': 'delete',
+                            '_index': temp_index,
+                            '_type': mapping.get_mapping_type_name(),
+                            '_id': pk,
+                        })
+                    counts[kind] += len(extra)
+                pks[kind] = []
+
+            drift = compare_entries(
+                iter_database_entries(mapping, chunksize=chunksize),
+                iter_index_entries(mapping, index=temp_index_base, chunksize=chunksize, es_client=self.es),
+            )
+            for kind, pk in drift:
+                # Stale documents are kept up to date by the dual write, only the ids are compared.
+                if kind in pks:
+                    pks[kind].append(pk)
+                    if len(pks[kind]) >= chunksize:
+                        fix(kind)
+            for kind in pks:
+                if pks[kind]:
+                    fix(kind)
+            indexer.close()
+
+            if counts[MISSING] or counts[ORPHANED]:
+                self.stdout.write('Fixed %s missing and %s extra documents' % (counts[MISSING], counts[ORPHANED]))
+
+            self.es.indices.refresh(temp_index)
+            index_count = self.es.count(index=temp_index, doc_type=mapping.get_mapping_type_name())['count']
+            db_count = model_objs.count()
+            self.stdout.write('Documents in the new index: %s, instances in the database: %s' % (
+                index_count, db_count))
+            if index_count == db_count:
+                return
+
+            time.sleep(1)
+
+        raise Exception('The new index "%s" does not match the database, run again with --live --resume.' % (
+            temp_index))
+
+    def get_pk_ranges(self, model_objs):
+        """
+        Split the pk space in ranges, more ranges than there are workers, so a worker that finishes
+        a sparse range early picks up the next one.
+        """
+        bounds = model_objs.aggregate(Min('pk'), Max('pk'))
+        if bounds['pk__min'] is None:
+            return []
+
+        pk_min, pk_max = bounds['pk__min'], bounds['pk__max'] + 1
+        range_count = self.workers * 4
+        range_size = max(1, (pk_max - pk_min + range_count - 1) // range_count)
+        return [(pk_from, min(pk_from + range_size, pk_max)) for pk_from in xrange(pk_min, pk_max, range_size)]
+
+    def index_documents_parallel(self, mapping, model_objs, temp_index_base, checkpoint):
+        """
+        Index all objects with multiple worker processes, each indexing a range of primary keys.
+        """
+        if checkpoint.pk_ranges:
+            # Resuming, so keep the ranges the checkpoints were saved for.
+            pk_ranges = [tuple(pk_range) for pk_range in checkpoint.pk_ranges]
         else:
-            model_objs = model.objects.all()
+            # Continue after the last pk of a serial run, when it's resumed with workers.
+            pk_ranges = self.get_pk_ranges(model_objs.filter(pk__gt=checkpoint.get_last_pk()))
+            checkpoint.set_pk_ranges(pk_ranges)
+
+        total = sum(
+            model_objs.filter(pk__gt=checkpoint.get_last_pk(pk_from), pk__gte=pk_from, pk__lt=pk_to).count()
+            for pk_from, pk_to in pk_ranges
+        )
+        if not total:
+            return
+
+        # Don't let the workers inherit the database connection of this process.
+        connections.close_all()
 
-        index_objects(mapping, model_objs, temp_index_base, print_progress=True)
+        manager = Manager()
+        progress_queue = manager.Queue()
+        pool = Pool(processes=self.workers)
+        start = time.time()
+        try:
+            result = pool.map_async(index_pk_range, [
+                (mapping, temp_index_base, pk_from, pk_to, self.use_rows, self.live, progress_queue)
+                for pk_from, pk_to in pk_ranges
+            ], chunksize=1)
+
+            progress = 0
+            while not result.ready() or not progress_queue.empty():
+                try:
+                    progress += progress_queue.get(timeout=1)
+                except Empty:
+                    continue
+                logutil.print_progress(progress, total)
+
+            range_stats = result.get()
+        finally:
+            pool.close()
+            pool.join()
+            manager.shutdown()
+
+        duration = time.time() - start
+        worker_stats = {}
+        for pid, count, range_duration in range_stats:
+            worker_count, worker_duration = worker_stats.get(pid, (0, 0))
+            worker_stats[pid] = (worker_count + count, worker_duration + range_duration)
+
+        indexed = sum(count for count, worker_duration in worker_stats.values())
+        self.stdout.write('\nIndexed %s documents in %.1fs (%.0f docs/s) with %s workers.' % (
+            indexed, duration, indexed / duration if duration else 0, self.workers))
+        for pid, (count, worker_duration) in sorted(worker_stats.items()):
+            self.stdout.write('  Worker %s: %s documents in %.1fs (%.0f docs/s)' % (
+                pid, count, worker_duration, count / worker_duration if worker_duration else 0))
@@ -0,0 +1,135 @@
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from elasticsearch.helpers import expand_action
+from elasticsearch.serializer import JSONSerializer
+
+from lily.messaging.email.search import EmailMessageMapping
+from lily.search.indexing import document_iterator, get_index_queryset, prepare_dict, queryset_iterator
+from lily.search.scan_search import ModelMappings
+from lily.search.serialization import encode_action
+from python_imap.utils import convert_html_to_search_text
+
+
+class Command(BaseCommand):
+    help = """Measure how many documents per second are extracted for the index,
+without sending them to Elasticsearch:
+
+    index_benchmark -t emailmessage --limit 5000
+
+Documents are extracted from model instances and, when the mapping supports
+it, from database rows (see `index --rows`). For email messages the speed is
+also shown with the html bodies parsed at index time, as was done before the
+text of the html body was stored when the message is synchronized.
+
+Preparing and serializing the documents for a bulk request is measured on its
+own, repeated a number of times over the same documents, and compared with
+serializing them with elasticsearch-py:
+
+    index_benchmark -t account,contact,emailmessage --repeat 20"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('-t', '--target',
+                    action='store',
+                    dest='target',
+                    default='',
+                    help='Choose specific model targets, comma separated (no added space after comma).'
+                    ),
+        make_option('--limit',
+                    action='store',
+                    dest='limit',
+                    type='int',
+                    default=1000,
+                    help='The number of documents to extract per mapping.'
+                    ),
+        make_option('--repeat',
+                    action='store',
+                    dest='repeat',
+                    type='int',
+                    default=10,
+                    help='The number of times to prepare and serialize the documents.'
+                    ),
+    )
+
+    def handle(self, *args, **options):
+        for mapping in self.get_mappings(options['target']):
+            queryset = get_index_queryset(mapping).order_by('pk')
+            pks = list(queryset.values_list('pk', flat=True)[:options['limit']])
+            if not pks:
+                continue
+            queryset = queryset.filter(pk__lte=pks[-1])
+
+            self.stdout.write('==> %s (%s documents)' % (mapping.get_mapping_type_name(), len(pks)))
+
+            start = time.time()
+            for obj in queryset_iterator(mapping, queryset):
+                mapping.extract_document(obj.id, obj)
+            duration = time.time() - start
+            self.write_result('instances', len(pks), duration)
+
+            if mapping is EmailMessageMapping:
+                # Parsing the html bodies is what extraction used to cost on top of the above.
+                start = time.time()
+                for body_html in queryset.filter(body_text='').values_list('body_html', flat=True).iterator():
+                    convert_html_to_search_text(body_html)
+                self.write_result('instances, parsing html', len(pks), duration + time.time() - start)
+
+            if mapping.has_values_extraction():
+                start = time.time()
+                for pk, document in document_iterator(mapping, queryset):
+                    pass
+                self.write_result('rows', len(pks), time.time() - start)
+
+            self.benchmark_serialization(mapping, queryset, options['repeat'])
+
+    def benchmark_serialization(self, mapping, queryset, repeat):
+        """
+        Measure prepare_dict and the serialization of bulk actions, on the documents as obj_to_doc returns them.
+        """
+        doc_type = mapping.get_mapping_type_name()
+        docs = []
+        for obj in queryset_iterator(mapping, queryset):
+            document = mapping.obj_to_doc(obj)
+            document['tenant'] = obj.tenant_id
+            document['id'] = obj.id
+            docs.append(document)
+
+        start = time.time()
+        for i in xrange(repeat):
+            prepared = [prepare_dict(doc) for doc in docs]
+        self.write_result('prepare_dict', len(docs) * repeat, time.time() - start)
+
+        actions = [{'_index': 'benchmark', '_type': doc_type, '_id': doc['id'], '_source': doc} for doc in prepared]
+
+        start = time.time()
+        for i in xrange(repeat):
+            for action in actions:
+                encode_action(action)
+        self.write_result('encode', len(actions) * repeat, time.time() - start)
+
+        serializer = JSONSerializer()
+        start = time.time()
+        for i in xrange(repeat):
+            for action in actions:
+                action_line, data = expand_action(action)
+                serializer.dumps(action_line)
+                serializer.dumps(data)
+        self.write_result('encode (elasticsearch-py)', len(actions) * repeat, time.time() - start)
+
+    def write_result(self, label, count, duration):
+        self.stdout.write('%s: %.0f docs/sec (%.2fs)' % (label, count / duration if duration else 0, duration))
+
+    def get_mappings(self, target):
+        if not target:
+            return ModelMappings.mappings
+
+        mappings = []
+        for name in target.split(','):
+            for mapping in ModelMappings.mappings:
+                if name in (mapping.get_mapping_type_name(), mapping.get_model().__name__.lower()):
+                    mappings.append(mapping)
+                    break
+            else:
+                raise CommandError('The target %s was not recognized.' % name)
+        return mappings
@@ -0,0 +1,76 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lily.search.drift import DRIFT_KINDS, find_drift
+from lily.search.scan_search import ModelMappings
+from lily.tenant.models import Tenant
+
+
+class Command(BaseCommand):
+    help = """Compare the database with the index, per mapping and tenant, and report
+the documents that are missing, stale (modified after they were indexed) or
+orphaned (their instance no longer exists):
+
+    index_drift
+    index_drift -t contact,account --tenant 12
+
+Fix the documents that drifted with bulk requests:
+
+    index_drift --repair"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('-t', '--target',
+                    action='store',
+                    dest='target',
+                    default='',
+                    help='Choose specific model targets, comma separated (no added space after comma).'
+                    ),
+        make_option('--tenant',
+                    action='store',
+                    dest='tenant',
+                    type='int',
+                    help='Only compare the documents of this tenant.'
+                    ),
+        make_option('--repair',
+                    action='store_true',
+                    dest='repair',
+                    help='Update the missing and stale documents and remove the orphaned ones.'
+                    ),
+    )
+
+    def handle(self, *args, **options):
+        mappings = self.get_mappings(options['target'])
+        if options['tenant']:
+            tenant_ids = [options['tenant']]
+        else:
+            tenant_ids = Tenant.objects.order_by('pk').values_list('pk', flat=True)
+
+        for mapping in mappings:
+            self.stdout.write('==> %s' % mapping.get_mapping_type_name())
+            totals = dict.fromkeys(DRIFT_KINDS, 0)
+            for tenant_id in tenant_ids:
+                counts = find_drift(mapping, tenant_id=tenant_id, repair=options['repair'])
+                if any(counts.values()):
+                    self.stdout.write('Tenant %s: %s' % (tenant_id, self.format_counts(counts)))
+                for kind in DRIFT_KINDS:
+                    totals[kind] += counts[kind]
+            repaired = ', repaired' if options['repair'] else ''
+            self.stdout.write('Total: %s%s\n' % (self.format_counts(totals), repaired))
+
+    def format_counts(self, counts):
+        return ', '.join('%s %s' % (counts[kind], kind) for kind in DRIFT_KINDS)
+
+    def get_mappings(self, target):
+        if not target:
+            return ModelMappings.mappings
+
+        mappings = []
+        for name in target.split(','):
+            for mapping in ModelMappings.mappings:
+                if name in (mapping.get_mapping_type_name(), mapping.get_model().__name__.lower()):
+                    mappings.append(mapping)
+                    break
+            else:
+                raise CommandError('The target %s was not recognized.' % name)
+        return mappings
@@ -0,0 +1,95 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from lily.search import result_cache
+from lily.search.fingerprints import get_counts, reset_counts
+from lily.search.metrics import STAGES, flush_metrics, get_metrics, get_percentile, reset_metrics
+from lily.search.scan_search import ModelMappings
+
+
+class Command(BaseCommand):
+    help = """Show how many documents were written to the index and how many writes were
+skipped because the document did not change since it was last written.
+
+For every mapping the time spent in every stage of indexing is shown, with the
+throughput in documents and bytes per second. This tells whether slow indexing
+is spent in the database (fetch, prefetch), in Python (obj_to_doc,
+prepare_dict, encode) or in Elasticsearch (bulk).
+
+The hits and misses of the search result cache are shown per mapping, when the
+cache is enabled with ES_RESULT_CACHE."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--reset',
+                    action='store_true',
+                    dest='reset',
+                    help='Reset the counters after showing them.'
+                    ),
+    )
+
+    def handle(self, *args, **options):
+        counts = get_counts()
+        total = counts['skipped'] + counts['written']
+
+        self.stdout.write('Written documents: %s' % counts['written'])
+        self.stdout.write('Skipped documents: %s (%.1f%%)' % (
+            counts['skipped'], 100.0 * counts['skipped'] / total if total else 0))
+
+        # Include the measurements of this process, e.g. when called after indexing.
+        flush_metrics()
+        for mapping in ModelMappings.mappings:
+            self.write_metrics(mapping.get_mapping_type_name())
+
+        self.write_result_cache_counts()
+
+        if options['reset']:
+            reset_counts()
+            for mapping in ModelMappings.mappings:
+                reset_metrics(mapping.get_mapping_type_name())
+                result_cache.reset_counts(mapping.get_mapping_type_name())
+            result_cache.reset_counts(None)
+            self.stdout.write('The counters have been reset.')
+
+    def write_metrics(self, doc_type):
+        metrics = get_metrics(doc_type)
+        if not any(values['calls'] for values in metrics.values()):
+            return
+
+        self.stdout.write('\n==> %s' % doc_type)
+        self.stdout.write('%-14s%10s%10s%12s%10s%10s%12s%12s' % (
+            'stage', 'calls', 'docs', 'seconds', 'p50 ms', 'p95 ms', 'docs/sec', 'KB/sec'))
+        for stage in STAGES:
+            values = metrics[stage]
+            if not values['calls']:
+                continue
+            seconds = values['micros'] / 1000000.0
+            self.stdout.write('%-14s%10s%10s%12.3f%10s%10s%12.0f%12s' % (
+                stage,
+                values['calls'],
+                values['docs'],
+                seconds,
+                self.format_percentile(values, 0.5),
+                self.format_percentile(values, 0.95),
+                values['docs'] / seconds if seconds else 0,
+                '%.0f' % (values['bytes'] / seconds / 1024) if values['bytes'] and seconds else '-',
+            ))
+
+    def write_result_cache_counts(self):
+        doc_types = [mapping.get_mapping_type_name() for mapping in ModelMappings.mappings] + [None]
+        counts = [(doc_type, result_cache.get_counts(doc_type)) for doc_type in doc_types]
+        if not any(values[result_cache.HITS] or values[result_cache.MISSES] for doc_type, values in counts):
+            return
+
+        self.stdout.write('\n==> result cache')
+        self.stdout.write('%-30s%10s%10s%10s' % ('type', 'hits', 'misses', 'hit %'))
+        for doc_type, values in counts:
+            total = values[result_cache.HITS] + values[result_cache.MISSES]
+            if total:
+                self.stdout.write('%-30s%10s%10s%10.1f' % (
+                    doc_type or 'all', values[result_cache.HITS], values[result_cache.MISSES],
+                    100.0 * values[result_cache.HITS] / total))
+
+    def format_percentile(self, values, percentile):
+        bucket = get_percentile(values, percentile)
+        return '<=%s' % bucket if bucket else '>5000'
@@ -0,0 +1,85 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lily.search.indexing import unindex_by_query, unindex_objects
+from lily.search.scan_search import ModelMappings
+
+
+class Command(BaseCommand):
+    help = """Remove documents from Elasticsearch in bulk.
+
+Remove every document of a tenant, or the email messages of an email account,
+with a delete by query per index:
+
+    unindex --tenant 12
+    unindex -t emailmessage --email-account 34
+
+Remove the documents of instances that are (soft) deleted in the database:
+
+    unindex -t contact --deleted"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('-t', '--target',
+                    action='store',
+                    dest='target',
+                    default='',
+                    help='Choose specific model targets, comma separated (no added space after comma).'
+                    ),
+        make_option('--tenant',
+                    action='store',
+                    dest='tenant',
+                    type='int',
+                    help='Remove the documents of this tenant.'
+                    ),
+        make_option('--email-account',
+                    action='store',
+                    dest='email_account',
+                    type='int',
+                    help='Remove the documents of this email account.'
+                    ),
+        make_option('--deleted',
+                    action='store_true',
+                    dest='deleted',
+                    help='Remove the documents of the deleted instances.'
+                    ),
+    )
+
+    def handle(self, *args, **options):
+        mappings = self.get_mappings(options['target'])
+
+        if options['deleted']:
+            for mapping in mappings:
+                if not mapping.has_deleted():
+                    continue
+                self.stdout.write('==> %s' % mapping.get_mapping_type_name())
+                queryset = mapping.get_model().objects.filter(is_deleted=True)
+                count = unindex_objects(mapping, queryset, print_progress=True)
+                self.stdout.write('Removed %s documents.\n' % count)
+            return
+
+        if not options['tenant'] and not options['email_account']:
+            raise CommandError('Give a tenant or email account, or --deleted.')
+
+        if options['email_account']:
+            # Only the mappings of models that belong to an email account.
+            mappings = [mapping for mapping in mappings if mapping.has_email_account()]
+
+        for mapping in mappings:
+            self.stdout.write('==> %s' % mapping.get_mapping_type_name())
+            count = unindex_by_query(mapping, tenant_id=options['tenant'], account_id=options['email_account'])
+            self.stdout.write('Removed %s documents.\n' % count)
+
+    def get_mappings(self, target):
+        if not target:
+            return ModelMappings.mappings
+
+        mappings = []
+        for name in target.split(','):
+            for mapping in ModelMappings.mappings:
+                if name in (mapping.get_mapping_type_name(), mapping.get_model().__name__.lower()):
+                    mappings.append(mapping)
+                    break
+            else:
+                raise CommandError('The target %s was not recognized.' % name)
+        return mappings
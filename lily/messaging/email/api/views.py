@@ -12,11 +12,13 @@ from rest_framework.viewsets import GenericViewSet
 
 from lily.messaging.email.utils import get_email_parameter_api_dict, reindex_email_message
 from lily.search.lily_search import LilySearch
+from lily.search.tasks import unindex_documents
 from lily.tenant.api.mixins import SetTenantUserMixin
 from lily.users.models import LilyUser
 
 from .serializers import (EmailLabelSerializer, EmailAccountSerializer, EmailMessageSerializer,
                           EmailTemplateSerializer, SharedEmailConfigSerializer, TemplateVariableSerializer)
+from ..search import EmailMessageMapping
 from ..models.models import (EmailLabel, EmailAccount, EmailMessage, EmailTemplate, SharedEmailConfig,
                              TemplateVariable)
 from ..tasks import (trash_email_message, delete_email_message, toggle_read_email_message,
@@ -89,6 +91,8 @@ class EmailAccountViewSet(mixins.DestroyModelMixin,
         if instance.owner_id is self.request.user.id:
             instance.is_deleted = True
             instance.save()
+            # The email messages of the account are not searched anymore, see `reindex_documents` for re-adding it.
+            unindex_documents.delay(EmailMessageMapping.get_mapping_type_name(), account_id=instance.pk)
         else:
             return Response(status=status.HTTP_403_FORBIDDEN)
 
@@ -13,7 +13,7 @@ from django.core.files import File
 from django.db import transaction, IntegrityError
 import pytz
 
-from python_imap.utils import get_extensions_for_type
+from python_imap.utils import convert_html_to_search_text, get_extensions_for_type
 
 from ..models.models import EmailMessage, EmailHeader, Recipient, EmailAttachment, NoEmailMessageId
 
@@ -425,6 +425,12 @@ class MessageBuilder(object):
             if self.attachments or self.inline_attachments:
                 self.message.has_attachment = True
 
+            # Parse the html body once, instead of every time the message is indexed.
+            if not self.message.body_text and self.message.body_html:
+                self.message.body_html_text = convert_html_to_search_text(self.message.body_html)
+            else:
+                self.message.body_html_text = ''
+
             if not self.message.pk:
                 # Save before we can add many-to-many and foreign keys.
                 try:
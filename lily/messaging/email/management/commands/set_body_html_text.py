@@ -0,0 +1,64 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from python_imap.utils import convert_html_to_search_text
+
+from ...models.models import EmailMessage
+
+
+class Command(BaseCommand):
+    help = """Store the text of the html body of the email messages without a text body,
+which is indexed instead of parsing the html every time a message is indexed
+(see MessageBuilder.save). Until then the html of these messages is parsed
+when they're indexed (see EmailMessageMapping.get_body), so run this once
+after migrating, preferably before reindexing the email messages:
+
+    set_body_html_text
+
+The messages are updated in batches of primary keys, each batch in its own
+transaction, so no table is locked for long. An interrupted run can be
+resumed after the last primary key it printed:
+
+    set_body_html_text --start-pk 123456"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+                    action='store',
+                    dest='batch_size',
+                    type='int',
+                    default=500,
+                    help='The number of messages to update per transaction.'
+                    ),
+        make_option('--start-pk',
+                    action='store',
+                    dest='start_pk',
+                    type='int',
+                    default=0,
+                    help='Only update the messages with a higher primary key.'
+                    ),
+    )
+
+    def handle(self, *args, **options):
+        # Only the messages without a text body are indexed with the text of their html body.
+        queryset = EmailMessage.objects.filter(body_text='', body_html_text='').exclude(body_html='')
+
+        pk = options['start_pk']
+        count = 0
+        while True:
+            messages = list(queryset.filter(pk__gt=pk).order_by('pk').only('pk', 'body_html')[:options['batch_size']])
+            if not messages:
+                break
+
+            with transaction.atomic():
+                for message in messages:
+                    EmailMessage.objects.filter(pk=message.pk).update(
+                        body_html_text=convert_html_to_search_text(message.body_html),
+                    )
+
+            pk = messages[-1].pk
+            count += len(messages)
+            self.stdout.write('Updated %s messages, up to pk %s.' % (count, pk))
+
+        self.stdout.write('Done.')
@@ -168,6 +168,8 @@ class EmailMessage(models.Model):
     account = models.ForeignKey(EmailAccount, related_name='messages')
     body_html = models.TextField(default='')
     body_text = models.TextField(default='')
+    # Plain text of body_html for messages without a text body, stored once so indexing never parses html.
+    body_html_text = models.TextField(default='')
     draft_id = models.CharField(max_length=50, db_index=True, default='')
     has_attachment = models.BooleanField(default=False)
     labels = models.ManyToManyField(EmailLabel, related_name='messages')
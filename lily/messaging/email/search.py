@@ -1,11 +1,35 @@
-from bs4 import BeautifulSoup
+from django.conf import settings
 from lily.search.base_mapping import BaseMapping
+from lily.search.extraction import fetch_many_to_many
+from python_imap.utils import convert_html_to_search_text
 
 from .models.models import EmailMessage
-from python_imap.utils import convert_br_to_newline
 
 
 class EmailMessageMapping(BaseMapping):
+    # Email messages are mostly written by the synchronization, so don't refresh on every message.
+    refresh_policy = 'periodic'
+    large_fields = ('body',)
+    values_fields = [
+        'id',
+        'account',
+        'account__tenant',
+        'account__label',
+        'account__email_address',
+        'subject',
+        'sent_date',
+        'read',
+        'snippet',
+        'has_attachment',
+        'sender__email_address',
+        'sender__name',
+        'message_id',
+        'thread_id',
+        'body_text',
+        'body_html_text',
+    ]
+    values_tenant_field = 'account__tenant'
+
     @classmethod
     def get_model(cls):
         return EmailMessage
@@ -36,6 +60,12 @@ class EmailMessageMapping(BaseMapping):
             'sender_email': {
                 'type': 'string',
                 'analyzer': 'email_analyzer',
+                'fields': {
+                    'exact': {
+                        'type': 'string',
+                        'analyzer': 'lowercase_keyword_analyzer',
+                    },
+                },
             },
             'sender_name': {
                 'type': 'string',
@@ -44,6 +74,12 @@ class EmailMessageMapping(BaseMapping):
             'received_by_email': {
                 'type': 'string',
                 'analyzer': 'email_analyzer',
+                'fields': {
+                    'exact': {
+                        'type': 'string',
+                        'analyzer': 'lowercase_keyword_analyzer',
+                    },
+                },
             },
             'received_by_name': {
                 'type': 'string',
@@ -52,6 +88,12 @@ class EmailMessageMapping(BaseMapping):
             'received_by_cc_email': {
                 'type': 'string',
                 'analyzer': 'email_analyzer',
+                'fields': {
+                    'exact': {
+                        'type': 'string',
+                        'analyzer': 'lowercase_keyword_analyzer',
+                    },
+                },
             },
             'received_by_cc_name': {
                 'type': 'string',
@@ -126,6 +168,8 @@ class EmailMessageMapping(BaseMapping):
             'account',
         ).select_related(
             'sender',
+        ).defer(
+            'body_html',
         )
 
     @classmethod
@@ -154,7 +198,7 @@ class EmailMessageMapping(BaseMapping):
             'received_by_cc_name': [receiver.name for receiver in obj.received_by_cc.all() if receiver.name],
             'message_id': obj.message_id,
             'thread_id': obj.thread_id,
-            'body': obj.body_text or cls.body_html_parsed(obj),
+            'body': cls.get_body(obj),
             'is_trashed': obj.is_trashed,
             'is_starred': obj.is_starred,
             'is_spam': obj.is_spam,
@@ -162,12 +206,76 @@ class EmailMessageMapping(BaseMapping):
             'is_archived': obj.is_archived,
         }
 
+    @classmethod
+    def get_body(cls, obj):
+        """
+        Returns the text body of a message, or else the stored text of its html body.
+
+        Messages that were synchronized before the text of the html body was stored only have the html body,
+        until the set_body_html_text command stored their text, so it's parsed for those messages. The html
+        body is deferred for batch indexing, so it's only read for them.
+        """
+        if obj.body_text or obj.body_html_text:
+            return obj.body_text or obj.body_html_text
+        if obj.body_html:
+            return convert_html_to_search_text(obj.body_html)
+        return ''
+
+    @classmethod
+    def rows_to_docs(cls, rows):
+        """
+        Translate a chunk of rows to index documents, the same as obj_to_doc.
+        """
+        pks = [row['id'] for row in rows]
+
+        labels = fetch_many_to_many(EmailMessage, 'labels', pks, ['label_id', 'name'])
+        received_by = fetch_many_to_many(EmailMessage, 'received_by', pks, ['email_address', 'name'])
+        received_by_cc = fetch_many_to_many(EmailMessage, 'received_by_cc', pks, ['email_address', 'name'])
+        # The html bodies of the messages of which the text wasn't stored yet, see `get_body`.
+        html_bodies = dict(EmailMessage.objects.filter(
+            pk__in=[row['id'] for row in rows if not row['body_text'] and not row['body_html_text']],
+        ).exclude(body_html='').values_list('pk', 'body_html'))
+
+        docs = []
+        for row in rows:
+            pk = row['id']
+            label_ids = [label['label_id'] for label in labels[pk] if label['label_id']]
+            docs.append({
+                'account': row['account'],
+                'account_name': row['account__label'],
+                'account_email': row['account__email_address'],
+                'subject': row['subject'],
+                'sent_date': row['sent_date'],
+                'read': row['read'],
+                'snippet': row['snippet'],
+                'has_attachment': row['has_attachment'],
+                'label_id': label_ids,
+                'label_name': [label['name'] for label in labels[pk] if label['name']],
+                'sender_email': row['sender__email_address'],
+                'sender_name': row['sender__name'],
+                'received_by_email':
+                    [receiver['email_address'] for receiver in received_by[pk] if receiver['email_address']],
+                'received_by_name': [receiver['name'] for receiver in received_by[pk] if receiver['name']],
+                'received_by_cc_email':
+                    [receiver['email_address'] for receiver in received_by_cc[pk] if receiver['email_address']],
+                'received_by_cc_name': [receiver['name'] for receiver in received_by_cc[pk] if receiver['name']],
+                'message_id': row['message_id'],
+                'thread_id': row['thread_id'],
+                'body': row['body_text'] or row['body_html_text'] or (
+                    convert_html_to_search_text(html_bodies[pk]) if pk in html_bodies else ''),
+                'is_trashed': settings.GMAIL_LABEL_TRASH in label_ids,
+                'is_starred': settings.GMAIL_LABEL_STAR in label_ids,
+                'is_spam': settings.GMAIL_LABEL_SPAM in label_ids,
+                'is_draft': settings.GMAIL_LABEL_DRAFT in label_ids,
+                'is_archived': settings.GMAIL_LABEL_INBOX not in label_ids,
+            })
+
+        return docs
+
     @classmethod
     def has_deleted(cls):
         return False
 
     @classmethod
-    def body_html_parsed(cls, obj):
-        soup = BeautifulSoup(obj.body_html, 'lxml', from_encoding='utf-8')
-        soup = convert_br_to_newline(soup)
-        return soup.get_text()
+    def has_email_account(cls):
+        return True
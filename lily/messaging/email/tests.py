@@ -1,6 +1,6 @@
 from unittest import TestCase
 
-from python_imap.utils import convert_html_to_text
+from python_imap.utils import convert_html_to_search_text, convert_html_to_text
 
 
 class ConvertHTMLToTextTestCase(TestCase):
@@ -59,3 +59,13 @@ Bye!
         result = 'Test link title <http://www.test.com>'
 
         self.assertEqual(convert_html_to_text(html, keep_linebreaks=True), result)
+
+
+class ConvertHTMLToSearchTextTestCase(TestCase):
+
+    def test_br_to_newline(self):
+        html = '<p>Hello VoipGRID,<br>This is a <b>test</b></p>'
+
+        result = 'Hello VoipGRID,\nThis is a test'
+
+        self.assertEqual(convert_html_to_search_text(html), result)
@@ -18,7 +18,7 @@ from django.utils.translation import ugettext_lazy as _
 from lily.accounts.models import Account
 from lily.contacts.models import Contact
 from lily.search.scan_search import ModelMappings
-from lily.search.indexing import update_in_index
+from lily.search.indexing import update_in_index, REFRESH_WAIT_FOR
 
 from .decorators import get_safe_template
 from .models.models import EmailAttachment, EmailMessage
@@ -502,7 +502,8 @@ def reindex_email_message(instance):
     Re-index the given email message instance, so there is no need to misuse the save method for triggering a re-index.
 
     No need to check related models compared to the more generic post_save signal. Email messages have no related model
-    mapping.
+    mapping. The document is based on unsaved instance variables, so it can't be deferred to the index queue. The user
+    expects to see the change right away, so wait for the write to be searchable.
     """
     if settings.ES_DISABLED:
         return
@@ -510,4 +511,4 @@ def reindex_email_message(instance):
         return
     mapping = ModelMappings.model_to_mappings.get(type(instance))
     if mapping:
-        update_in_index(instance, mapping)
+        update_in_index(instance, mapping, defer=False, refresh=REFRESH_WAIT_FOR)
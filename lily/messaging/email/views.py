@@ -32,6 +32,7 @@ from lily.contacts.models import Contact
 from lily.google.token_generator import generate_token, validate_token
 from lily.integrations.models import IntegrationDetails
 from lily.integrations.credentials import get_credentials
+from lily.search.tasks import reindex_documents
 from lily.tenant.middleware import get_current_user
 from lily.utils.functions import is_ajax, post_intercom_event, send_post_request
 from lily.utils.views.mixins import LoginRequiredMixin, FormActionMixin, AjaxFormMixin
@@ -41,6 +42,7 @@ from .forms import (ComposeEmailForm, CreateUpdateEmailTemplateForm, CreateUpdat
 from .models.models import (EmailMessage, EmailAttachment, EmailAccount, EmailTemplate, DefaultEmailTemplate,
                             EmailOutboxMessage, EmailOutboxAttachment, TemplateVariable, GmailCredentialsModel,
                             EmailLabel)
+from .search import EmailMessageMapping
 from .services import build_gmail_service
 from .tasks import (send_message, create_draft_email_message, delete_email_message, update_draft_email_message,
                     add_and_remove_labels_for_message)
@@ -113,6 +115,9 @@ class OAuth2Callback(LoginRequiredMixin, View):
         storage = Storage(GmailCredentialsModel, 'id', account, 'credentials')
         storage.put(credentials)
 
+        # The email messages of a removed account were removed from the index, see `EmailAccountViewSet`.
+        was_deleted = account.is_deleted
+
         # Set account as authorized.
         account.is_authorized = True
         account.is_deleted = False
@@ -132,6 +137,12 @@ class OAuth2Callback(LoginRequiredMixin, View):
 
         account.save()
 
+        if was_deleted:
+            # Synchronizing only fetches the changes since the account was removed, so index its messages again.
+            reindex_documents.delay(account_id=account.pk, mapping_type_names=[
+                EmailMessageMapping.get_mapping_type_name(),
+            ])
+
         post_intercom_event(event_name='email-account-added', user_id=request.user.id)
 
         return HttpResponseRedirect('/#/preferences/emailaccounts/edit/%s' % account.pk)
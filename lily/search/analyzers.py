@@ -33,6 +33,13 @@ def get_analyzers():
                     'tokenizer': 'email_tokenizer',
                     'filter': ['lowercase', 'my_ascii'],
                 },
+                # The whole value as one lowercase token, for exact matches
+                # on e.g. email addresses with a terms filter.
+                'lowercase_keyword_analyzer': {
+                    'type': 'custom',
+                    'tokenizer': 'keyword',
+                    'filter': ['lowercase'],
+                },
                 # Websites will be tokenized on component hierarchy, i.e.
                 # www.example.org will hit on the following search terms:
                 # 'org', 'example.org' and 'www.example.org'
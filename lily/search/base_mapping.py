@@ -2,11 +2,21 @@ from django.db.models import FieldDoesNotExist
 from elasticutils.contrib.django import MappingType, Indexable
 
 from lily.search.indexing import prepare_dict
+from lily.search.metrics import OBJ_TO_DOC, PREPARE_DICT, measure
 
 
 class BaseMapping(MappingType, Indexable):
     has_deleted_mixin = None
     model = None
+    # The refresh policy for writes of this mapping, None to use settings.ES_REFRESH_POLICY.
+    refresh_policy = None
+    # The fields to read to build documents from database rows instead of model instances (see rows_to_docs),
+    # None when the mapping only supports model instances.
+    values_fields = None
+    # The field (or lookup) of values_fields that contains the tenant id.
+    values_tenant_field = 'tenant'
+    # Large fields that are left out of the search results, unless they're asked for (see LilySearch.do_search).
+    large_fields = ()
 
     @classmethod
     def get_model(cls):
@@ -51,12 +61,15 @@ class BaseMapping(MappingType, Indexable):
         if obj is None:
             obj = cls.get_model().objects.get(pk=obj_id)
 
-        doc = cls.obj_to_doc(obj)
+        doc_type = cls.get_mapping_type_name()
+        with measure(doc_type, OBJ_TO_DOC):
+            doc = cls.obj_to_doc(obj)
 
         doc['tenant'] = obj.tenant_id
         doc['id'] = obj_id
 
-        return prepare_dict(doc)
+        with measure(doc_type, PREPARE_DICT):
+            return prepare_dict(doc)
 
     @classmethod
     def obj_to_doc(cls, obj):
@@ -65,6 +78,39 @@ class BaseMapping(MappingType, Indexable):
         """
         raise NotImplementedError
 
+    @classmethod
+    def extract_documents(cls, rows):
+        """
+        Converts a chunk of rows (dicts with the values_fields) into Elasticsearch documents.
+
+        Sets the tenant and id and prepares the dicts, the same as extract_document does.
+        """
+        doc_type = cls.get_mapping_type_name()
+        # Fetching the related rows is part of rows_to_docs, so it's measured as part of that stage.
+        with measure(doc_type, OBJ_TO_DOC, docs=len(rows)):
+            docs = cls.rows_to_docs(rows)
+
+        for row, doc in zip(rows, docs):
+            doc['tenant'] = row[cls.values_tenant_field]
+            doc['id'] = row['id']
+
+        with measure(doc_type, PREPARE_DICT, docs=len(docs)):
+            return [prepare_dict(doc) for doc in docs]
+
+    @classmethod
+    def rows_to_docs(cls, rows):
+        """
+        Translate a chunk of rows to index documents, the related rows are fetched for the whole chunk at once.
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def has_values_extraction(cls):
+        """
+        Can documents of this mapping be built from database rows?
+        """
+        return cls.values_fields is not None
+
     @classmethod
     def has_deleted(cls):
         """
@@ -82,10 +128,29 @@ class BaseMapping(MappingType, Indexable):
             except FieldDoesNotExist:
                 return False
 
+    @classmethod
+    def has_modified(cls):
+        """
+        Does the model keep track of the time it was last modified?
+        """
+        try:
+            cls.get_model()._meta.get_field('modified')
+            return True
+        except FieldDoesNotExist:
+            return False
+
+    @classmethod
+    def has_email_account(cls):
+        """
+        Do the instances belong to an email account, which is stored in the account field of the document?
+        """
+        return False
+
     @classmethod
     def get_related_models(cls):
         """
         Method stump for the listening to signals of related models.
+        Return querysets where possible, so only the pks are read, see `check_related`.
         """
         return {}
 
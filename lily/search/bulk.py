@@ -0,0 +1,179 @@
+import logging
+from threading import BoundedSemaphore, Lock
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from elasticsearch.exceptions import TransportError
+from elasticsearch.helpers import BulkIndexError
+
+from lily.search.connections_utils import get_es_client
+from lily.search.metrics import ENCODE, record, record_bulk
+from lily.search.result_cache import bump_generations
+from lily.search.serialization import encode_action
+
+
+logger = logging.getLogger('search')
+
+
+class BulkIndexer(object):
+    """
+    Streams actions to Elasticsearch with the bulk api.
+
+    Actions are serialized to NDJSON as soon as they are added and a bulk request is sent when the
+    next action would exceed the maximum payload size or document count. Requests are sent
+    by a small thread pool, so a bounded number of requests is in flight while the caller
+    extracts the next documents. Items that are rejected because the bulk queue of the
+    cluster is full (429) are retried per item with an increasing delay.
+
+    Usage:
+        indexer = BulkIndexer()
+        for action in actions:
+            indexer.add(action)
+        success, errors = indexer.close()
+    """
+    def __init__(self, es_client=None, max_bytes=None, max_docs=None, max_in_flight=None, max_retries=None,
+                 raise_on_error=False, done_callback=None, **bulk_kwargs):
+        """
+        Args:
+            es_client (Elasticsearch): client to use, by default one with a connection per request in flight
+            max_bytes (int): maximum size of the payload of one bulk request
+            max_docs (int): maximum number of actions in one bulk request
+            max_in_flight (int): maximum number of bulk requests that are sent at the same time
+            max_retries (int): number of times an item that was rejected with a 429 is retried
+            raise_on_error (boolean): raise a BulkIndexError on close when any item failed
+            done_callback (function): called with the last action of every bulk request, in the order the
+                actions were added, when it and every request before it is done
+            bulk_kwargs: passed to every bulk request, e.g. refresh
+        """
+        self.max_bytes = max_bytes or settings.ES_BULK_MAX_BYTES
+        self.max_docs = max_docs or settings.ES_BULK_MAX_DOCS
+        self.max_in_flight = max_in_flight or settings.ES_BULK_MAX_IN_FLIGHT
+        self.max_retries = settings.ES_BULK_MAX_RETRIES if max_retries is None else max_retries
+        self.es = es_client or get_es_client(maxsize=self.max_in_flight)
+        self.raise_on_error = raise_on_error
+        self.done_callback = done_callback
+        self.bulk_kwargs = bulk_kwargs
+
+        self.executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        self.in_flight = BoundedSemaphore(self.max_in_flight)
+        self.lock = Lock()
+
+        # The chunk being built, a list of (action, lines) tuples.
+        self.chunk = []
+        self.chunk_bytes = 0
+
+        # Bookkeeping to call done_callback in order.
+        self.chunk_count = 0
+        self.next_done = 0
+        self.done = {}
+
+        self.success = 0
+        self.errors = []
+        self.bytes_sent = 0
+
+    def add(self, action):
+        """
+        Add an action, in the format of `elasticsearch.helpers.bulk`.
+        """
+        start = time.time()
+        lines = encode_action(action)
+        size = sum(len(line) + 1 for line in lines)
+        record(action['_type'], ENCODE, time.time() - start, size=size)
+
+        if self.chunk and (self.chunk_bytes + size > self.max_bytes or len(self.chunk) >= self.max_docs):
+            self.flush()
+
+        self.chunk.append((action, lines))
+        self.chunk_bytes += size
+
+    def flush(self):
+        """
+        Send the current chunk, blocks while the maximum number of requests is in flight.
+        """
+        if not self.chunk:
+            return
+
+        chunk, self.chunk, self.chunk_bytes = self.chunk, [], 0
+        sequence = self.chunk_count
+        self.chunk_count += 1
+
+        self.in_flight.acquire()
+        future = self.executor.submit(self.send, chunk)
+        future.add_done_callback(lambda future: self.chunk_done(sequence, chunk[-1][0]))
+
+    def close(self):
+        """
+        Send the remaining actions and wait for all requests to finish.
+
+        Returns:
+            success (int): number of actions that succeeded
+            errors (list): the items that failed
+        """
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+        if self.errors and self.raise_on_error:
+            raise BulkIndexError('%i document(s) failed to index.' % len(self.errors), self.errors)
+
+        return self.success, self.errors
+
+    def chunk_done(self, sequence, last_action):
+        self.in_flight.release()
+
+        if not self.done_callback:
+            return
+
+        with self.lock:
+            if self.errors:
+                # Never report progress past a failed item.
+                return
+
+            self.done[sequence] = last_action
+            while self.next_done in self.done:
+                self.done_callback(self.done.pop(self.next_done))
+                self.next_done += 1
+
+    def send(self, chunk):
+        """
+        Send a chunk and retry the items that were rejected, runs in a thread of the pool.
+        """
+        try:
+            for attempt in range(self.max_retries + 1):
+                body = ''.join(line + '\n' for action, lines in chunk for line in lines)
+                start = time.time()
+                response = self.es.bulk(body, **self.bulk_kwargs)
+                record_bulk([action for action, lines in chunk], time.time() - start, size=len(body))
+                bump_generations([action for action, lines in chunk])
+                with self.lock:
+                    self.bytes_sent += len(body)
+
+                rejected = []
+                for (action, lines), item in zip(chunk, response['items']):
+                    op_type, result = item.popitem()
+                    status = result.get('status', 500)
+                    # Deleting a missing document, or creating one that already exists, leaves the index as wanted.
+                    done = (op_type == 'delete' and status == 404) or (op_type == 'create' and status == 409)
+                    if 200 <= status < 300 or done:
+                        with self.lock:
+                            self.success += 1
+                    elif status == 429 and attempt < self.max_retries:
+                        rejected.append((action, lines))
+                    else:
+                        with self.lock:
+                            self.errors.append({op_type: result})
+
+                if not rejected:
+                    break
+
+                logger.warning('Elasticsearch rejected %s of %s bulk items, retrying' % (len(rejected), len(chunk)))
+                chunk = rejected
+                time.sleep(2 ** attempt)
+        except TransportError as e:
+            with self.lock:
+                self.errors.extend({'index': {'_id': action.get('_id'), 'error': str(e), 'status': e.status_code}}
+                                   for action, lines in chunk)
+        except Exception as e:
+            logger.exception('Bulk request failed')
+            with self.lock:
+                self.errors.extend({'index': {'_id': action.get('_id'), 'error': repr(e)}} for action, lines in chunk)
@@ -0,0 +1,83 @@
+from django.core.cache import cache
+from django.utils import timezone
+
+
+class IndexCheckpoint(object):
+    """
+    The persisted progress of (re)indexing a mapping, so an interrupted index command can resume where it stopped.
+
+    The checkpoint is stored in the cache without expiry and consists of:
+        index_base (str): the base name of the index that is being built
+        pk_ranges (list): the pk ranges the workers are indexing, None when indexing serially
+        watermark (datetime): the time the last run started, instances modified afterwards may not be indexed
+        finished (boolean): True when the last run completed
+
+    The last indexed pk is stored per pk range in a separate key, so workers never overwrite each other.
+    The cache may still evict the checkpoint, e.g. the file based cache culls its entries, in which
+    case the index command warns that it can't resume and starts a new run.
+    """
+    key_prefix = 'search:index_checkpoint'
+
+    def __init__(self, mapping):
+        self.mapping_key = '%s:%s' % (self.key_prefix, mapping.get_mapping_type_name())
+
+        data = cache.get(self.mapping_key) or {}
+        self.index_base = data.get('index_base')
+        self.pk_ranges = data.get('pk_ranges')
+        self.watermark = data.get('watermark')
+        self.finished = data.get('finished', False)
+
+    def get_range_key(self, pk_from=None):
+        return '%s:%s' % (self.mapping_key, pk_from or 'all')
+
+    def save(self):
+        cache.set(self.mapping_key, {
+            'index_base': self.index_base,
+            'pk_ranges': self.pk_ranges,
+            'watermark': self.watermark,
+            'finished': self.finished,
+        }, None)
+
+    def start(self, index_base, pk_ranges=None):
+        """
+        Start a new run, the watermark is set before anything is read from the database.
+        """
+        self.clear_positions()
+        self.index_base = index_base
+        self.pk_ranges = pk_ranges
+        self.watermark = timezone.now()
+        self.finished = False
+        self.save()
+
+    def set_pk_ranges(self, pk_ranges):
+        self.pk_ranges = pk_ranges
+        self.save()
+
+    def finish(self, watermark=None):
+        """
+        Mark the run as completed, the watermark is kept for incremental runs.
+        """
+        self.clear_positions()
+        self.pk_ranges = None
+        self.finished = True
+        if watermark:
+            self.watermark = watermark
+        self.save()
+
+    def get_last_pk(self, pk_from=None):
+        """
+        Returns the last pk that was indexed in the range starting with pk_from, 0 when nothing was indexed yet.
+        """
+        return cache.get(self.get_range_key(pk_from)) or 0
+
+    def set_last_pk(self, pk, pk_from=None):
+        cache.set(self.get_range_key(pk_from), pk, None)
+
+    def clear_positions(self):
+        keys = [self.get_range_key()]
+        if self.pk_ranges:
+            keys.extend(self.get_range_key(pk_from) for pk_from, pk_to in self.pk_ranges)
+        cache.delete_many(keys)
+
+    def is_resumable(self):
+        return bool(self.index_base and not self.finished)
@@ -0,0 +1,133 @@
+import logging
+
+from dateutil.parser import parse
+from elasticsearch.helpers import scan
+
+from lily.search.connections_utils import get_index_name
+from lily.search.extraction import iter_row_chunks
+from lily.search.fingerprints import get_key, save_fingerprints
+from lily.search.indexing import REFRESH_NONE, es, get_index_queryset, main_index, update_ids_in_index
+
+
+logger = logging.getLogger('search')
+
+MISSING = 'missing'
+STALE = 'stale'
+ORPHANED = 'orphaned'
+DRIFT_KINDS = (MISSING, STALE, ORPHANED)
+
+
+def iter_database_entries(mapping, tenant_id=None, chunksize=1000):
+    """
+    Returns an iterator over (pk, modified) tuples of the instances that belong in the index, ordered by pk.
+    The rows are streamed, see `iter_row_chunks`. Modified is None for models that don't keep track of it.
+    """
+    queryset = get_index_queryset(mapping, tenant_id=tenant_id).order_by('pk')
+    fields = ['id', 'modified'] if mapping.has_modified() else ['id']
+
+    for rows in iter_row_chunks(queryset, fields, chunksize=chunksize):
+        for row in rows:
+            yield row['id'], row.get('modified')
+
+
+def iter_index_entries(mapping, tenant_id=None, index=None, chunksize=1000, es_client=None):
+    """
+    Returns an iterator over (id, modified) tuples of the documents in the index, ordered by id.
+    The documents are read with a sorted scroll, so only one page is held in memory at a time.
+
+    Args:
+        index (str): the base name of the index, None for the main index
+        es_client (Elasticsearch): client to use instead of the shared one
+    """
+    query = {'match_all': {}}
+    if tenant_id:
+        query = {'filtered': {'filter': {'term': {'tenant': tenant_id}}}}
+
+    hits = scan(
+        es_client or es,
+        query={
+            'query': query,
+            'sort': [{'id': 'asc'}],
+            '_source': ['modified'] if mapping.has_modified() else False,
+        },
+        index=get_index_name(index or main_index, mapping),
+        doc_type=mapping.get_mapping_type_name(),
+        size=chunksize,
+        preserve_order=True,
+    )
+    for hit in hits:
+        modified = hit.get('_source', {}).get('modified')
+        yield int(hit['_id']), parse(modified) if modified else None
+
+
+def compare_entries(database_entries, index_entries):
+    """
+    Merge two iterators over (pk, modified) tuples that are ordered by pk, in constant memory.
+
+    Returns an iterator over (kind, pk) tuples for every pk that differs:
+        missing: the instance is not in the index
+        stale: the document has an other modified time than the instance
+        orphaned: the document is in the index, but the instance is not in the database (anymore)
+    """
+    database_entries = iter(database_entries)
+    index_entries = iter(index_entries)
+    database_entry = next(database_entries, None)
+    index_entry = next(index_entries, None)
+
+    while database_entry or index_entry:
+        if index_entry is None or (database_entry and database_entry[0] < index_entry[0]):
+            yield MISSING, database_entry[0]
+            database_entry = next(database_entries, None)
+        elif database_entry is None or index_entry[0] < database_entry[0]:
+            yield ORPHANED, index_entry[0]
+            index_entry = next(index_entries, None)
+        else:
+            if database_entry[1] != index_entry[1]:
+                yield STALE, database_entry[0]
+            database_entry = next(database_entries, None)
+            index_entry = next(index_entries, None)
+
+
+def find_drift(mapping, tenant_id=None, repair=False, chunksize=1000):
+    """
+    Compare the instances of a mapping in the database with the documents in the index.
+
+    Stale documents are found by their modified time, so changes of related instances that
+    did not update the modified time of the instance itself are not detected.
+
+    Args:
+        tenant_id (int): only compare the instances and documents of this tenant
+        repair (boolean): update the missing and stale documents and remove the orphaned ones, in bulk
+        chunksize (int): the number of pks to read and repair at a time
+
+    Returns:
+        counts (dict): the number of missing, stale and orphaned documents
+    """
+    doc_type = mapping.get_mapping_type_name()
+    counts = dict.fromkeys(DRIFT_KINDS, 0)
+    pks = []
+
+    def repair_pks(pks):
+        # The fingerprints say the documents are up to date, forget them so they are written.
+        save_fingerprints({get_key(doc_type, pk): None for pk in pks})
+        update_ids_in_index(mapping, pks, refresh=REFRESH_NONE)
+
+    drift = compare_entries(
+        iter_database_entries(mapping, tenant_id=tenant_id, chunksize=chunksize),
+        iter_index_entries(mapping, tenant_id=tenant_id, chunksize=chunksize),
+    )
+    for kind, pk in drift:
+        counts[kind] += 1
+        if repair:
+            pks.append(pk)
+            if len(pks) >= chunksize:
+                repair_pks(pks)
+                pks = []
+    if pks:
+        repair_pks(pks)
+
+    if any(counts.values()):
+        logger.warning('Index drift of %s (tenant %s): %s missing, %s stale, %s orphaned%s' % (
+            doc_type, tenant_id, counts[MISSING], counts[STALE], counts[ORPHANED], ', repaired' if repair else ''))
+
+    return counts
@@ -0,0 +1,68 @@
+import time
+
+from django.conf import settings
+
+from lily.search.connections_utils import get_es_client, get_index_name
+
+
+es = get_es_client(maxsize=1)
+
+# Seconds a process keeps using the dual write index it looked up, before looking it up again.
+CHECK_INTERVAL = 10
+
+# The looked up dual write index per mapping, with the time it was looked up.
+dual_write_indexes = {}
+
+
+def get_dual_write_alias(mapping):
+    """
+    Returns the name of the alias of the index that is being built for the mapping while the current index is
+    in use. The alias is kept by Elasticsearch, so it can't be evicted, and it's removed together with the index.
+    """
+    return '%s.dual_write' % get_index_name(settings.ES_INDEXES['default'], mapping)
+
+
+def load_dual_write_index(mapping, es_client=None):
+    """
+    Returns the name of the index the dual write alias of the mapping points to, None when there is none.
+    """
+    alias = get_dual_write_alias(mapping)
+    aliases = (es_client or es).indices.get_aliases(name=alias, ignore=404)
+    for index_name, value in aliases.iteritems():
+        if isinstance(value, dict) and alias in value.get('aliases', {}):
+            return index_name
+    return None
+
+
+def get_dual_write_index(mapping):
+    """
+    Returns the name of the index that is being built for the mapping while the current index is in use,
+    None when there is no such index. Every write to the current index should be done to this index as well.
+
+    The index is looked up at most once per CHECK_INTERVAL seconds per process, see `start_dual_write`.
+    """
+    if settings.ES_DISABLED:
+        return None
+
+    doc_type = mapping.get_mapping_type_name()
+    index_name, loaded = dual_write_indexes.get(doc_type, (None, 0))
+    if time.time() - loaded > CHECK_INTERVAL:
+        index_name = load_dual_write_index(mapping)
+        dual_write_indexes[doc_type] = (index_name, time.time())
+    return index_name
+
+
+def start_dual_write(mapping, index_base, es_client=None):
+    """
+    Start writing every update of the mapping to the index with the given base name as well, by pointing
+    the dual write alias to it. Other processes pick it up within CHECK_INTERVAL seconds, so wait that long
+    before reading the instances to index.
+    """
+    index_name = get_index_name(index_base, mapping)
+    (es_client or es).indices.put_alias(index=index_name, name=get_dual_write_alias(mapping))
+    dual_write_indexes[mapping.get_mapping_type_name()] = (index_name, time.time())
+
+
+def stop_dual_write(mapping, es_client=None):
+    (es_client or es).indices.delete_alias(index='_all', name=get_dual_write_alias(mapping), ignore=404)
+    dual_write_indexes.pop(mapping.get_mapping_type_name(), None)
@@ -0,0 +1,106 @@
+from collections import defaultdict
+import uuid
+
+from django.db import connections, transaction
+from django.utils.encoding import force_text
+
+
+# Choices per (model, field name), to translate values like get_FOO_display() does.
+_choices = {}
+
+
+def iter_row_chunks(queryset, fields, chunksize=1000):
+    """
+    Returns an iterator over chunks of rows of the queryset, every row being a dict with the given fields.
+
+    On PostgreSQL the rows are streamed from a named (server side) cursor, so only one chunk is held
+    in memory at a time and no model instances are created. Other databases use the values() iterator.
+
+    Args:
+        queryset (QuerySet): the instances to read, ordered the way the chunks should be returned
+        fields (list): the field names (or lookups) to read
+        chunksize (int): the number of rows per chunk
+    """
+    values = queryset.values(*fields)
+    connection = connections[values.db]
+
+    if connection.vendor != 'postgresql':
+        chunk = []
+        for row in values.iterator():
+            chunk.append(row)
+            if len(chunk) >= chunksize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+        return
+
+    sql, params = values.query.get_compiler(using=values.db).as_sql()
+    # A named cursor only lives as long as the transaction it was declared in.
+    with transaction.atomic(using=values.db):
+        cursor = connection.connection.cursor(name='search_rows_%s' % uuid.uuid4().hex)
+        cursor.itersize = chunksize
+        try:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                if not rows:
+                    break
+                yield [dict(zip(fields, row)) for row in rows]
+        finally:
+            cursor.close()
+
+
+def fetch_many_to_many(model, field_name, pks, fields):
+    """
+    Fetch the related rows of a many to many field for multiple instances with one query.
+
+    Args:
+        model (Model): the model with the many to many field
+        field_name (str): the name of the many to many field
+        pks (list): the pks of the instances to fetch the related rows for
+        fields (list): the fields of the related model to read
+
+    Returns:
+        dict: a list of dicts with the given fields per pk
+    """
+    field = model._meta.get_field(field_name)
+    source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+    lookups = ['%s__%s' % (target, related_field) for related_field in fields]
+
+    related = defaultdict(list)
+    queryset = field.rel.through._default_manager.filter(**{'%s__in' % source: pks}).order_by('pk')
+    for row in queryset.values(source, *lookups):
+        related[row[source]].append({
+            related_field: row[lookup] for related_field, lookup in zip(fields, lookups)
+        })
+    return related
+
+
+def fetch_reverse(queryset, field_name, pks, fields):
+    """
+    Fetch the rows that point to multiple instances (e.g. with a foreign key) with one query.
+
+    Args:
+        queryset (QuerySet): the related instances to read
+        field_name (str): the field that contains the pk of the instance
+        pks (list): the pks of the instances to fetch the related rows for
+        fields (list): the fields (or lookups) of the related model to read
+
+    Returns:
+        dict: a list of dicts with the given fields per pk
+    """
+    related = defaultdict(list)
+    for row in queryset.filter(**{'%s__in' % field_name: pks}).order_by('pk').values(field_name, *fields):
+        related[row.pop(field_name) if field_name not in fields else row[field_name]].append(row)
+    return related
+
+
+def get_choice_display(model, field_name, value):
+    """
+    Returns the display value of a choice, like get_FOO_display() on an instance does.
+    """
+    key = (model, field_name)
+    if key not in _choices:
+        _choices[key] = dict(model._meta.get_field(field_name).flatchoices)
+    return force_text(_choices[key].get(value, value), strings_only=True)
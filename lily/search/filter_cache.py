@@ -0,0 +1,251 @@
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.query_utils import Q
+from elasticsearch.exceptions import TransportError
+
+from lily.search.connections_utils import get_es_client, get_index_name
+
+
+logger = logging.getLogger('search')
+
+key_prefix = 'search:filters'
+
+# The email address fields of email messages with an exact subfield, see `has_exact_email_fields`.
+EXACT_EMAIL_FIELDS = ('sender_email', 'received_by_email', 'received_by_cc_email')
+
+# Check the mapping of the live index this often, in seconds, until the exact subfields are there.
+EXACT_EMAIL_FIELDS_CHECK_INTERVAL = 10 * 60
+
+
+def get_account_emails_key(account_id):
+    return '%s:account_emails:%s' % (key_prefix, account_id)
+
+
+def get_account_email_addresses(account_id):
+    """
+    Returns the email addresses of an account and of its contacts, to search the email related to the account.
+    They're cached until an email address, contact or function of the account changes, see `invalidate`.
+
+    Returns:
+        email_addresses (list): lowercase email addresses, sorted
+    """
+    key = get_account_emails_key(account_id)
+    email_addresses = cache.get(key)
+    if email_addresses is None:
+        email_addresses = load_account_email_addresses(account_id)
+        cache.set(key, email_addresses, settings.ES_FILTER_CACHE_TIMEOUT)
+    return email_addresses
+
+
+def load_account_email_addresses(account_id):
+    """
+    Read the email addresses of the account and of its contacts that are not deleted (see Account.get_contacts),
+    with one query each. The relation tables are queried, so the tenant of the current user doesn't matter.
+    """
+    # Prevent importing models before the apps are loaded, this module is imported by the signals.
+    from lily.accounts.models import Account
+    from lily.contacts.models import Contact
+
+    email_addresses = set(Account.email_addresses.through.objects.filter(
+        account=account_id,
+    ).values_list('emailaddress__email_address', flat=True))
+    email_addresses.update(Contact.email_addresses.through.objects.filter(
+        contact__functions__account=account_id,
+        contact__functions__is_deleted=False,
+        contact__is_deleted=False,
+    ).values_list('emailaddress__email_address', flat=True))
+
+    return sorted(set(email_address.lower() for email_address in email_addresses if email_address))
+
+
+def get_exact_email_fields_key():
+    return '%s:exact_email_fields' % key_prefix
+
+
+def has_exact_email_fields():
+    """
+    Returns whether the email messages in the live index have the exact subfields of their email addresses.
+    They only exist after the email messages were reindexed (index -t emailmessage), which switches the alias
+    to the new index when it's done. Once they exist this is cached for ES_FILTER_CACHE_TIMEOUT.
+    """
+    if settings.ES_DISABLED:
+        return False
+
+    key = get_exact_email_fields_key()
+    exists = cache.get(key)
+    if exists is None:
+        exists = load_has_exact_email_fields()
+        cache.set(key, exists, settings.ES_FILTER_CACHE_TIMEOUT if exists else EXACT_EMAIL_FIELDS_CHECK_INTERVAL)
+    return exists
+
+
+def load_has_exact_email_fields(es_client=None):
+    """
+    Look up the exact subfields in the mapping of the index the email messages alias points to.
+    """
+    from lily.messaging.email.search import EmailMessageMapping
+
+    doc_type = EmailMessageMapping.get_mapping_type_name()
+    es_client = es_client or get_es_client()
+    try:
+        response = es_client.indices.get_mapping(
+            index=get_index_name(settings.ES_INDEXES['default'], EmailMessageMapping),
+            doc_type=doc_type,
+        )
+    except TransportError:
+        logger.exception('Unable to get the mapping of %s' % doc_type)
+        return False
+
+    # The mapping is returned per index the alias points to.
+    for index_mapping in response.values():
+        properties = index_mapping['mappings'].get(doc_type, {}).get('properties', {})
+        return all('exact' in properties.get(field, {}).get('fields', {}) for field in EXACT_EMAIL_FIELDS)
+    return False
+
+
+def get_visible_email_accounts_key(tenant_id, user_id):
+    return '%s:visible_email_accounts:%s:%s:%s' % (
+        key_prefix, tenant_id, cache.get(get_email_accounts_generation_key(tenant_id), 0), user_id)
+
+
+def get_email_accounts_generation_key(tenant_id):
+    return '%s:email_accounts_generation:%s' % (key_prefix, tenant_id)
+
+
+def get_email_account_access_key(email_account_id):
+    return '%s:email_account_access:%s' % (key_prefix, email_account_id)
+
+
+def get_visible_email_account_ids(user):
+    """
+    Returns the ids of the email accounts of which the user can see the email: the accounts the user owns,
+    the public accounts and the accounts shared with the user, without the ones the user has hidden.
+    They're cached until the email accounts of the tenant or the settings of the user change, see `invalidate`.
+
+    Returns:
+        email_account_ids (list): sorted ids
+    """
+    key = get_visible_email_accounts_key(user.tenant_id, user.pk)
+    email_account_ids = cache.get(key)
+    if email_account_ids is None:
+        email_account_ids = load_visible_email_account_ids(user)
+        cache.set(key, email_account_ids, settings.ES_FILTER_CACHE_TIMEOUT)
+    return email_account_ids
+
+
+def load_visible_email_account_ids(user):
+    from lily.messaging.email.models.models import EmailAccount, SharedEmailConfig
+
+    # Hide when we do not want to follow an email_account.
+    hidden_ids = SharedEmailConfig.objects.filter(
+        user=user,
+        is_hidden=True
+    ).values_list('email_account_id', flat=True)
+
+    return sorted(EmailAccount.objects.filter(
+        Q(owner=user) |
+        Q(public=True) |
+        Q(shared_with_users__id=user.pk)
+    ).filter(
+        tenant=user.tenant_id,
+        is_deleted=False,
+    ).exclude(
+        id__in=hidden_ids,
+    ).values_list('id', flat=True).distinct())
+
+
+def invalidate(sender, instance, action=None, pk_set=None, deleted=False):
+    """
+    Forget the cached filters that depend on a saved or deleted instance, or a changed many to many relation.
+
+    Args:
+        sender: the sender of the post_save, post_delete or m2m_changed signal
+        instance: the instance of the signal
+        action (str): the action of the m2m_changed signal
+        pk_set (set): the pks of the m2m_changed signal
+        deleted (boolean): True for the post_delete signal
+    """
+    # Prevent importing models before the apps are loaded, this module is imported by the signals.
+    from lily.accounts.models import Account
+    from lily.contacts.models import Contact, Function
+    from lily.messaging.email.models.models import EmailAccount, SharedEmailConfig
+    from lily.users.models import LilyUser
+    from lily.utils.models.models import EmailAddress
+
+    model = type(instance)
+    if action and action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if model in (Account, Contact, Function, EmailAddress):
+        invalidate_account_email_addresses(sender, instance, action, pk_set)
+    elif model is EmailAccount:
+        if action:
+            if sender is EmailAccount.shared_with_users.through:
+                bump_email_accounts_generation(instance.tenant_id)
+        else:
+            # Email accounts are saved by every synchronization, only the fields that decide who can see
+            # the email of an account invalidate the email accounts of every user of the tenant.
+            key = get_email_account_access_key(instance.pk)
+            access = (instance.owner_id, instance.public, instance.is_deleted)
+            if deleted:
+                cache.delete(key)
+                bump_email_accounts_generation(instance.tenant_id)
+            elif cache.get(key) != access:
+                cache.set(key, access, settings.ES_FILTER_CACHE_TIMEOUT)
+                bump_email_accounts_generation(instance.tenant_id)
+    elif model is LilyUser:
+        if action and sender is EmailAccount.shared_with_users.through:
+            bump_email_accounts_generation(instance.tenant_id)
+    elif model is SharedEmailConfig:
+        cache.delete(get_visible_email_accounts_key(instance.tenant_id, instance.user_id))
+
+
+def bump_email_accounts_generation(tenant_id):
+    key = get_email_accounts_generation_key(tenant_id)
+    cache.add(key, 0, None)
+    cache.incr(key)
+
+
+def invalidate_account_email_addresses(sender, instance, action=None, pk_set=None):
+    """
+    Forget the email addresses of the accounts that are related to the instance, see `invalidate`.
+    """
+    from lily.accounts.models import Account
+    from lily.contacts.models import Contact, Function
+
+    model = type(instance)
+    account_ids = set()
+    contact_ids = set()
+    email_address_ids = set()
+
+    if model is Account:
+        account_ids.add(instance.pk)
+    elif model is Contact:
+        contact_ids.add(instance.pk)
+    elif model is Function:
+        account_ids.add(instance.account_id)
+    elif action:
+        # The relation was changed from the side of the email address, pk_set contains the accounts or contacts.
+        if action == 'pre_clear':
+            email_address_ids.add(instance.pk)
+        elif sender is Account.email_addresses.through:
+            account_ids.update(pk_set)
+        elif sender is Contact.email_addresses.through:
+            contact_ids.update(pk_set)
+    else:
+        email_address_ids.add(instance.pk)
+
+    if email_address_ids:
+        account_ids.update(Account.email_addresses.through.objects.filter(
+            emailaddress__in=email_address_ids,
+        ).values_list('account_id', flat=True))
+        contact_ids.update(Contact.email_addresses.through.objects.filter(
+            emailaddress__in=email_address_ids,
+        ).values_list('contact_id', flat=True))
+
+    if contact_ids:
+        account_ids.update(Function.objects.filter(contact__in=contact_ids).values_list('account_id', flat=True))
+
+    cache.delete_many([get_account_emails_key(account_id) for account_id in account_ids])
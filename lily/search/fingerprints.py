@@ -0,0 +1,108 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+key_prefix = 'search:fingerprint'
+SKIPPED_KEY = '%s:skipped' % key_prefix
+WRITTEN_KEY = '%s:written' % key_prefix
+
+
+def get_fingerprint(document):
+    """
+    Returns a hash of the document, equal for documents with the same content.
+
+    Lists are compared regardless of their order, the values of a list in the
+    index are deduplicated and not ordered anyway (see prepare_dict).
+    """
+    def normalize(value):
+        if isinstance(value, dict):
+            return {key: normalize(item) for key, item in value.iteritems()}
+        if isinstance(value, list):
+            return sorted((normalize(item) for item in value), key=serialize)
+        return value
+
+    def serialize(value):
+        return json.dumps(value, sort_keys=True, cls=DjangoJSONEncoder)
+
+    return hashlib.sha1(serialize(normalize(document))).hexdigest()
+
+
+def get_key(doc_type, doc_id):
+    return '%s:%s:%s' % (key_prefix, doc_type, doc_id)
+
+
+def skip_unchanged(actions):
+    """
+    Leave out the index actions of documents that have the same content as the last time they were written.
+
+    Returns:
+        actions (list): the actions that need to be sent
+        fingerprints (dict): the fingerprints to save when the actions succeed, None for deleted documents
+    """
+    if not settings.ES_FINGERPRINTS or not actions:
+        return actions, {}
+
+    stored = cache.get_many([get_key(action['_type'], action['_id']) for action in actions])
+
+    changed = []
+    fingerprints = {}
+    for action in actions:
+        key = get_key(action['_type'], action['_id'])
+        if action.get('_op_type', 'index') == 'delete':
+            fingerprints[key] = None
+        else:
+            fingerprint = get_fingerprint(action['_source'])
+            if stored.get(key) == fingerprint:
+                continue
+            fingerprints[key] = fingerprint
+        changed.append(action)
+
+    count(skipped=len(actions) - len(changed), written=len(changed))
+
+    return changed, fingerprints
+
+
+def save_fingerprints(fingerprints, failed_keys=()):
+    """
+    Save the fingerprints of the documents that were written, and forget the ones of removed documents.
+    """
+    if not fingerprints:
+        return
+
+    failed_keys = set(failed_keys)
+    cache.set_many({
+        key: fingerprint for key, fingerprint in fingerprints.iteritems()
+        if fingerprint is not None and key not in failed_keys
+    }, settings.ES_FINGERPRINT_TIMEOUT)
+    cache.delete_many([
+        key for key, fingerprint in fingerprints.iteritems() if fingerprint is None or key in failed_keys
+    ])
+
+
+def count(skipped=0, written=0):
+    """
+    Keep track of the number of skipped and written documents, over all processes.
+    """
+    for key, value in ((SKIPPED_KEY, skipped), (WRITTEN_KEY, written)):
+        if value:
+            cache.add(key, 0, None)
+            cache.incr(key, value)
+
+
+def get_counts():
+    """
+    Returns the number of skipped and written documents since the counters were reset.
+    """
+    counts = cache.get_many([SKIPPED_KEY, WRITTEN_KEY])
+    return {
+        'skipped': counts.get(SKIPPED_KEY, 0),
+        'written': counts.get(WRITTEN_KEY, 0),
+    }
+
+
+def reset_counts():
+    cache.delete_many([SKIPPED_KEY, WRITTEN_KEY])
@@ -0,0 +1,68 @@
+from collections import OrderedDict
+from threading import local
+
+
+_thread_locals = local()
+
+
+class IndexQueue(object):
+    """
+    Collects the instances that need to be updated in Elasticsearch during a unit of work (a request or a task).
+
+    Entries are keyed by (mapping, pk), so saving the same instance multiple times (for example an account and
+    its email addresses, phone numbers and tags) results in one document being sent to Elasticsearch.
+    """
+    def __init__(self, refresh=None):
+        self.entries = OrderedDict()
+        # The default refresh policy for the updates in this queue.
+        self.refresh = refresh
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, mapping, instance, remove=False, refresh=None):
+        """
+        Mark an instance as dirty, the last call for the same (mapping, pk) wins.
+
+        Args:
+            mapping (BaseMapping): the mapping of the instance
+            instance (Model): the instance to update in the index
+            remove (boolean): True if the instance needs to be removed from the index
+            refresh (str): the refresh policy for this update, None for the policy of the mapping
+        """
+        self.entries[(mapping, instance.pk)] = (instance, remove, refresh)
+
+    def get_entries_per_mapping(self):
+        """
+        Returns an OrderedDict with mappings as keys and a list of (instance, remove, refresh) tuples as values.
+        """
+        per_mapping = OrderedDict()
+        for (mapping, pk), entry in self.entries.iteritems():
+            per_mapping.setdefault(mapping, []).append(entry)
+        return per_mapping
+
+
+def get_index_queue():
+    """
+    Returns the index queue of the current thread, None when indexing is not deferred.
+    """
+    return getattr(_thread_locals, 'index_queue', None)
+
+
+def start_index_queue(refresh=None):
+    """
+    Start deferring index updates for the current thread. Returns the (possibly already active) queue.
+    """
+    queue = get_index_queue()
+    if queue is None:
+        queue = _thread_locals.index_queue = IndexQueue(refresh=refresh)
+    return queue
+
+
+def stop_index_queue():
+    """
+    Stop deferring index updates for the current thread and return the queue that was active.
+    """
+    queue = get_index_queue()
+    _thread_locals.index_queue = None
+    return queue
@@ -1,12 +1,23 @@
-from datetime import date
+from contextlib import contextmanager
+from datetime import date, datetime
 import logging
+import time
 import traceback
 
 from django.conf import settings
-from elasticsearch.exceptions import NotFoundError
-from elasticutils.contrib.django import tasks
+from django.db.models.query import prefetch_related_objects
+from elasticsearch.exceptions import NotFoundError, TransportError
+from elasticsearch.helpers import bulk
 
+from lily.search.bulk import BulkIndexer
 from lily.search.connections_utils import get_es_client, get_index_name
+from lily.search.dual_write import get_dual_write_index
+from lily.search.extraction import iter_row_chunks
+from lily.search.fingerprints import get_key, save_fingerprints, skip_unchanged
+from lily.search.index_queue import get_index_queue, start_index_queue, stop_index_queue
+from lily.search.metrics import FETCH, PREFETCH, flush_metrics, record, record_bulk
+from lily.search.result_cache import ALL_TENANTS, bump_generations, bump_scopes
+from lily.search.serialization import expand_encoded_action
 from lily.utils import logutil
 
 
@@ -14,86 +25,557 @@ logger = logging.getLogger('search')
 main_index = settings.ES_INDEXES['default']
 es = get_es_client(maxsize=1)
 
+# The refresh policies, ordered from cheapest to most expensive.
+REFRESH_NONE = 'none'
+REFRESH_PERIODIC = 'periodic'
+REFRESH_WAIT_FOR = 'wait_for'
+REFRESH_IMMEDIATE = 'immediate'
+REFRESH_POLICIES = (REFRESH_NONE, REFRESH_PERIODIC, REFRESH_WAIT_FOR, REFRESH_IMMEDIATE)
 
-def update_in_index(instance, mapping):
+# Types of values that are never empty, see prepare_dict.
+PREPARED_TYPES = frozenset([int, long, float, bool, datetime])
+
+# Time of the last refresh per index, used by the periodic refresh policy.
+last_refresh = {}
+
+
+def get_refresh_policy(mapping, refresh=None):
+    """
+    Returns the refresh policy to use for a write, in order of precedence: the
+    policy of the call site, the policy of the mapping or the default from the settings.
+    """
+    policy = refresh or mapping.refresh_policy or settings.ES_REFRESH_POLICY
+    if policy not in REFRESH_POLICIES:
+        raise ValueError('Unknown refresh policy %s, choose one of %s' % (policy, REFRESH_POLICIES))
+    return policy
+
+
+def get_write_kwargs(policy):
+    """
+    Returns the kwargs for a write request with the given refresh policy.
+
+    The `wait_for` policy uses the refresh parameter of the write request itself, so
+    the request returns when the written shards are searchable, instead of
+    refreshing every shard of the index with a separate request.
+    """
+    if policy == REFRESH_WAIT_FOR:
+        return {'refresh': True}
+    return {}
+
+
+def refresh_after_write(index_name, policy):
+    """
+    Refresh the index after a write, according to the refresh policy.
+
+    The `periodic` policy only refreshes when the index is written to, so the last writes of an
+    interval become searchable with the next write after it, or by the refresh interval of the index.
+    """
+    if policy == REFRESH_IMMEDIATE:
+        es.indices.refresh(index_name)
+    elif policy == REFRESH_PERIODIC:
+        now = time.time()
+        if now - last_refresh.get(index_name, 0) >= settings.ES_REFRESH_INTERVAL:
+            last_refresh[index_name] = now
+            es.indices.refresh(index_name)
+
+
+def update_in_index(instance, mapping, defer=True, refresh=None):
     """
     Utility function for signal listeners index to Elasticsearch.
-    Currently uses synchronous tasks. And because of that all exceptions are
+    When an index queue is active for the current thread (see `deferred_indexing`)
+    the instance is only marked as dirty and indexed when the queue is flushed.
+    Otherwise it uses synchronous tasks. And because of that all exceptions are
     caught, so failures will not interfere with the regular model updates.
+
+    Args:
+        instance (Model): the instance to index
+        mapping (BaseMapping): the mapping of the instance
+        defer (boolean): False to index right away, even when an index queue is active
+        refresh (str): refresh policy for this write, see REFRESH_POLICIES
     """
     if settings.ES_DISABLED:
         return
-    if hasattr(instance, 'is_deleted') and instance.is_deleted:
-        remove_from_index(instance, mapping)
+    queue = get_index_queue()
+    if defer and queue is not None:
+        # The policy is resolved when the queue is flushed, so an invalid policy can't interrupt the save.
+        queue.add(mapping, instance, remove=getattr(instance, 'is_deleted', False), refresh=refresh or queue.refresh)
+    elif hasattr(instance, 'is_deleted') and instance.is_deleted:
+        remove_from_index(instance, mapping, defer=False, refresh=refresh)
     else:
         logger.info(u'Updating instance %s: %s' % (instance.__class__.__name__, instance.pk))
 
         try:
             main_index_with_type = get_index_name(main_index, mapping)
+            policy = get_refresh_policy(mapping, refresh)
             try:
                 document = mapping.extract_document(instance.id, instance)
             except Exception as exc:
                 logger.exception('Unable to extract document {0}: {1}'.format(
                     instance, repr(exc)))
             else:
+                actions, fingerprints = skip_unchanged([{
+                    '_index': main_index_with_type,
+                    '_type': mapping.get_mapping_type_name(),
+                    '_id': instance.id,
+                    '_source': document,
+                }])
+                if not actions:
+                    logger.info(u'Skipping unchanged instance %s: %s' % (instance.__class__.__name__, instance.pk))
+                    return
+
                 # Index object direct instead of bulk_index, to prevent multiple reads from db
-                mapping.index(document, id_=instance.id, es=es, index=main_index_with_type)
-                es.indices.refresh(main_index_with_type)
+                es.index(index=main_index_with_type, doc_type=mapping.get_mapping_type_name(), body=document,
+                         id=instance.id, **get_write_kwargs(policy))
+                dual_write_index = get_dual_write_index(mapping)
+                if dual_write_index:
+                    es.index(index=dual_write_index, doc_type=mapping.get_mapping_type_name(), body=document,
+                             id=instance.id)
+                save_fingerprints(fingerprints)
+                bump_generations(actions)
+                refresh_after_write(main_index_with_type, policy)
         except Exception, e:
             logger.error(traceback.format_exc(e))
 
 
-def remove_from_index(instance, mapping):
+def remove_from_index(instance, mapping, defer=True, refresh=None):
     """
     Utility function for signal listeners to remove from Elasticsearch.
-    Currently uses synchronous tasks. And because of that all exceptions are
-    caught, so failures will not interfere with the regular model updates.
+    When an index queue is active for the current thread the removal is deferred
+    until the queue is flushed, so the removals of a request or task are sent in
+    bulk, see `deferred_indexing`. Otherwise it uses synchronous tasks. And because
+    of that all exceptions are caught, so failures will not interfere with the
+    regular model updates.
     """
     if settings.ES_DISABLED:
         return
+    queue = get_index_queue()
+    if defer and queue is not None:
+        queue.add(mapping, instance, remove=True, refresh=refresh or queue.refresh)
+        return
     logger.info(u'Removing instance %s: %s' % (instance.__class__.__name__, instance.pk))
 
     try:
         main_index_with_type = get_index_name(main_index, mapping)
-        tasks.unindex_objects(mapping, [instance.id], es=es, index=main_index_with_type)
-        es.indices.refresh(main_index_with_type)
+        policy = get_refresh_policy(mapping, refresh)
+        # Forget the fingerprint first, so the document is written again when the instance comes back.
+        save_fingerprints({get_key(mapping.get_mapping_type_name(), instance.id): None})
+        dual_write_index = get_dual_write_index(mapping)
+        if dual_write_index:
+            es.delete(index=dual_write_index, doc_type=mapping.get_mapping_type_name(), id=instance.id, ignore=404)
+        # Forget the cached results before deleting, a document that was not in the index raises NotFoundError.
+        bump_scopes([(getattr(instance, 'tenant_id', None) or ALL_TENANTS, mapping.get_mapping_type_name())])
+        es.delete(index=main_index_with_type, doc_type=mapping.get_mapping_type_name(), id=instance.id,
+                  **get_write_kwargs(policy))
+        refresh_after_write(main_index_with_type, policy)
     except NotFoundError, e:
         logger.warn('Not found in index instance %s: %s' % (instance.__class__.__name__, instance.pk))
     except Exception, e:
         logger.error(traceback.format_exc(e))
 
 
-def index_objects(mapping, queryset, index, print_progress=False):
+@contextmanager
+def deferred_indexing(refresh=None):
+    """
+    Context manager that collects all index updates of the current thread and
+    flushes them once at the end of the block. Nested blocks are merged into
+    the outermost one.
+
+    When the block raises, the collected instances are reloaded from the
+    database before indexing, so only committed data ends up in the index.
+
+    Args:
+        refresh (str): refresh policy for the writes in this block that don't specify one
+    """
+    if get_index_queue() is not None:
+        yield
+        return
+
+    start_index_queue(refresh=refresh)
+    try:
+        yield
+    except Exception:
+        flush_index_queue(reload=True)
+        raise
+    else:
+        flush_index_queue()
+
+
+def flush_index_queue(reload=False):
+    """
+    Stop deferring index updates and send everything that was collected to
+    Elasticsearch in a single bulk request. When ES_INDEX_ASYNC is set, the
+    ids are handed to the indexing task instead, so the request does not wait
+    for Elasticsearch at all.
+
+    Args:
+        reload (boolean): True to fetch the instances from the database again
+            instead of indexing the (possibly unsaved) instances in the queue
+    """
+    queue = stop_index_queue()
+    if not queue or settings.ES_DISABLED:
+        return
+
+    try:
+        if settings.ES_INDEX_ASYNC:
+            # Prevent a circular import.
+            from lily.search.tasks import update_index_for_ids
+
+            for mapping, entries in queue.get_entries_per_mapping().iteritems():
+                update_index_for_ids.apply_async(
+                    args=(mapping.get_mapping_type_name(), [instance.pk for instance, remove, policy in entries]),
+                    kwargs={'refresh': get_strongest_policy(mapping, entries)},
+                )
+        elif reload:
+            for mapping, entries in queue.get_entries_per_mapping().iteritems():
+                update_ids_in_index(
+                    mapping,
+                    [instance.pk for instance, remove, policy in entries],
+                    refresh=get_strongest_policy(mapping, entries),
+                )
+        else:
+            actions = []
+            policies = {}
+            for mapping, entries in queue.get_entries_per_mapping().iteritems():
+                actions.extend(get_bulk_actions(mapping, [
+                    (instance.pk, None if remove else instance) for instance, remove, policy in entries
+                ]))
+                policies[get_index_name(main_index, mapping)] = get_strongest_policy(mapping, entries)
+            send_bulk_actions(actions, refresh=policies)
+    except Exception, e:
+        logger.error(traceback.format_exc(e))
+
+
+def get_strongest_policy(mapping, entries):
+    """
+    Returns the most expensive refresh policy of the queue entries of the mapping, so every write gets
+    at least what it asked for. Raises ValueError for an invalid policy, see `get_refresh_policy`.
+    """
+    policies = [get_refresh_policy(mapping, policy) for instance, remove, policy in entries]
+    return max(policies, key=REFRESH_POLICIES.index)
+
+
+def update_ids_in_index(mapping, ids, refresh=None):
+    """
+    Fetch the instances with the given ids from the database and update them in
+    the index with one bulk request. Ids that no longer exist (or are deleted)
+    are removed from the index.
+    """
+    model = mapping.get_model()
+    queryset = mapping.prepare_batch(model.objects.filter(pk__in=ids))
+    instances = {instance.pk: instance for instance in queryset}
+
+    send_bulk_actions(
+        get_bulk_actions(mapping, [(pk, instances.get(pk)) for pk in ids]),
+        refresh={get_index_name(main_index, mapping): get_refresh_policy(mapping, refresh)},
+    )
+
+
+def get_bulk_actions(mapping, entries, index=None):
+    """
+    Translate (pk, instance) tuples to bulk actions for the given mapping.
+    An instance of None, or a deleted instance, results in a delete action.
+
+    Actions for the main index are repeated for the index that is being built
+    for the mapping, if any, see `lily.search.dual_write`.
+    """
+    index_names = get_write_index_names(mapping, index)
+    doc_type = mapping.get_mapping_type_name()
+
+    actions = []
+    for pk, instance in entries:
+        if instance is None or getattr(instance, 'is_deleted', False):
+            actions.extend({'_op_type': 'delete', '_index': index_name, '_type': doc_type, '_id': pk}
+                           for index_name in index_names)
+            continue
+
+        try:
+            document = mapping.extract_document(pk, instance)
+        except Exception as exc:
+            logger.exception('Unable to extract document {0}: {1}'.format(instance, repr(exc)))
+        else:
+            actions.extend({'_index': index_name, '_type': doc_type, '_id': pk, '_source': document}
+                           for index_name in index_names)
+
+    return actions
+
+
+def send_bulk_actions(actions, refresh=None):
+    """
+    Send the actions to Elasticsearch with the bulk api and log the items that failed.
+    Deleting a document that was not in the index is not considered to be a failure.
+    Documents that did not change since they were last written are not sent at all.
+
+    Args:
+        actions (list): bulk actions, see `get_bulk_actions`
+        refresh (dict): refresh policy per index name, no refresh when not given
+    """
+    actions, fingerprints = skip_unchanged(actions)
+    if not actions:
+        return
+
+    refresh = refresh or {}
+    # The refresh parameter applies to every shard written by the bulk request.
+    policy = REFRESH_WAIT_FOR if REFRESH_WAIT_FOR in refresh.values() else REFRESH_NONE
+
+    start = time.time()
+    try:
+        success, errors = bulk(es, actions, raise_on_error=False, expand_action_callback=expand_encoded_action,
+                               **get_write_kwargs(policy))
+    except TransportError, e:
+        logger.error(traceback.format_exc(e))
+        return
+    record_bulk(actions, time.time() - start)
+
+    failed_keys = []
+    for error in errors:
+        op_type, item = error.items()[0]
+        if op_type == 'delete' and item.get('status') == 404:
+            continue
+        failed_keys.append(get_key(item.get('_type'), item.get('_id')))
+        logger.error('Unable to %s document %s in %s: %s' % (
+            op_type, item.get('_id'), item.get('_index'), item.get('error')))
+
+    save_fingerprints(fingerprints, failed_keys)
+    bump_generations(actions)
+
+    for index_name, index_policy in refresh.items():
+        refresh_after_write(index_name, index_policy)
+
+
+def get_index_queryset(mapping, tenant_id=None, account_id=None, include_deleted=False):
+    """
+    Returns the queryset with all instances of the mapping that belong in the index.
+
+    Args:
+        tenant_id (int): only the instances of this tenant
+        account_id (int): only the instances of this email account, see `has_email_account`
+        include_deleted (boolean): also the deleted instances, which don't belong in the index
+    """
+    model = mapping.get_model()
+    if mapping.has_deleted() and not include_deleted:
+        queryset = model.objects.filter(is_deleted=False)
+    else:
+        queryset = model.objects.all()
+
+    if tenant_id:
+        queryset = queryset.filter(**{mapping.values_tenant_field: tenant_id})
+    if account_id:
+        queryset = queryset.filter(account=account_id)
+    return queryset
+
+
+def index_objects(mapping, queryset, index, print_progress=False, es_client=None, progress_callback=None,
+                  start_pk=0, checkpoint_callback=None, use_rows=False, create_only=False):
     """
     Index synchronously model specified mapping type with an optimized query.
+
+    Args:
+        index (str): the base name of the index, None for the main index (and the index that is being built)
+        es_client (Elasticsearch): client to use instead of the shared one, e.g. in a worker process
+        progress_callback (function): called with the number of instances after every chunk
+        start_pk (int): only index instances with a higher pk, to resume an earlier run
+        checkpoint_callback (function): called with the last pk that was indexed after every bulk request
+        use_rows (boolean): build the documents from database rows, if the mapping supports it
+        create_only (boolean): don't overwrite documents that are already in the index, because they
+            were written by a live update while the index was being built
     """
-    documents = []
-    for instance in queryset_iterator(mapping, queryset, print_progress=print_progress):
-        documents.append(mapping.extract_document(instance.id, instance))
+    index_names = get_write_index_names(mapping, index)
+    doc_type = mapping.get_mapping_type_name()
+    indexer = BulkIndexer(
+        es_client=es_client,
+        raise_on_error=True,
+        done_callback=(lambda action: checkpoint_callback(action['_id'])) if checkpoint_callback else None,
+    )
 
-        if len(documents) >= 100:
-            mapping.bulk_index(documents, id_field='id', index=get_index_name(index, mapping), es=es)
-            documents = []
+    if use_rows and mapping.has_values_extraction():
+        documents = document_iterator(mapping, queryset, print_progress=print_progress,
+                                      progress_callback=progress_callback, start_pk=start_pk)
+    else:
+        documents = ((instance.id, mapping.extract_document(instance.id, instance)) for instance in queryset_iterator(
+            mapping, queryset, print_progress=print_progress, progress_callback=progress_callback, start_pk=start_pk))
 
-    mapping.bulk_index(documents, id_field='id', index=get_index_name(index, mapping), es=es)
-    documents = []
+    for pk, document in documents:
+        for index_name in index_names:
+            indexer.add({
+                '_op_type': 'create' if create_only else 'index',
+                '_index': index_name,
+                '_type': doc_type,
+                '_id': pk,
+                '_source': document,
+            })
 
+    indexer.close()
+    flush_metrics()
 
-def unindex_objects(mapping, queryset, index, print_progress=False):
+
+def reindex_scope(mapping, tenant_id=None, account_id=None, print_progress=False, use_rows=False):
     """
-    Remove synchronously model specified mapping type with an optimized query.
+    Replace the documents of a tenant or an email account in the current index, e.g. to repair the
+    search data of one customer without reindexing everything. The documents of the scope are removed
+    with a delete by query first, so documents of instances that no longer exist don't stay behind.
+
+    Args:
+        tenant_id (int): reindex the documents of this tenant
+        account_id (int): reindex the documents of this email account
+        print_progress (boolean): print a progress bar
+        use_rows (boolean): build the documents from database rows, if the mapping supports it
+
+    Returns:
+        count (int): the number of documents that were indexed
     """
-    queryset = queryset.only('pk')
+    if account_id and not mapping.has_email_account():
+        raise ValueError('The instances of %s do not belong to an email account.' % mapping.get_mapping_type_name())
+
+    queryset = get_index_queryset(mapping, tenant_id=tenant_id, account_id=account_id)
+    unindex_by_query(mapping, tenant_id=tenant_id, account_id=account_id)
+    count = queryset.count()
+    index_objects(mapping, queryset, None, print_progress=print_progress, use_rows=use_rows)
+    return count
 
+
+def index_modified_since(mapping, since, index=None, print_progress=False):
+    """
+    Update the documents of the instances that were modified since the given time.
+    Soft deleted instances are removed from the index, hard deleted instances can't be found this way,
+    their documents are removed by `index_drift --repair` (or the periodic drift check).
+
+    Returns:
+        count (int): the number of instances that were updated or removed
+    """
+    queryset = mapping.get_model().objects.filter(modified__gte=since)
+    count = 0
+    indexer = BulkIndexer()
     for instance in queryset_iterator(mapping, queryset, print_progress=print_progress):
-        try:
-            mapping.unindex(instance.pk, index=get_index_name(index, mapping), es=es)
-        except NotFoundError:
-            # Not present in the first place? Just ignore.
-            pass
+        for action in get_bulk_actions(mapping, [(instance.pk, instance)], index=index):
+            indexer.add(action)
+        count += 1
+
+    success, errors = indexer.close()
+    flush_metrics()
+    for error in errors:
+        logger.error('Unable to update document: %s' % error)
+    return count
+
+
+def unindex_objects(mapping, queryset, index=None, print_progress=False, chunksize=1000):
+    """
+    Remove the documents of the instances in the queryset from the index with bulk requests.
+    Only the pks are read from the database, so the instances may already be deleted there.
+
+    Args:
+        index (str): the base name of the index, the main index (and the index that is being built) by default
+        print_progress (boolean): print a progress bar
+
+    Returns:
+        count (int): the number of documents that were removed (or were not in the index)
+    """
+    doc_type = mapping.get_mapping_type_name()
+    index_names = get_write_index_names(mapping, index)
+    end = queryset.count() if print_progress else 0
+
+    indexer = BulkIndexer()
+    count = 0
+    pks = []
+    for pk in queryset.order_by('pk').values_list('pk', flat=True).iterator():
+        pks.append(pk)
+        if len(pks) >= chunksize:
+            count += unindex_pks(indexer, doc_type, index_names, pks)
+            pks = []
+            if print_progress:
+                logutil.print_progress(count, end)
+    if pks:
+        count += unindex_pks(indexer, doc_type, index_names, pks)
+        if print_progress:
+            logutil.print_progress(count, end)
+
+    success, errors = indexer.close()
+    for error in errors:
+        logger.error('Unable to remove document: %s' % error)
+    return count
+
+
+def unindex_pks(indexer, doc_type, index_names, pks):
+    """
+    Add the delete actions for the pks to the bulk indexer and forget their fingerprints.
+    """
+    save_fingerprints({get_key(doc_type, pk): None for pk in pks})
+    for pk in pks:
+        for index_name in index_names:
+            indexer.add({'_op_type': 'delete', '_index': index_name, '_type': doc_type, '_id': pk})
+    return len(pks)
+
+
+def unindex_by_query(mapping, index=None, tenant_id=None, account_id=None):
+    """
+    Remove all documents of a tenant or an email account with one delete by query request per index,
+    e.g. when purging a tenant or an email account with a lot of email messages.
+
+    Args:
+        index (str): the base name of the index, the main index (and the index that is being built) by default
+        tenant_id (int): remove the documents of this tenant
+        account_id (int): remove the documents with this (email) account
+
+    Returns:
+        count (int): the number of documents that matched in the (main) index
+    """
+    filters = []
+    if tenant_id:
+        filters.append({'term': {'tenant': tenant_id}})
+    if account_id:
+        filters.append({'term': {'account': account_id}})
+    if not filters:
+        raise ValueError('Refusing to remove all documents, give a tenant or account to remove.')
+
+    doc_type = mapping.get_mapping_type_name()
+    body = {'query': {'filtered': {'filter': {'and': filters}}}}
 
+    # The instances may still be in the database, e.g. the email messages of an email account that is added again.
+    # Forget their fingerprints first, so they are written again when they are saved.
+    forget_fingerprints(mapping, tenant_id=tenant_id, account_id=account_id)
 
-def queryset_iterator(mapping, queryset, chunksize=100, print_progress=False):
+    index_names = get_write_index_names(mapping, index)
+    count = es.count(index=index_names[0], doc_type=doc_type, body=body, ignore=404).get('count', 0)
+    for index_name in index_names:
+        es.delete_by_query(index=index_name, doc_type=doc_type, body=body, ignore=404)
+        logger.info('Removed documents of %s matching %s from %s' % (doc_type, filters, index_name))
+    bump_scopes([(tenant_id or ALL_TENANTS, doc_type)])
+
+    return count
+
+
+def forget_fingerprints(mapping, tenant_id=None, account_id=None, chunksize=1000):
+    """
+    Forget the fingerprints of the instances of a tenant or an email account, deleted or not, see `unindex_by_query`.
+    Only the pks are read from the database, in chunks.
+    """
+    doc_type = mapping.get_mapping_type_name()
+    queryset = get_index_queryset(mapping, tenant_id=tenant_id, account_id=account_id, include_deleted=True)
+
+    keys = []
+    for pk in queryset.order_by().values_list('pk', flat=True).iterator():
+        keys.append(get_key(doc_type, pk))
+        if len(keys) >= chunksize:
+            save_fingerprints(dict.fromkeys(keys))
+            keys = []
+    save_fingerprints(dict.fromkeys(keys))
+
+
+def get_write_index_names(mapping, index=None):
+    """
+    Returns the names of the indexes a write should go to, the main index and the index that is
+    being built for the mapping, or the given index.
+    """
+    if index:
+        return [get_index_name(index, mapping)]
+
+    index_names = [get_index_name(main_index, mapping)]
+    dual_write_index = get_dual_write_index(mapping)
+    if dual_write_index:
+        index_names.append(dual_write_index)
+    return index_names
+
+
+def queryset_iterator(mapping, queryset, chunksize=100, print_progress=False, progress_callback=None, start_pk=0):
     """
     Returns an iterator that chops the queryset into chunks.
 
@@ -104,13 +586,25 @@ def queryset_iterator(mapping, queryset, chunksize=100, print_progress=False):
     """
 
     queryset = mapping.prepare_batch(queryset)
+    doc_type = mapping.get_mapping_type_name()
+    # Prefetch separately, so the query and the prefetching are measured on their own.
+    prefetch_lookups = queryset._prefetch_related_lookups
+    queryset = queryset.prefetch_related(None)
 
-    pk = 0
+    pk = start_pk
     progress = 0
+    if start_pk:
+        queryset = queryset.filter(pk__gt=start_pk)
     end = queryset.count()
     queryset = queryset.order_by('pk')
     while True:
-        subset = queryset.filter(pk__gt=pk)[:chunksize]
+        start = time.time()
+        subset = list(queryset.filter(pk__gt=pk)[:chunksize])
+        record(doc_type, FETCH, time.time() - start, docs=len(subset))
+        if subset and prefetch_lookups:
+            start = time.time()
+            prefetch_related_objects(subset, prefetch_lookups)
+            record(doc_type, PREFETCH, time.time() - start, docs=len(subset))
         len_subset = len(subset)
         progress += len_subset
         if not len_subset:
@@ -118,26 +612,69 @@ def queryset_iterator(mapping, queryset, chunksize=100, print_progress=False):
             break
         if print_progress:
             logutil.print_progress(progress, end)
+        if progress_callback:
+            progress_callback(len_subset)
         for row in subset:
             pk = row.pk
             yield row
 
 
-def prepare_dict(arg_dict):
+def document_iterator(mapping, queryset, chunksize=1000, print_progress=False, progress_callback=None, start_pk=0):
     """
-    Cleans up a dict to be indexed. Returns a new dict.
+    Returns an iterator over (pk, document) tuples, built from database rows instead of model instances.
+
+    The rows are streamed in chunks and the mapping fetches the related rows once per chunk,
+    so no prefetching is done and no model instances are kept in memory.
     """
+    if start_pk:
+        queryset = queryset.filter(pk__gt=start_pk)
+    end = queryset.count() if print_progress else 0
+    queryset = queryset.order_by('pk')
+
+    doc_type = mapping.get_mapping_type_name()
+    chunks = iter_row_chunks(queryset, mapping.values_fields, chunksize=chunksize)
+    progress = 0
+    while True:
+        start = time.time()
+        rows = next(chunks, None)
+        if rows is None:
+            break
+        record(doc_type, FETCH, time.time() - start, docs=len(rows))
+        progress += len(rows)
+        if print_progress:
+            logutil.print_progress(progress, end)
+        if progress_callback:
+            progress_callback(len(rows))
+        for row, document in zip(rows, mapping.extract_documents(rows)):
+            yield row['id'], document
 
-    # Remove entries with empty values.
-    new_dict = {k: v for k, v in arg_dict.items() if v not in ([], '', {}, None)}
 
-    for k, v in new_dict.iteritems():
-        # Normalize dates.
-        if type(v) is date:
-            new_dict[k] = '%sT00:00:00.000000+00:00' % str(v)
+def prepare_dict(arg_dict):
+    """
+    Cleans up a dict to be indexed, in one pass over its items. Returns a new dict.
+
+    Empty values are left out, dates are normalized to the datetime format and lists are deduplicated.
+    """
+    new_dict = {}
+    for key, value in arg_dict.iteritems():
+        value_type = type(value)
+        if value is None:
+            continue
+        elif value_type is list:
+            if not value:
+                continue
+            # Dedup lists.
+            if len(value) > 1 and type(value[0]) is not dict:
+                value = list(set(value))
+        elif value_type is unicode or value_type is str or value_type is dict:
+            if not value:
+                continue
+        elif value_type is date:
+            # Normalize dates.
+            value = value.isoformat() + 'T00:00:00.000000+00:00'
+        elif value_type not in PREPARED_TYPES and value in ([], '', {}):
+            continue
 
-        # Dedup lists.
-        elif type(v) is list and len(v) > 1 and type(v[0]) is not dict:
-            new_dict[k] = list(set(v))
+        new_dict[key] = value
 
     return new_dict
@@ -1,27 +1,131 @@
+import base64
+import json
 import logging
 
 from django.conf import settings
-from django.db.models.query_utils import Q
 from elasticsearch.exceptions import RequestError
 from elasticutils import S
 
-from lily.accounts.models import Account
 from lily.contacts.models import Contact
-from lily.messaging.email.models.models import EmailAccount, SharedEmailConfig
 from lily.search.connections_utils import get_es_client_kwargs, get_index_name
+from lily.search.filter_cache import (EXACT_EMAIL_FIELDS, get_account_email_addresses, get_visible_email_account_ids,
+                                      has_exact_email_fields)
+from lily.search.result_cache import cache_results, get_cached_results
+from lily.search.scan_search import ModelMappings
 
 
 logger = logging.getLogger(__name__)
 
 main_index = settings.ES_INDEXES['default']
 
+# The sort value Elasticsearch returns for documents without a value in the sort field, sorted last.
+MISSING_SORT_VALUES = (None, 2 ** 63 - 1, -2 ** 63)
+
+
+def encode_cursor(sort, sort_values, total=None):
+    """
+    Returns an opaque cursor to the results after the result with the given sort values.
+
+    Args:
+        sort (str): the sort option of the search
+        sort_values (list): the sort values of the last result, the value of the sort field and the id
+        total (int): the total number of results of the first page, see `decode_cursor`
+    """
+    if len(sort_values) > 1 and sort_values[0] in MISSING_SORT_VALUES:
+        sort_values = [None] + sort_values[1:]
+    return base64.urlsafe_b64encode(json.dumps({'sort': sort, 'after': sort_values, 'total': total},
+                                               separators=(',', ':')))
+
+
+def decode_cursor(sort, cursor):
+    """
+    Returns the sort values and the total of a cursor, see `encode_cursor`.
+
+    The cursor filters out the results of the previous pages, so Elasticsearch counts fewer results on every
+    page. The total of the first page is kept in the cursor instead, and returned as the total of every page.
+
+    Returns:
+        after (list): the sort values of the last result of the previous page
+        total (int): the total number of results of the first page, None when it's unknown
+
+    Raises:
+        ValueError: when the cursor is invalid or belongs to a search with another sort
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        after = data['after']
+    except (TypeError, ValueError, KeyError):
+        raise ValueError('Invalid cursor %s' % cursor)
+    if data.get('sort') != sort or len(after) != (2 if sort else 1):
+        raise ValueError('The cursor %s does not belong to a search sorted on %s' % (cursor, sort))
+    return after, data.get('total')
+
+
+class LilyS(S):
+    """
+    S that can add aggregations and source filtering to the search, which elasticutils doesn't know.
+    """
+    # The steps that are added to the search body here instead of by elasticutils.
+    raw_actions = ('aggregate_raw', 'source')
+
+    def aggregate_raw(self, **aggregations):
+        """
+        Return a new S with the aggregations added, in the format of the Elasticsearch aggregations api.
+        Their results are in the response of the search results, under 'aggregations'.
+        """
+        return self._clone(next_step=('aggregate_raw', aggregations))
+
+    def source(self, include=None, exclude=None):
+        """
+        Return a new S that returns only part of the _source of the results.
+
+        Args:
+            include (list): the fields to return, all fields when not given
+            exclude (list): the fields to leave out
+        """
+        source = {}
+        if include:
+            source['include'] = include
+        if exclude:
+            source['exclude'] = exclude
+        return self._clone(next_step=('source', source))
+
+    def get_search_results(self, response):
+        """
+        Returns the search results of a response that was not fetched by this S, e.g. from a multi search.
+        The search has to be built before, see `build_search`.
+        """
+        return self.get_results_class()(self.type, response, self.to_python(response['hits']['hits']), self.fields)
+
+    def build_search(self):
+        # The steps are restored afterwards, building the search also sets attributes of the S, like the fields.
+        steps = self.steps
+        self.steps = [(action, value) for action, value in steps if action not in self.raw_actions]
+        try:
+            body = super(LilyS, self).build_search()
+        finally:
+            self.steps = steps
+
+        aggregations = {}
+        for action, value in steps:
+            if action == 'aggregate_raw':
+                aggregations.update(value)
+            elif action == 'source':
+                if value:
+                    body['_source'] = value
+                else:
+                    body.pop('_source', None)
+        if aggregations:
+            body['aggs'] = aggregations
+        return body
+
 
 class LilySearch(object):
     """
     Search API for Elastic search backend.
     """
 
-    def __init__(self, tenant_id, model_type=None, sort=None, page=0, size=10, facet=None):
+    def __init__(self, tenant_id, model_type=None, sort=None, page=0, size=10, facet=None, cursor=None):
         """
         Setup of search.
 
@@ -31,8 +135,14 @@ class LilySearch(object):
             sort (string): sort option for results
             page (int): page number of pagination
             size (int): max number of returned results
+            cursor (string): paginate with cursors instead of pages, the next_cursor of the
+                previous page, or an empty string for the first page. Without a sort the results
+                are ordered by id, so a query should be sorted to paginate it with cursors
+
+        Raises:
+            ValueError: when the cursor is invalid
         """
-        search_request = S().es(**get_es_client_kwargs()).indexes(settings.ES_INDEXES['default'])
+        search_request = LilyS().es(**get_es_client_kwargs()).indexes(settings.ES_INDEXES['default'])
         self.search = search_request.all()
 
         # Always filter on Tenant.
@@ -49,21 +159,64 @@ class LilySearch(object):
         # Filter on model type.
         self.model_type = model_type
 
-        # Add sorting.
-        if sort:
-            self.search = self.search.order_by(sort)
+        self.sort = sort
+        self.size = size
+        self.cursor = cursor
+        # The cursor to the next page, set by do_search when paginating with cursors.
+        self.next_cursor = None
+        # The total number of results of the first page, when paginating with cursors.
+        self.cursor_total = None
+
+        if cursor is not None:
+            # Every page starts after the last result of the previous page, instead of skipping all previous
+            # results, so a page deep in the results is as fast as the first one. Results with the same value
+            # in the sort field are ordered by id, so the last result of a page identifies where to continue.
+            self.search = self.search.order_by(*[field for field in (sort, 'id') if field])[:size]
+            if cursor:
+                after, self.cursor_total = decode_cursor(sort, cursor)
+                self.raw_filters.append(self.get_cursor_filter(after))
+        else:
+            # Add sorting.
+            if sort:
+                self.search = self.search.order_by(sort)
+
+            # Pagination.
+            from_hits = page * size
+            to_hits = (page + 1) * size
+            self.search = self.search[from_hits:to_hits]
+
+    def get_cursor_filter(self, after):
+        """
+        Returns the filter for the results that are sorted after the given sort values. Results without
+        a value in the sort field are sorted last, and are ordered by id among themselves.
 
-        # Pagination.
-        from_hits = page * size
-        to_hits = (page + 1) * size
-        self.search = self.search[from_hits:to_hits]
+        Args:
+            after (list): the sort values of the last result of the previous page, see `decode_cursor`
+        """
+        after_id = {'range': {'id': {'gt': after[-1]}}}
+        if not self.sort:
+            return after_id
+
+        field = self.sort.lstrip('-')
+        if after[0] is None:
+            return {'and': [{'missing': {'field': field}}, after_id]}
+
+        return {
+            'or': [
+                {'range': {field: {'lt' if self.sort.startswith('-') else 'gt': after[0]}}},
+                {'and': [{'term': {field: after[0]}}, after_id]},
+                {'missing': {'field': field}},
+            ]
+        }
 
     def do_search(self, return_fields=None):
         """
-        Execute the search.
+        Execute the search. With settings.ES_RESULT_CACHE the results are cached
+        until the searched types of the tenant are written to, see `result_cache`.
 
         Arguments:
-            return_fields (list): strings of fieldnames to return from result
+            return_fields (list): strings of fieldnames to return from result, when not given all
+                fields but the large fields of the mapping (see BaseMapping.large_fields) are returned
 
         Returns:
             hits (list): dicts with search results per item
@@ -71,7 +224,106 @@ class LilySearch(object):
             took (int): milliseconds Elastic search took to get the results
         """
         if settings.ES_DISABLED:
-            return [], 0, 0
+            return [], None, 0, 0
+        self.prepare(return_fields)
+
+        if settings.ES_RESULT_CACHE:
+            cached, cache_key = self.get_cached_results(return_fields)
+            if cached is not None:
+                results, self.next_cursor = cached
+                return results
+
+        # Fire off search.
+        try:
+            results = self.execute(return_fields)
+        except RequestError as e:
+            # This can happen when the query is malformed. For example:
+            # A user entering special characters. This should normally be taken
+            # care of where the request is built (usually in Javascript),
+            # by escaping or omitting special characters.
+            # This may be hard to get fool proof, therefore we also
+            # catch the exception here to prevent server errors.
+            logger.error('request error %s' % e)
+            return [], None, 0, 0
+
+        if settings.ES_RESULT_CACHE:
+            cache_results(cache_key, (results, self.next_cursor))
+
+        return results
+
+    @staticmethod
+    def multi_search(searches, return_fields=None):
+        """
+        Execute a number of searches with one request to Elasticsearch, the multi search api.
+
+        Arguments:
+            searches (list): LilySearch instances
+            return_fields (list): strings of fieldnames to return from the results, see `do_search`
+
+        Returns:
+            results (list): the results of every search, as `do_search` returns them
+        """
+        if settings.ES_DISABLED:
+            return [([], None, 0, 0) for search in searches]
+
+        results = [None] * len(searches)
+        cache_keys = [None] * len(searches)
+        body = []
+        sent = []
+        for position, search in enumerate(searches):
+            search.prepare(return_fields)
+
+            if settings.ES_RESULT_CACHE:
+                cached, cache_keys[position] = search.get_cached_results(return_fields)
+                if cached is not None:
+                    results[position], search.next_cursor = cached
+                    continue
+
+            body.append({'index': search.search.get_indexes(), 'type': search.search.get_doctypes()})
+            body.append(search.search.build_search())
+            sent.append(position)
+
+        if not sent:
+            return results
+
+        try:
+            responses = searches[sent[0]].search.get_es().msearch(body=body)['responses']
+        except RequestError as e:
+            # See do_search, a malformed search fails the whole request.
+            logger.error('request error %s' % e)
+            responses = [{'error': e} for position in sent]
+
+        for position, response in zip(sent, responses):
+            search = searches[position]
+            if 'error' in response:
+                logger.error('request error %s' % response['error'])
+                results[position] = [], None, 0, 0
+                continue
+
+            results[position] = search.get_results(search.search.get_search_results(response), return_fields)
+            if settings.ES_RESULT_CACHE:
+                cache_results(cache_keys[position], (results[position], search.next_cursor))
+
+        return results
+
+    @staticmethod
+    def search_tiers(searches, return_fields=None):
+        """
+        Execute a fallback chain of searches in one request, see `multi_search`.
+
+        Returns:
+            position (int): the position of the first search with hits, None when none has hits
+            hits (list): the hits of that search
+        """
+        for position, (hits, facets, total, took) in enumerate(LilySearch.multi_search(searches, return_fields)):
+            if hits:
+                return position, hits
+        return None, []
+
+    def prepare(self, return_fields=None):
+        """
+        Add the filters, types, facets and returned fields to the search, before sending it.
+        """
         self.search = self.search.filter_raw({'and': self.raw_filters})
 
         if self.model_type:
@@ -83,25 +335,33 @@ class LilySearch(object):
             self.search = self.search.indexes(index_name)
 
         if self.facet:
-            facet_raw = {
+            terms_aggregation = {
                 'terms': {
                     'field': self.facet['field'],
                     'size': self.facet['size'],
                 },
             }
 
-            facet_filter_dict = {
-                'and': [
-                    {
-                        'term': {
-                            'tenant': self.tenant_id,
+            if self.model_type == 'tags_tag':
+                # Let Elasticsearch find the latest usage of every tag.
+                terms_aggregation['aggs'] = {
+                    'last_used': {
+                        'max': {
+                            'field': 'last_used',
                         }
                     }
-                ]
-            }
+                }
+
+            facet_filters = [
+                {
+                    'term': {
+                        'tenant': self.tenant_id,
+                    }
+                }
+            ]
 
             if self.facet['filter']:
-                facet_filter_dict['and'].append(
+                facet_filters.append(
                     {
                         'query': {
                             'query_string': {
@@ -111,56 +371,116 @@ class LilySearch(object):
                     }
                 )
 
-            facet_raw['facet_filter'] = facet_filter_dict
+            # The filters of the search are applied after aggregating, so the facet is filtered on its own.
+            self.search = self.search.aggregate_raw(items={
+                'filter': {
+                    'and': facet_filters,
+                },
+                'aggs': {
+                    'terms': terms_aggregation,
+                },
+            })
 
-            self.search = self.search.facet_raw(items=facet_raw)
+        self.search = self.search.source(**self.get_source_filter(return_fields))
 
-        # Fire off search.
-        try:
-            hits = []
-            execute = self.search.execute()
-            for result in execute:
-                hit = {
-                    'id': result.id,
-                }
-                if not self.model_type:
-                    # We will add type if not specifically searched on it.
-                    hit['type'] = result.es_meta.type
-                for field in result:
-                    # Add specified fields, or all fields when not specified.
-                    if return_fields:
-                        if field in return_fields:
-                            hit[field] = result[field]
-                    else:
+    def execute(self, return_fields=None):
+        """
+        Send the search to Elasticsearch and collect the results, see `do_search`.
+        """
+        return self.get_results(self.search.execute(), return_fields)
+
+    def get_results(self, execute, return_fields=None):
+        """
+        Collect the results of the search from the search results of elasticutils.
+        """
+        hits = []
+        for result in execute:
+            hit = {
+                'id': result.id,
+            }
+            if not self.model_type:
+                # We will add type if not specifically searched on it.
+                hit['type'] = result.es_meta.type
+            for field in result:
+                # Add specified fields, or all fields when not specified.
+                if return_fields:
+                    if field in return_fields:
                         hit[field] = result[field]
-                hits.append(hit)
+                else:
+                    hit[field] = result[field]
+            hits.append(hit)
 
-            if execute.facets:
-                facets = execute.facets['items']['terms']
+        count = execute.count
+        if self.cursor_total is not None:
+            # The results of the previous pages aren't counted anymore, see `decode_cursor`.
+            count = self.cursor_total
 
-                if self.model_type == 'tags_tag':
-                    for hit in hits:
-                        # Get the object with the given name.
-                        facet = next((x for x in facets if x.get('term') == hit.get('name_flat')), None)
+        if self.cursor is not None and len(hits) == self.size:
+            self.next_cursor = encode_cursor(self.sort, execute.response['hits']['hits'][-1]['sort'], count)
 
-                        if facet and (not facet.get('last_used') or hit.get('last_used') > facet.get('last_used')):
-                            # Set the latest usage date.
-                            facet.update({
-                                'last_used': hit.get('last_used')
-                            })
+        aggregations = execute.response.get('aggregations')
+        if aggregations:
+            facets = [self.get_facet(bucket) for bucket in aggregations['items']['terms']['buckets']]
+            return hits, facets, count, execute.took
 
-                return hits, facets, execute.count, execute.took
+        return hits, None, count, execute.took
 
-            return hits, None, execute.count, execute.took
-        except RequestError as e:
-            # This can happen when the query is malformed. For example:
-            # A user entering special characters. This should normally be taken
-            # care of where the request is built (usually in Javascript),
-            # by escaping or omitting special characters.
-            # This may be hard to get fool proof, therefore we also
-            # catch the exception here to prevent server errors.
-            logger.error('request error %s' % e)
-            return [], None, 0, 0
+    def get_source_filter(self, return_fields=None):
+        """
+        Returns the fields of the documents Elasticsearch should return. These are the
+        return_fields, or all fields but the large fields of the searched mappings.
+
+        Returns:
+            source_filter (dict): the include and exclude arguments for `LilyS.source`
+        """
+        if return_fields:
+            # The id is always returned, see `execute`.
+            return {'include': sorted(set(return_fields) | set(['id']))}
+
+        large_fields = set()
+        for mapping in ModelMappings.mappings:
+            if not self.model_type or mapping.get_mapping_type_name() == self.model_type:
+                large_fields.update(mapping.large_fields)
+        return {'exclude': sorted(large_fields)}
+
+    def get_facet(self, bucket):
+        """
+        Translate a bucket of the terms aggregation to a facet, as the terms facet used to return them.
+
+        Returns:
+            facet (dict): the term, its number of documents and for tags the latest usage
+        """
+        facet = {
+            'term': bucket['key'],
+            'count': bucket['doc_count'],
+        }
+        if 'last_used' in bucket:
+            facet['last_used'] = bucket['last_used'].get('value_as_string')
+        return facet
+
+    def get_cached_results(self, return_fields=None):
+        """
+        Look up the results of the search in the result cache. The query, filters, sorting and
+        page are all part of the search body, which is hashed into the key together with the
+        generations of the tenant and the searched types, so writes to the index invalidate it.
+
+        Returns:
+            results (tuple): the results as `do_search` returns them and the next cursor, None when they
+                are not cached
+            key (str): the key to cache the results with, None when they shouldn't be cached
+        """
+        if self.model_type:
+            doc_types = [self.model_type]
+        else:
+            doc_types = [mapping.get_mapping_type_name() for mapping in ModelMappings.mappings]
+
+        request = {
+            'body': self.search.build_search(),
+            'indexes': self.search.get_indexes(),
+            'doctypes': self.search.get_doctypes(),
+            'fields': return_fields,
+        }
+        return get_cached_results(self.tenant_id, self.model_type, doc_types, request)
 
     def query_common_fields(self, query):
         """
@@ -241,25 +561,7 @@ class LilySearch(object):
         Args:
             account_id (integer): search with this account's email addresses
         """
-        account = Account.objects.get(id=account_id)
-        emails = [email.email_address for email in account.email_addresses.all() if email.email_address]
-        contacts = account.get_contacts()
-        for contact in contacts:
-            contact_emails = [email.email_address for email in contact.email_addresses.all() if email.email_address]
-            emails.extend(contact_emails)
-        if not emails:
-            # Disable results if no email at all for account.
-            self.raw_filters.append({
-                'limit': {
-                    'value': 0
-                }
-            })
-            return
-        # Enclose emails with quotes.
-        emails = set(['"%s"' % email for email in emails])
-        join = ' OR '.join(emails)
-        filterquery = 'sender_email:(%s) OR received_by_email:(%s) OR received_by_cc_email:(%s)' % (join, join, join)
-        self.filter_query(filterquery)
+        self.filter_email_addresses(get_account_email_addresses(account_id))
 
     def contact_related(self, contact_id):
         """
@@ -269,18 +571,39 @@ class LilySearch(object):
             contact_id (integer): search with this contact's email addresses
         """
         contact = Contact.objects.get(id=contact_id)
-        emails = set(['"%s"' % email.email_address for email in contact.email_addresses.all() if email.email_address])
+        self.filter_email_addresses([email.email_address for email in contact.email_addresses.all()])
+
+    def filter_email_addresses(self, email_addresses):
+        """
+        Search email sent by or to any of the email addresses, with a terms filter on the exact email addresses.
+        Until the email messages are reindexed with the exact subfields, the addresses are searched with a
+        query_string instead.
 
-        if not emails:
+        Args:
+            email_addresses (list): email addresses, no results at all when empty
+        """
+        email_addresses = sorted(set(email.lower() for email in email_addresses if email))
+        if not email_addresses:
+            # Disable results if no email at all for account.
             self.raw_filters.append({
                 'limit': {
                     'value': 0
                 }
             })
             return
-        join = ' OR '.join(emails)
-        filterquery = 'sender_email:(%s) OR received_by_email:(%s) OR received_by_cc_email:(%s)' % (join, join, join)
-        self.filter_query(filterquery)
+
+        if not has_exact_email_fields():
+            # Enclose emails with quotes.
+            join = ' OR '.join('"%s"' % email for email in email_addresses)
+            self.filter_query(' OR '.join('%s:(%s)' % (field, join) for field in EXACT_EMAIL_FIELDS))
+            return
+
+        self.raw_filters.append({
+            'or': [
+                {'terms': {'%s.exact' % field: email_addresses}}
+                for field in EXACT_EMAIL_FIELDS
+            ]
+        })
 
     def user_email_related(self, user):
         """
@@ -289,23 +612,9 @@ class LilySearch(object):
         Args:
             user (User): The user to use with the search
         """
-        email_accounts = EmailAccount.objects.filter(
-            Q(owner=user) |
-            Q(public=True) |
-            Q(shared_with_users__id=user.pk)
-        ).filter(tenant=user.tenant, is_deleted=False).distinct('id')
-
-        # Hide when we do not want to follow an email_account.
-        email_account_exclude_list = SharedEmailConfig.objects.filter(
-            user=user,
-            is_hidden=True
-        ).values_list('email_account_id', flat=True)
-
-        email_accounts = email_accounts.exclude(
-            id__in=email_account_exclude_list
-        )
+        email_account_ids = get_visible_email_account_ids(user)
 
-        if not email_accounts:
+        if not email_account_ids:
             # Disable results if no email at all for account.
             self.raw_filters.append({
                 'limit': {
@@ -313,10 +622,12 @@ class LilySearch(object):
                 }
             })
             return
-        email_accounts = set(['%s' % email.email_address for email in email_accounts])
-        join = ' OR '.join(email_accounts)
-        filterquery = 'account_email:(%s)' % join
-        self.filter_query(filterquery)
+
+        self.raw_filters.append({
+            'terms': {
+                'account': email_account_ids,
+            }
+        })
 
     def get_by_id(self, id_arg):
         """
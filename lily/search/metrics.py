@@ -0,0 +1,165 @@
+from contextlib import contextmanager
+import logging
+from threading import Lock
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+logger = logging.getLogger('search')
+
+key_prefix = 'search:metrics'
+
+# The stages of indexing a document, in the order they happen.
+FETCH = 'fetch'
+PREFETCH = 'prefetch'
+OBJ_TO_DOC = 'obj_to_doc'
+PREPARE_DICT = 'prepare_dict'
+ENCODE = 'encode'
+BULK = 'bulk'
+STAGES = (FETCH, PREFETCH, OBJ_TO_DOC, PREPARE_DICT, ENCODE, BULK)
+
+# The upper bounds of the duration histogram in milliseconds, the last bucket has no upper bound.
+BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+BUCKET_FIELDS = tuple('le_%s' % bucket for bucket in BUCKETS) + ('le_inf',)
+FIELDS = ('calls', 'micros', 'docs', 'bytes') + BUCKET_FIELDS
+
+# Measurements of this process that were not written to the cache yet, (doc_type, stage) -> {field: value}.
+pending = {}
+pending_lock = Lock()
+last_flush = [time.time()]
+
+
+def get_key(doc_type, stage, field):
+    return '%s:%s:%s:%s' % (key_prefix, doc_type, stage, field)
+
+
+def get_bucket_field(seconds):
+    milliseconds = seconds * 1000
+    for bucket, field in zip(BUCKETS, BUCKET_FIELDS):
+        if milliseconds <= bucket:
+            return field
+    return BUCKET_FIELDS[-1]
+
+
+def record(doc_type, stage, seconds, docs=1, size=0):
+    """
+    Record one measurement of an indexing stage. Measurements are kept in memory and written to the
+    cache by the index commands and, at most once per settings.ES_METRICS_FLUSH_INTERVAL seconds, after
+    the Celery tasks, see `flush_metrics`. So web requests never wait for the cache to store them.
+
+    Args:
+        doc_type (str): the name of the mapping, e.g. 'contacts_contact'
+        stage (str): one of STAGES
+        seconds (float): the duration of the stage
+        docs (int): the number of documents the stage handled
+        size (int): the number of bytes the stage handled, for the encode and bulk stages
+    """
+    if not settings.ES_METRICS:
+        return
+
+    with pending_lock:
+        values = pending.get((doc_type, stage))
+        if values is None:
+            values = pending[(doc_type, stage)] = dict.fromkeys(FIELDS, 0)
+        values['calls'] += 1
+        values['micros'] += int(seconds * 1000000)
+        values['docs'] += docs
+        values['bytes'] += size
+        values[get_bucket_field(seconds)] += 1
+
+
+def record_bulk(actions, seconds, size=0):
+    """
+    Record the duration of a bulk request for every mapping it contained actions of,
+    divided by their share of the actions.
+    """
+    doc_types = {}
+    for action in actions:
+        doc_types[action['_type']] = doc_types.get(action['_type'], 0) + 1
+    for doc_type, count in doc_types.iteritems():
+        share = float(count) / len(actions)
+        record(doc_type, BULK, seconds * share, docs=count, size=int(size * share))
+
+
+@contextmanager
+def measure(doc_type, stage, docs=1):
+    """
+    Record the duration of the block as a measurement of the stage.
+
+    Usage:
+        with measure('contacts_contact', OBJ_TO_DOC):
+            doc = cls.obj_to_doc(obj)
+    """
+    start = time.time()
+    yield
+    record(doc_type, stage, time.time() - start, docs=docs)
+
+
+def flush_metrics():
+    """
+    Add the measurements of this process to the counters in the cache, over all processes,
+    and log them as one line per mapping and stage.
+    """
+    with pending_lock:
+        flushed = pending.copy()
+        pending.clear()
+        last_flush[0] = time.time()
+
+    for (doc_type, stage), values in sorted(flushed.items()):
+        for field, value in values.iteritems():
+            if value:
+                key = get_key(doc_type, stage, field)
+                cache.add(key, 0, None)
+                cache.incr(key, value)
+
+        seconds = values['micros'] / 1000000.0
+        logger.info(
+            'search.metrics mapping=%s stage=%s calls=%s docs=%s bytes=%s seconds=%.3f docs_per_sec=%.0f '
+            'bytes_per_sec=%.0f' % (
+                doc_type, stage, values['calls'], values['docs'], values['bytes'], seconds,
+                values['docs'] / seconds if seconds else 0, values['bytes'] / seconds if seconds else 0,
+            )
+        )
+
+
+def flush_metrics_if_due():
+    """
+    Flush the measurements of this process when the flush interval has passed since the last flush.
+    """
+    if time.time() - last_flush[0] > settings.ES_METRICS_FLUSH_INTERVAL:
+        flush_metrics()
+
+
+def get_metrics(doc_type):
+    """
+    Returns the counters of every stage of a mapping, since the counters were reset.
+
+    Returns:
+        metrics (dict): stage -> {field: value}, see FIELDS
+    """
+    keys = [get_key(doc_type, stage, field) for stage in STAGES for field in FIELDS]
+    stored = cache.get_many(keys)
+    return {
+        stage: {field: stored.get(get_key(doc_type, stage, field), 0) for field in FIELDS}
+        for stage in STAGES
+    }
+
+
+def get_percentile(values, percentile):
+    """
+    Returns the upper bound in milliseconds of the histogram bucket the percentile falls in,
+    None when it falls in the last bucket (or there are no measurements).
+    """
+    rank = values['calls'] * percentile
+    seen = 0
+    for bucket, field in zip(BUCKETS, BUCKET_FIELDS):
+        seen += values[field]
+        if seen and seen >= rank:
+            return bucket
+    return None
+
+
+def reset_metrics(doc_type):
+    cache.delete_many([get_key(doc_type, stage, field) for stage in STAGES for field in FIELDS])
@@ -0,0 +1,22 @@
+from .index_queue import get_index_queue, start_index_queue
+from .indexing import flush_index_queue
+
+
+class IndexQueueMiddleware(object):
+    """
+    Defer all index updates during a request and send them to Elasticsearch in one go when the response is ready.
+    This way saving an instance with a lot of related instances results in one document per instance being indexed.
+    """
+    def process_request(self, request):
+        if get_index_queue() is not None:
+            # Left over from a request whose response was never processed, e.g. because the error page failed.
+            flush_index_queue(reload=True)
+        start_index_queue()
+
+    def process_exception(self, request, exception):
+        # The view failed, so only index what actually ended up in the database.
+        request._index_queue_reload = True
+
+    def process_response(self, request, response):
+        flush_index_queue(reload=getattr(request, '_index_queue_reload', False))
+        return response
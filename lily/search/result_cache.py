@@ -0,0 +1,146 @@
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+key_prefix = 'search:results'
+
+# Written documents become searchable when the index is refreshed, which happens every second by default.
+# Results are not cached until this many seconds after the last write, so they can't be cached from before
+# the refresh under the generation of after the write.
+SETTLE_SECONDS = 2
+
+# The generation of all tenants, bumped for writes of which the tenant is not known, e.g. delete actions.
+ALL_TENANTS = 'all'
+
+HITS = 'hits'
+MISSES = 'misses'
+
+
+def get_generation_key(tenant_id, doc_type):
+    return '%s:generation:%s:%s' % (key_prefix, tenant_id, doc_type)
+
+
+def get_written_key(tenant_id, doc_type):
+    return '%s:written:%s:%s' % (key_prefix, tenant_id, doc_type)
+
+
+def get_counter_key(doc_type, counter):
+    return '%s:%s:%s' % (key_prefix, doc_type or 'all', counter)
+
+
+def get_generations(tenant_id, doc_types):
+    """
+    Returns the generations of the results of the tenant for the given mapping types.
+
+    Returns:
+        generations (list): the generation per mapping type, of the tenant and of all tenants
+        settled (boolean): False when any of the mapping types was written to too recently to cache results
+    """
+    generation_keys = []
+    written_keys = []
+    for doc_type in doc_types:
+        for tenant in (tenant_id, ALL_TENANTS):
+            generation_keys.append(get_generation_key(tenant, doc_type))
+            written_keys.append(get_written_key(tenant, doc_type))
+
+    stored = cache.get_many(generation_keys + written_keys)
+    generations = [stored.get(key, 0) for key in generation_keys]
+    last_written = max([stored.get(key, 0) for key in written_keys] or [0])
+    return generations, time.time() - last_written > SETTLE_SECONDS
+
+
+def bump_generations(actions):
+    """
+    Invalidate the cached results of the tenants and mapping types the bulk actions were written to.
+    """
+    if not settings.ES_RESULT_CACHE:
+        return
+
+    scopes = set()
+    for action in actions:
+        source = action.get('_source') or {}
+        scopes.add((source.get('tenant', ALL_TENANTS), action['_type']))
+    bump_scopes(scopes)
+
+
+def bump_scopes(scopes):
+    """
+    Args:
+        scopes (iterable): (tenant_id, doc_type) tuples, tenant_id ALL_TENANTS for every tenant
+    """
+    if not settings.ES_RESULT_CACHE:
+        return
+
+    now = time.time()
+    for tenant_id, doc_type in scopes:
+        key = get_generation_key(tenant_id, doc_type)
+        cache.add(key, 0, None)
+        cache.incr(key)
+    cache.set_many({get_written_key(tenant_id, doc_type): now for tenant_id, doc_type in scopes}, SETTLE_SECONDS * 2)
+
+
+def get_cache_key(tenant_id, doc_type, generations, request):
+    """
+    Returns the key of a search request, its generations make it change when the results can change.
+
+    Args:
+        request (dict): everything that determines the results, e.g. the search body, indexes and fields
+    """
+    digest = hashlib.sha1(json.dumps(request, sort_keys=True, cls=DjangoJSONEncoder)).hexdigest()
+    return '%s:%s:%s:%s:%s' % (key_prefix, tenant_id, doc_type or 'all', '.'.join(map(str, generations)), digest)
+
+
+def get_cached_results(tenant_id, doc_type, doc_types, request):
+    """
+    Returns the cached results of a search request.
+
+    Args:
+        tenant_id (int): the tenant that searches
+        doc_type (str): the mapping type that is searched, None for all
+        doc_types (list): the names of the mapping types the results can come from
+        request (dict): everything that determines the results, see `get_cache_key`
+
+    Returns:
+        results: the cached results, None when there are none
+        key (str): the key to cache the results with, None when they shouldn't be cached
+    """
+    generations, settled = get_generations(tenant_id, doc_types)
+    key = get_cache_key(tenant_id, doc_type, generations, request)
+    results = cache.get(key)
+    count(doc_type, HITS if results is not None else MISSES)
+    return results, key if settled else None
+
+
+def cache_results(key, results):
+    if key:
+        cache.set(key, results, settings.ES_RESULT_CACHE_TIMEOUT)
+
+
+def count(doc_type, counter):
+    """
+    Keep track of the number of hits and misses per mapping type, over all processes.
+    """
+    key = get_counter_key(doc_type, counter)
+    cache.add(key, 0, None)
+    cache.incr(key)
+
+
+def get_counts(doc_type):
+    """
+    Returns the number of hits and misses of a mapping type, None for searches over all types.
+    """
+    keys = [get_counter_key(doc_type, HITS), get_counter_key(doc_type, MISSES)]
+    counts = cache.get_many(keys)
+    return {
+        HITS: counts.get(keys[0], 0),
+        MISSES: counts.get(keys[1], 0),
+    }
+
+
+def reset_counts(doc_type):
+    cache.delete_many([get_counter_key(doc_type, HITS), get_counter_key(doc_type, MISSES)])
@@ -1,35 +1,107 @@
-import inspect
+import logging
+from threading import RLock
+import time
 
 from django.conf import settings
-from elasticutils.contrib.django import MappingType
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
 
 from lily.search.base_mapping import BaseMapping
 
 
-class ModelMappings(object):
-    mappings = []
-    model_to_mappings = {}
-    app_to_mappings = {}
-
-    @classmethod
-    def scan(cls, apps_to_scan=settings.INSTALLED_APPS):
-        mappings = []
-        apps = []
-        models = []
-
-        for app in apps_to_scan:
-            # Try because not every app has a search.py.
-            try:
-                # Import the child module 'search', hence the additional
-                # parameters. (Otherwise only the top module is returned).
-                search_module = __import__('%s.search' % app, globals(), locals(), ['search'])
-                for name_member in inspect.getmembers(search_module, inspect.isclass):
-                    member = name_member[1]
-                    # Check if we defined a mapping class. We shall exclude
-                    # members of BaseMapping or MappingType itself.
-                    if issubclass(member, MappingType) and member is not BaseMapping and member is not MappingType:
-                        cls.mappings.append(member)
-                        cls.model_to_mappings[member.get_model()] = member
-                        cls.app_to_mappings[app] = member
-            except Exception:
-                pass
+logger = logging.getLogger('search')
+
+
+class MappingRegistry(object):
+    """
+    The mappings of settings.ES_MAPPINGS, with lookup tables by model, app and related model.
+
+    The mappings are imported the first time the registry is used, instead of at startup, and the lookup
+    tables are built once. A mapping that can't be imported raises an error instead of being left out.
+    """
+    def __init__(self, mapping_paths=None):
+        """
+        Args:
+            mapping_paths (list): dotted paths of the mapping classes, settings.ES_MAPPINGS by default
+        """
+        self.mapping_paths = mapping_paths
+        self.lock = RLock()
+        self.loaded = False
+        # The time it took to import the mappings and build the lookup tables, in seconds.
+        self.load_duration = None
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+
+            start = time.time()
+            mapping_paths = settings.ES_MAPPINGS if self.mapping_paths is None else self.mapping_paths
+
+            mappings = []
+            model_to_mappings = {}
+            app_to_mappings = {}
+            for path in mapping_paths:
+                mapping = import_string(path)
+                if not issubclass(mapping, BaseMapping):
+                    raise ImproperlyConfigured('%s in ES_MAPPINGS is not a subclass of BaseMapping.' % path)
+
+                model = mapping.get_model()
+                if model in model_to_mappings:
+                    raise ImproperlyConfigured('%s and %s in ES_MAPPINGS both map %s.' % (
+                        model_to_mappings[model].__name__, mapping.__name__, model.__name__))
+
+                mappings.append(mapping)
+                model_to_mappings[model] = mapping
+                # The app of lily.contacts.search.ContactMapping is lily.contacts.
+                app_to_mappings.setdefault(mapping.__module__.rpartition('.')[0], []).append(mapping)
+
+            self._mappings = mappings
+            self._model_to_mappings = model_to_mappings
+            self._app_to_mappings = app_to_mappings
+            self._related_mappings = self.build_related_mappings(mappings)
+            self.loaded = True
+            self.load_duration = time.time() - start
+
+            logger.info('Loaded %s search mappings in %.1fms' % (len(mappings), self.load_duration * 1000))
+
+    def build_related_mappings(self, mappings):
+        """
+        Build the reverse dependency map once, instead of asking every mapping
+        for its related models on every save of any model.
+        """
+        related_mappings = {}
+        for mapping in mappings:
+            for model, resolver in mapping.get_related_models().items():
+                related_mappings.setdefault(model, []).append((mapping, resolver))
+        return related_mappings
+
+    @property
+    def mappings(self):
+        if not self.loaded:
+            self.load()
+        return self._mappings
+
+    @property
+    def model_to_mappings(self):
+        if not self.loaded:
+            self.load()
+        return self._model_to_mappings
+
+    @property
+    def app_to_mappings(self):
+        if not self.loaded:
+            self.load()
+        return self._app_to_mappings
+
+    @property
+    def related_mappings(self):
+        """
+        Reverse dependency map, model -> [(mapping, resolver)], see `build_related_mappings`.
+        """
+        if not self.loaded:
+            self.load()
+        return self._related_mappings
+
+
+ModelMappings = MappingRegistry()
@@ -0,0 +1,68 @@
+from datetime import date, datetime
+from decimal import Decimal
+import json
+
+from elasticsearch.helpers import expand_action
+
+
+def default(value):
+    """
+    Serialize the values json doesn't know, the same as the serializer of elasticsearch-py.
+    """
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    elif isinstance(value, Decimal):
+        return float(value)
+    raise TypeError('Unable to serialize %r (type: %s)' % (value, type(value)))
+
+
+# One encoder for every document, json.dumps creates a new encoder on every call with other than default arguments.
+encoder = json.JSONEncoder(default=default, check_circular=False, separators=(',', ':'))
+
+# The start of the action line per (op_type, index, doc_type), only the id differs per document.
+action_prefixes = {}
+
+# The keys of the actions encode_action writes itself, other actions are expanded by elasticsearch-py.
+ACTION_KEYS = frozenset(['_op_type', '_index', '_type', '_id', '_source'])
+DELETE_KEYS = frozenset(['_index', '_type', '_id'])
+INDEX_KEYS = DELETE_KEYS | frozenset(['_source'])
+
+
+def get_action_line(op_type, index, doc_type, doc_id):
+    key = (op_type, index, doc_type)
+    prefix = action_prefixes.get(key)
+    if prefix is None:
+        prefix = action_prefixes[key] = '{"%s":{"_index":%s,"_type":%s,"_id":' % (
+            op_type, encoder.encode(index), encoder.encode(doc_type))
+    return '%s%s}}' % (prefix, encoder.encode(doc_id))
+
+
+def encode_action(action):
+    """
+    Returns the NDJSON lines of a bulk action, in the format of `elasticsearch.helpers.bulk`.
+
+    The action line is built from a cached prefix instead of serializing a dict for every document,
+    and the document is serialized with a shared, compact encoder.
+    """
+    op_type = action.get('_op_type', 'index')
+    keys = set(action)
+
+    if ACTION_KEYS >= keys >= (DELETE_KEYS if op_type == 'delete' else INDEX_KEYS):
+        lines = [get_action_line(op_type, action['_index'], action['_type'], action['_id'])]
+        data = None if op_type == 'delete' else action['_source']
+    else:
+        action_line, data = expand_action(action)
+        lines = [encoder.encode(action_line)]
+
+    if data is not None:
+        lines.append(encoder.encode(data))
+    return lines
+
+
+def expand_encoded_action(action):
+    """
+    Expand an action to its encoded action and data line, for the expand_action_callback of
+    `elasticsearch.helpers.bulk`, which sends strings as they are.
+    """
+    lines = encode_action(action)
+    return lines[0], lines[1] if len(lines) > 1 else None
@@ -1,13 +1,18 @@
+from collections import OrderedDict
+
+from django.db.models.query import QuerySet
 from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch.dispatcher import receiver
 
-from .indexing import update_in_index, remove_from_index
+from . import filter_cache
+from .indexing import deferred_indexing, update_in_index, remove_from_index
 from .scan_search import ModelMappings
 from django.conf import settings
 
 
 @receiver(post_save)
 def post_save_generic(sender, instance, **kwargs):
+    filter_cache.invalidate(sender, instance)
     if settings.ES_DISABLED:
         return
     mapping = ModelMappings.model_to_mappings.get(sender)
@@ -18,6 +23,7 @@ def post_save_generic(sender, instance, **kwargs):
 
 @receiver(m2m_changed)
 def m2m_changed_generic(sender, instance, action, **kwargs):
+    filter_cache.invalidate(sender, instance, action=action, pk_set=kwargs.get('pk_set'))
     if settings.ES_DISABLED:
         return
     if action.startswith('post_'):
@@ -29,6 +35,7 @@ def m2m_changed_generic(sender, instance, action, **kwargs):
 
 @receiver(post_delete)
 def post_delete_generic(sender, instance, **kwargs):
+    filter_cache.invalidate(sender, instance, deleted=True)
     if settings.ES_DISABLED:
         return
     mapping = ModelMappings.model_to_mappings.get(sender)
@@ -41,16 +48,33 @@ def post_delete_generic(sender, instance, **kwargs):
 
 def check_related(sender, instance):
     """
-    Check related models by checking if the sender is in the relations of the
-    mappings.
+    Check related models by looking up the sender in the reverse dependency map
+    of the mappings. The pks of the related objects are collected per mapping, so
+    every related object is fetched once (with the batch optimizations of the
+    mapping) and indexed once, with one bulk request.
     """
-    for mapping in ModelMappings.mappings:
-        # Use type(instance) because of sender, because m2m sender differs
-        # from type(instance).
-        related = mapping.get_related_models().get(type(instance))
-        if related:
-            for obj in related(instance):
-                # Some related objects are not specific to one model, such as
-                # 'subject' of Tag, so we do a double check to match the model.
-                if type(obj) is mapping.get_model():
-                    update_in_index(obj, mapping)
+    # Use type(instance) because of sender, because m2m sender differs
+    # from type(instance).
+    related_mappings = ModelMappings.related_mappings.get(type(instance))
+    if not related_mappings:
+        return
+
+    related_ids = OrderedDict()
+    for mapping, related in related_mappings:
+        model = mapping.get_model()
+        related_objects = related(instance)
+        if isinstance(related_objects, QuerySet):
+            # Only read the pks, prepare_batch fetches the objects.
+            ids = set(related_objects.values_list('pk', flat=True))
+        else:
+            # Some related objects are not specific to one model, such as
+            # 'subject' of Tag, so we do a double check to match the model.
+            ids = set(obj.pk for obj in related_objects if type(obj) is model)
+        if ids:
+            related_ids.setdefault(mapping, set()).update(ids)
+
+    with deferred_indexing():
+        for mapping, ids in related_ids.iteritems():
+            queryset = mapping.prepare_batch(mapping.get_model().objects.filter(pk__in=ids))
+            for obj in queryset:
+                update_in_index(obj, mapping)
@@ -0,0 +1,114 @@
+import logging
+
+from celery.signals import task_prerun, task_postrun
+from celery.task import task
+from django.conf import settings
+
+from lily.tenant.models import Tenant
+
+from .drift import find_drift
+from .index_queue import start_index_queue
+from .indexing import REFRESH_NONE, update_ids_in_index, flush_index_queue, reindex_scope, unindex_by_query
+from .metrics import flush_metrics_if_due
+from .scan_search import ModelMappings
+
+
+logger = logging.getLogger(__name__)
+
+
+@task(name='update_index_for_ids', logger=logger)
+def update_index_for_ids(mapping_type_name, ids, refresh=None):
+    """
+    Update the documents of the given ids in the index, used to take indexing out of the web request.
+
+    Args:
+        mapping_type_name (str): the name of the mapping, e.g. 'accounts_account'
+        ids (list): ids of the instances to update (or remove when they no longer exist)
+        refresh (str): refresh policy for the update
+    """
+    for mapping in ModelMappings.mappings:
+        if mapping.get_mapping_type_name() == mapping_type_name:
+            update_ids_in_index(mapping, ids, refresh=refresh)
+            break
+    else:
+        logger.error('Unknown mapping %s, not updating %s' % (mapping_type_name, ids))
+
+
+@task(name='unindex_documents', logger=logger)
+def unindex_documents(mapping_type_name, tenant_id=None, account_id=None):
+    """
+    Remove all documents of a tenant or an email account from the index, e.g. after an email account was removed.
+
+    Args:
+        mapping_type_name (str): the name of the mapping, e.g. 'email_emailmessage'
+        tenant_id (int): remove the documents of this tenant
+        account_id (int): remove the documents with this (email) account
+    """
+    if settings.ES_DISABLED:
+        return
+    for mapping in ModelMappings.mappings:
+        if mapping.get_mapping_type_name() == mapping_type_name:
+            count = unindex_by_query(mapping, tenant_id=tenant_id, account_id=account_id)
+            logger.info('Removed %s documents of %s' % (count, mapping_type_name))
+            break
+    else:
+        logger.error('Unknown mapping %s, not removing documents' % mapping_type_name)
+
+
+@task(name='reindex_documents', logger=logger)
+def reindex_documents(tenant_id=None, account_id=None, mapping_type_names=None):
+    """
+    Replace the documents of a tenant or an email account in the index, e.g. to repair the search data of one
+    customer without reindexing everything.
+
+    Args:
+        tenant_id (int): reindex the documents of this tenant
+        account_id (int): reindex the documents of this email account
+        mapping_type_names (list): only reindex these mappings, by default all (that belong to an email account)
+    """
+    if settings.ES_DISABLED:
+        return
+    for mapping in ModelMappings.mappings:
+        if mapping_type_names and mapping.get_mapping_type_name() not in mapping_type_names:
+            continue
+        if account_id and not mapping.has_email_account():
+            continue
+        count = reindex_scope(mapping, tenant_id=tenant_id, account_id=account_id, use_rows=True)
+        logger.info('Reindexed %s documents of %s' % (count, mapping.get_mapping_type_name()))
+
+
+@task(name='check_index_drift', logger=logger)
+def check_index_drift(repair=None):
+    """
+    Compare the database with the index for every mapping and tenant, and log the documents that are missing,
+    stale or orphaned, e.g. because an update of the index failed.
+
+    Args:
+        repair (boolean): fix the documents that drifted, settings.ES_DRIFT_REPAIR by default
+    """
+    if repair is None:
+        repair = settings.ES_DRIFT_REPAIR
+
+    tenant_ids = list(Tenant.objects.order_by('pk').values_list('pk', flat=True))
+    for mapping in ModelMappings.mappings:
+        for tenant_id in tenant_ids:
+            find_drift(mapping, tenant_id=tenant_id, repair=repair)
+
+
+@task_prerun.connect
+def start_index_queue_for_task(**kwargs):
+    """
+    Collect the index updates of every task, so every document is sent at most once per task.
+    Tasks run in the background, so they never force a refresh of the index.
+    """
+    start_index_queue(refresh=REFRESH_NONE)
+
+
+@task_postrun.connect
+def flush_index_queue_for_task(**kwargs):
+    """
+    Send the index updates of the task that just finished to Elasticsearch, and the indexing metrics
+    of this worker to the cache once per flush interval.
+    """
+    flush_index_queue(reload=kwargs.get('state') != 'SUCCESS')
+    flush_metrics_if_due()
@@ -0,0 +1,1325 @@
+from contextlib import contextmanager
+from datetime import date
+import json
+from StringIO import StringIO
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.test import RequestFactory, TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from elasticsearch.exceptions import TransportError
+from elasticsearch.helpers import BulkIndexError
+
+from rest_framework.request import Request
+from rest_framework.reverse import reverse
+
+from lily.accounts.api.views import AccountViewSet
+from lily.accounts.factories import AccountFactory
+from lily.accounts.models import Account
+from lily.accounts.search import AccountMapping
+from lily.api.filters import ElasticSearchFilter, ElasticSearchResults
+from lily.contacts.factories import ContactFactory, ContactWithEmailFactory, FunctionFactory
+from lily.contacts.models import Function
+from lily.contacts.search import ContactMapping
+from lily.management.commands.index import Command as IndexCommand
+from lily.messaging.email.models.models import EmailAccount, EmailLabel, EmailMessage, Recipient, SharedEmailConfig
+from lily.messaging.email.search import EmailMessageMapping
+from lily.tags.factories import TagFactory
+from lily.tenant.factories import TenantFactory
+from lily.users.factories import LilyUserFactory
+from lily.users.models import LilyUser
+from lily.users.search import LilyUserMapping, TeamMapping
+from lily.utils.models.factories import AddressFactory, EmailAddressFactory, PhoneNumberFactory
+
+from . import drift, dual_write, indexing, metrics
+from .bulk import BulkIndexer
+from .checkpoints import IndexCheckpoint
+from .connections_utils import get_index_name
+from .drift import MISSING, ORPHANED, STALE, compare_entries, find_drift
+from .dual_write import get_dual_write_alias, get_dual_write_index, start_dual_write, stop_dual_write
+from .filter_cache import (get_account_email_addresses, get_email_accounts_generation_key, get_exact_email_fields_key,
+                           get_visible_email_account_ids, load_has_exact_email_fields)
+from .fingerprints import get_fingerprint, get_key, save_fingerprints, skip_unchanged
+from .index_queue import IndexQueue, get_index_queue, start_index_queue, stop_index_queue
+from .indexing import (REFRESH_IMMEDIATE, REFRESH_NONE, REFRESH_PERIODIC, REFRESH_WAIT_FOR, deferred_indexing,
+                       get_bulk_actions, get_index_queryset, get_refresh_policy, prepare_dict, refresh_after_write,
+                       remove_from_index, unindex_by_query, update_in_index)
+from .lily_search import LilyS, LilySearch, decode_cursor, encode_cursor
+from .metrics import BULK, flush_metrics, flush_metrics_if_due, get_metrics, get_percentile, record, reset_metrics
+from .result_cache import (HITS, MISSES, bump_generations, cache_results, get_cache_key, get_cached_results,
+                           get_counts, get_generations)
+from .scan_search import MappingRegistry, ModelMappings
+from .serialization import encode_action
+from .signals import check_related
+from .views import EmailAddressSearchView, PhoneNumberSearchView, SearchView
+
+
+class StubElasticsearch(object):
+    """
+    Stands in for the Elasticsearch client, answers every request with the next of the given responses.
+    A response that is an exception is raised instead, and the requests are kept to check them.
+    """
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+        # The indices api is answered the same way.
+        self.indices = self
+
+    def respond(self, method, kwargs):
+        self.requests.append((method, kwargs))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        if callable(response):
+            # A function that builds the response from the request.
+            return response(**kwargs)
+        return response
+
+    def search(self, **kwargs):
+        return self.respond('search', kwargs)
+
+    def index(self, **kwargs):
+        return self.respond('index', kwargs)
+
+    def delete(self, **kwargs):
+        return self.respond('delete', kwargs)
+
+    def count(self, **kwargs):
+        return self.respond('count', kwargs)
+
+    def delete_by_query(self, **kwargs):
+        return self.respond('delete_by_query', kwargs)
+
+    def get_mapping(self, **kwargs):
+        return self.respond('get_mapping', kwargs)
+
+    def bulk(self, body, **kwargs):
+        return self.respond('bulk', dict(kwargs, body=body))
+
+    def msearch(self, **kwargs):
+        return self.respond('msearch', kwargs)
+
+    def refresh(self, index=None, **kwargs):
+        return self.respond('refresh', dict(kwargs, index=index))
+
+    def get_aliases(self, **kwargs):
+        return self.respond('get_aliases', kwargs)
+
+    def put_alias(self, **kwargs):
+        return self.respond('put_alias', kwargs)
+
+    def delete_alias(self, **kwargs):
+        return self.respond('delete_alias', kwargs)
+
+    def exists(self, index=None, **kwargs):
+        return self.respond('exists', dict(kwargs, index=index))
+
+    def scroll(self, scroll_id=None, **kwargs):
+        return self.respond('scroll', dict(kwargs, scroll_id=scroll_id))
+
+    def get_settings(self, **kwargs):
+        return self.respond('get_settings', kwargs)
+
+    def put_settings(self, body, **kwargs):
+        return self.respond('put_settings', dict(kwargs, body=body))
+
+
+def search_response(ids, total=None):
+    """
+    Returns the response of a search with a hit for every id.
+    """
+    return {
+        'took': 1,
+        'hits': {
+            'total': len(ids) if total is None else total,
+            'hits': [{'_id': str(pk), '_type': 'accounts_account', '_source': {'id': pk}} for pk in ids],
+        },
+    }
+
+
+def scroll_response(ids, modified=None):
+    """
+    Returns a page of a scroll with a hit for every id, see `elasticsearch.helpers.scan`.
+    """
+    return {
+        '_scroll_id': 'scroll',
+        '_shards': {'total': 1, 'failed': 0},
+        'hits': {
+            'hits': [{'_id': str(pk), '_source': {'modified': modified} if modified else {}} for pk in ids],
+        },
+    }
+
+
+def get_action_lines(body):
+    """
+    Returns the decoded action lines of the body of a bulk request, which is a string or a list of lines.
+    """
+    lines = body.splitlines() if isinstance(body, basestring) else body
+    return [json.loads(line) for line in lines if '"_index"' in line]
+
+
+def bulk_response(body, **kwargs):
+    """
+    Returns the response of a bulk request in which every action succeeded.
+    """
+    return {'items': [{'index': {'status': 200}} for line in get_action_lines(body)]}
+
+
+def get_bulk_ids(es_client):
+    """
+    Returns the sorted (op_type, id) tuples of the actions of the bulk requests the client received.
+    """
+    return sorted(
+        (op_type, action['_id'])
+        for method, kwargs in es_client.requests if method == 'bulk'
+        for line in get_action_lines(kwargs['body'])
+        for op_type, action in line.items()
+    )
+
+
+def msearch_response(*responses):
+    """
+    Returns the response of a multi search, with the response of every search.
+    """
+    return {'responses': list(responses)}
+
+
+@contextmanager
+def stub_search(es_client):
+    """
+    Send the searches of LilySearch to the given client.
+    """
+    LilyS.get_es = lambda self, **kwargs: es_client
+    try:
+        yield es_client
+    finally:
+        # Use the get_es of elasticutils again.
+        del LilyS.get_es
+
+
+@contextmanager
+def stub_indexing(es_client):
+    """
+    Send the writes of lily.search.indexing, the scans of lily.search.drift and the alias requests
+    of lily.search.dual_write to the given client.
+    """
+    es = indexing.es
+    indexing.es = drift.es = dual_write.es = es_client
+    # No index is being built, without looking up the dual write aliases.
+    dual_write.dual_write_indexes.update(
+        (mapping.get_mapping_type_name(), (None, time.time())) for mapping in ModelMappings.mappings)
+    try:
+        yield es_client
+    finally:
+        indexing.es = drift.es = dual_write.es = es
+        dual_write.dual_write_indexes.clear()
+
+
+class RefreshPolicyTests(TestCase):
+    def setUp(self):
+        indexing.last_refresh.clear()
+
+    def test_refresh_policy(self):
+        """
+        Test that the policy of the call site precedes the policy of the mapping, which precedes the settings.
+        """
+        with self.settings(ES_REFRESH_POLICY=REFRESH_NONE):
+            self.assertEqual(get_refresh_policy(ContactMapping), REFRESH_NONE)
+            self.assertEqual(get_refresh_policy(EmailMessageMapping), REFRESH_PERIODIC)
+            self.assertEqual(get_refresh_policy(EmailMessageMapping, REFRESH_IMMEDIATE), REFRESH_IMMEDIATE)
+            self.assertEqual(get_refresh_policy(ContactMapping, REFRESH_WAIT_FOR), REFRESH_WAIT_FOR)
+
+        self.assertRaises(ValueError, get_refresh_policy, ContactMapping, 'always')
+        with self.settings(ES_REFRESH_POLICY='always'):
+            self.assertRaises(ValueError, get_refresh_policy, ContactMapping)
+
+    def test_refresh_after_write(self):
+        """
+        Test that the periodic policy refreshes an index at most once per interval, when it's written to.
+        """
+        es_client = StubElasticsearch({}, {}, {}, {})
+        with self.settings(ES_REFRESH_INTERVAL=60), stub_indexing(es_client):
+            refresh_after_write('index_a', REFRESH_NONE)
+            refresh_after_write('index_a', REFRESH_WAIT_FOR)
+            self.assertEqual(es_client.requests, [])
+
+            refresh_after_write('index_a', REFRESH_PERIODIC)
+            refresh_after_write('index_a', REFRESH_PERIODIC)
+            refresh_after_write('index_b', REFRESH_PERIODIC)
+            self.assertEqual([kwargs['index'] for method, kwargs in es_client.requests], ['index_a', 'index_b'])
+
+            # The interval has passed.
+            indexing.last_refresh['index_a'] -= 60
+            refresh_after_write('index_a', REFRESH_PERIODIC)
+            self.assertEqual(len(es_client.requests), 3)
+
+            refresh_after_write('index_a', REFRESH_IMMEDIATE)
+            self.assertEqual(len(es_client.requests), 4)
+
+    def test_invalid_policy(self):
+        """
+        Test that an invalid policy does not interrupt saving an instance while indexing is deferred.
+        """
+        es_client = StubElasticsearch()
+        with self.settings(ES_DISABLED=False, ES_REFRESH_POLICY='always'), stub_indexing(es_client):
+            with deferred_indexing():
+                contact = ContactFactory()
+                contact.delete()
+
+        self.assertEqual(es_client.requests, [])
+
+
+class IndexQueueTests(TestCase):
+    class Instance(object):
+        def __init__(self, pk):
+            self.pk = pk
+
+    def setUp(self):
+        # Don't depend on a queue that was left behind by another test.
+        stop_index_queue()
+
+    def test_coalesce(self):
+        """
+        Test that multiple updates of the same instance result in one entry, where the last update wins.
+        """
+        queue = IndexQueue()
+        account = self.Instance(1)
+
+        queue.add(AccountMapping, account)
+        queue.add(ContactMapping, self.Instance(1))
+        queue.add(AccountMapping, account, remove=True)
+
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.get_entries_per_mapping()[AccountMapping], [(account, True, None)])
+
+    def test_start_and_stop(self):
+        """
+        Test that the queue is only active between start and stop, and that starting twice keeps the same queue.
+        """
+        self.assertIsNone(get_index_queue())
+
+        queue = start_index_queue()
+        self.assertIs(start_index_queue(), queue)
+        self.assertIs(stop_index_queue(), queue)
+
+        self.assertIsNone(get_index_queue())
+
+    def test_deferred_indexing(self):
+        """
+        Test that the index updates of a block are deferred until the block is done.
+        """
+        with deferred_indexing():
+            self.assertIsNotNone(get_index_queue())
+
+        self.assertIsNone(get_index_queue())
+
+    def test_check_related(self):
+        """
+        Test that the objects that depend on a saved object are queued once per mapping.
+        """
+        function = FunctionFactory()
+
+        queue = start_index_queue()
+        with self.settings(ES_DISABLED=False):
+            check_related(Function, function)
+            check_related(Account, function.account)
+        stop_index_queue()
+
+        self.assertEqual(set(queue.entries), set([
+            (AccountMapping, function.account_id), (ContactMapping, function.contact_id),
+        ]))
+
+
+class ModelMappingsTests(TestCase):
+    def test_related_mappings(self):
+        """
+        Test that the reverse dependency map contains every mapping that depends on a model.
+        """
+        mappings = [mapping for mapping, resolver in ModelMappings.related_mappings[Function]]
+
+        self.assertIn(AccountMapping, mappings)
+        self.assertIn(ContactMapping, mappings)
+
+    def test_lookup_tables(self):
+        """
+        Test that the mappings can be looked up by model and by app.
+        """
+        registry = MappingRegistry(['lily.contacts.search.ContactMapping', 'lily.users.search.LilyUserMapping',
+                                    'lily.users.search.TeamMapping'])
+
+        self.assertEqual(registry.model_to_mappings[ContactMapping.get_model()], ContactMapping)
+        self.assertEqual(registry.app_to_mappings['lily.users'], [LilyUserMapping, TeamMapping])
+
+    def test_invalid_mapping(self):
+        """
+        Test that a mapping that can't be loaded raises an error, instead of being left out.
+        """
+        with self.assertRaises(ImportError):
+            MappingRegistry(['lily.contacts.search.UnknownMapping']).load()
+        with self.assertRaises(ImproperlyConfigured):
+            MappingRegistry(['lily.contacts.models.Contact']).load()
+        with self.assertRaises(ImproperlyConfigured):
+            MappingRegistry(['lily.contacts.search.ContactMapping', 'lily.contacts.search.ContactMapping']).load()
+
+
+class RowExtractionTests(TestCase):
+    def assertDocumentsEqual(self, mapping, pks):
+        """
+        Assert that the documents built from the rows equal the documents built from the instances,
+        as the instances are read for batch indexing.
+        """
+        queryset = mapping.get_model().objects.filter(pk__in=pks).order_by('pk')
+        rows = list(queryset.values(*mapping.values_fields))
+        instances = list(mapping.prepare_batch(queryset))
+
+        self.assertEqual(mapping.extract_documents(rows), [
+            mapping.extract_document(instance.pk, instance) for instance in instances
+        ])
+
+    def test_extract_documents(self):
+        """
+        Test that documents built from database rows are equal to the ones built from model instances.
+        """
+        tenant = TenantFactory.create()
+        contact = ContactWithEmailFactory.create(tenant=tenant)
+
+        rows = list(ContactMapping.get_model().objects.filter(pk=contact.pk).values(*ContactMapping.values_fields))
+
+        documents = ContactMapping.extract_documents(rows)
+
+        self.assertEqual(documents, [ContactMapping.extract_document(contact.pk, contact)])
+
+    def test_accounts(self):
+        """
+        Test that the documents of accounts built from rows are equal to the ones built from instances.
+        """
+        tenant = TenantFactory.create()
+        account = AccountFactory.create(tenant=tenant, assigned_to=LilyUserFactory.create(tenant=tenant))
+        account.email_addresses.add(EmailAddressFactory.create(tenant=tenant))
+        account.addresses.add(AddressFactory.create(tenant=tenant))
+        TagFactory.create(tenant=tenant, subject=account)
+        # An account without any relations.
+        other_account = Account.objects.create(tenant=tenant, name='Lily', status=account.status)
+
+        self.assertDocumentsEqual(AccountMapping, [account.pk, other_account.pk])
+
+    def test_email_messages(self):
+        """
+        Test that the documents of email messages built from rows are equal to the ones built from instances,
+        which are read without their html body.
+        """
+        owner = LilyUserFactory.create()
+        email_account = EmailAccount.objects.create(tenant=owner.tenant, owner=owner, email_address='a@example.com',
+                                                    label='Lily')
+        sender = Recipient.objects.create(name='Sender', email_address='sender@example.com')
+        inbox = EmailLabel.objects.create(account=email_account, label_id=settings.GMAIL_LABEL_INBOX, name='Inbox')
+        messages = [
+            EmailMessage.objects.create(account=email_account, message_id='1', thread_id='1', sender=sender,
+                                        sent_date=timezone.now(), subject='Text', body_text='Hello',
+                                        body_html='<p>Hello</p>', body_html_text='Hello'),
+            EmailMessage.objects.create(account=email_account, message_id='2', thread_id='1', sender=sender,
+                                        sent_date=timezone.now(), subject='Html', body_html='<p>Hi</p>',
+                                        body_html_text='Hi'),
+            # A message of which the text of the html body wasn't stored yet.
+            EmailMessage.objects.create(account=email_account, message_id='3', thread_id='1', sender=sender,
+                                        sent_date=timezone.now(), subject='Old', body_html='<p>Old</p>'),
+        ]
+        messages[0].labels.add(inbox)
+        messages[0].received_by.add(Recipient.objects.create(name='Lily', email_address='lily@example.com'))
+        messages[1].received_by_cc.add(Recipient.objects.create(name=None, email_address='cc@example.com'))
+
+        self.assertDocumentsEqual(EmailMessageMapping, [message.pk for message in messages])
+        self.assertEqual(EmailMessageMapping.extract_document(messages[2].pk, messages[2])['body'], 'Old')
+
+        # The html body is deferred, so it's only read for messages without the text of it.
+        instance = EmailMessageMapping.prepare_batch(EmailMessage.objects.filter(pk=messages[1].pk))[0]
+        self.assertNotIn('body_html', instance.__dict__)
+
+
+class IndexQuerysetTests(TestCase):
+    def test_tenant(self):
+        """
+        Test that the queryset of a tenant only contains the instances of that tenant.
+        """
+        contact = ContactWithEmailFactory.create(tenant=TenantFactory.create())
+        other_tenant = TenantFactory.create()
+
+        self.assertIn(contact, get_index_queryset(ContactMapping, tenant_id=contact.tenant_id))
+        self.assertNotIn(contact, get_index_queryset(ContactMapping, tenant_id=other_tenant.pk))
+
+
+class SerializationTests(TestCase):
+    def test_prepare_dict(self):
+        """
+        Test that empty values are left out, dates are normalized and lists are deduplicated.
+        """
+        document = prepare_dict({
+            'name': 'Lily', 'empty': '', 'none': None, 'list': [], 'dict': {}, 'zero': 0, 'false': False,
+            'date': date(2016, 11, 1), 'tags': ['a', 'b', 'a'], 'addresses': [{'id': 1}, {'id': 1}],
+        })
+
+        self.assertEqual(document, {
+            'name': 'Lily', 'zero': 0, 'false': False, 'date': '2016-11-01T00:00:00.000000+00:00',
+            'tags': document['tags'], 'addresses': [{'id': 1}, {'id': 1}],
+        })
+        self.assertEqual(sorted(document['tags']), ['a', 'b'])
+
+    def test_encode_action(self):
+        """
+        Test that bulk actions are encoded to an action line and, except for deletes, a document line.
+        """
+        lines = encode_action({'_index': 'main_index', '_type': 'contacts_contact', '_id': 1, '_source': {'id': 1}})
+        self.assertEqual([json.loads(line) for line in lines], [
+            {'index': {'_index': 'main_index', '_type': 'contacts_contact', '_id': 1}},
+            {'id': 1},
+        ])
+
+        lines = encode_action({'_op_type': 'delete', '_index': 'main_index', '_type': 'contacts_contact', '_id': 1})
+        self.assertEqual([json.loads(line) for line in lines], [
+            {'delete': {'_index': 'main_index', '_type': 'contacts_contact', '_id': 1}},
+        ])
+
+
+class BulkIndexerTests(TestCase):
+    def get_action(self, pk, op_type='index'):
+        return {'_op_type': op_type, '_index': 'main_index', '_type': 'contacts_contact', '_id': pk,
+                '_source': {'id': pk}}
+
+    def get_ids(self, body):
+        return [json.loads(line).values()[0]['_id'] for line in body.splitlines() if '_index' in line]
+
+    def test_retry(self):
+        """
+        Test that only the items that were rejected because the bulk queue was full are sent again.
+        """
+        es_client = StubElasticsearch(
+            {'items': [{'index': {'status': 201}}, {'index': {'status': 429}}, {'delete': {'status': 404}}]},
+            {'items': [{'index': {'status': 201}}]},
+        )
+        indexer = BulkIndexer(es_client=es_client, max_retries=1)
+        for action in (self.get_action(1), self.get_action(2), self.get_action(3, op_type='delete')):
+            indexer.add(action)
+
+        self.assertEqual(indexer.close(), (3, []))
+        self.assertEqual([self.get_ids(kwargs['body']) for method, kwargs in es_client.requests], [[1, 2, 3], [2]])
+
+    def test_errors(self):
+        """
+        Test that items that failed are raised on close, and that progress is not reported past them.
+        """
+        done = []
+        es_client = StubElasticsearch(
+            {'items': [{'index': {'status': 400, 'error': 'MapperParsingException'}}]},
+            {'items': [{'index': {'status': 201}}]},
+        )
+        indexer = BulkIndexer(es_client=es_client, max_docs=1, max_in_flight=1, raise_on_error=True,
+                              done_callback=lambda action: done.append(action['_id']))
+        indexer.add(self.get_action(1))
+        indexer.add(self.get_action(2))
+
+        with self.assertRaises(BulkIndexError) as context:
+            indexer.close()
+        self.assertEqual(context.exception.errors, [{'index': {'status': 400, 'error': 'MapperParsingException'}}])
+        self.assertEqual(done, [])
+
+    def test_done_callback(self):
+        """
+        Test that progress is reported in the order the actions were added, also when a later request is done first.
+        """
+        done = []
+        reported = []
+
+        def respond(body):
+            if self.get_ids(body) == [1]:
+                # Wait for the second request to be done.
+                deadline = time.time() + 5
+                while 1 not in indexer.done and time.time() < deadline:
+                    time.sleep(0.01)
+                reported.append(list(done))
+            return {'items': [{'index': {'status': 201}}]}
+
+        indexer = BulkIndexer(es_client=StubElasticsearch(respond, respond), max_docs=1, max_in_flight=2,
+                              done_callback=lambda action: done.append(action['_id']))
+        indexer.add(self.get_action(1))
+        indexer.add(self.get_action(2))
+
+        self.assertEqual(indexer.close(), (2, []))
+        # The second request was done, but it was only reported after the first one.
+        self.assertEqual(reported, [[]])
+        self.assertEqual(done, [1, 2])
+
+
+class IndexCommandTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.command = IndexCommand()
+        self.command.stdout = StringIO()
+        self.command.stderr = StringIO()
+
+    def test_pk_ranges(self):
+        """
+        Test that the pks are split in adjacent ranges, four per worker, which cover every instance.
+        """
+        accounts = AccountFactory.create_batch(16)
+        queryset = Account.objects.filter(pk__in=[account.pk for account in accounts])
+        pk_min, pk_max = accounts[0].pk, accounts[-1].pk
+
+        self.command.workers = 2
+        pk_ranges = self.command.get_pk_ranges(queryset)
+        self.assertEqual(len(pk_ranges), 8)
+        self.assertEqual((pk_ranges[0][0], pk_ranges[-1][1]), (pk_min, pk_max + 1))
+        self.assertTrue(all(pk_to == next_from for (pk_from, pk_to), (next_from, next_to)
+                            in zip(pk_ranges, pk_ranges[1:])))
+        self.assertEqual(sum(queryset.filter(pk__gte=pk_from, pk__lt=pk_to).count()
+                             for pk_from, pk_to in pk_ranges), 16)
+
+        # More ranges than instances.
+        self.command.workers = 4
+        self.assertEqual(self.command.get_pk_ranges(queryset.filter(pk__lte=pk_min + 1)), [
+            (pk_min, pk_min + 1), (pk_min + 1, pk_min + 2),
+        ])
+        self.assertEqual(self.command.get_pk_ranges(queryset.none()), [])
+
+    def test_verify_index(self):
+        """
+        Test that missing documents are indexed and extra documents removed, comparing the ids in pk order.
+        """
+        contacts = ContactFactory.create_batch(3)
+        self.command.es = StubElasticsearch(
+            scroll_response([contacts[0].pk, contacts[2].pk, contacts[2].pk + 1]),
+            scroll_response([]),
+            bulk_response,
+            bulk_response,
+            {},
+            {'count': 3},
+        )
+        self.command.verify_index(ContactMapping, 'index_1', chunksize=2)
+
+        self.assertIn('Fixed 1 missing and 1 extra documents', self.command.stdout.getvalue())
+        self.assertEqual(get_bulk_ids(self.command.es), [
+            ('delete', contacts[2].pk + 1), ('index', contacts[1].pk),
+        ])
+
+    def test_disable_refresh(self):
+        """
+        Test that the refresh interval to restore is the one of the index, unless it was never restored.
+        """
+        self.command.es = StubElasticsearch(
+            {'index_1': {'settings': {'index.refresh_interval': '30s'}}},
+            {},
+            {'index_1': {'settings': {'index.refresh_interval': '-1'}}},
+            {},
+            {'index_1': {'settings': {}}},
+            {},
+        )
+        self.assertEqual(self.command.disable_refresh('index_1'), '30s')
+        self.assertEqual(self.command.disable_refresh('index_1'), '1s')
+        self.assertEqual(self.command.disable_refresh('index_1'), '1s')
+        self.assertEqual([kwargs['body'] for method, kwargs in self.command.es.requests if method == 'put_settings'],
+                         [{'index': {'refresh_interval': '-1'}}] * 3)
+
+    def test_resume(self):
+        """
+        Test that the positions of a run are kept until it finishes, and that a lost checkpoint is reported.
+        """
+        checkpoint = IndexCheckpoint(ContactMapping)
+        checkpoint.start('index_1')
+        checkpoint.set_last_pk(10)
+        checkpoint.set_pk_ranges([(1, 100), (100, 200)])
+        checkpoint.set_last_pk(150, 100)
+
+        checkpoint = IndexCheckpoint(ContactMapping)
+        self.assertTrue(checkpoint.is_resumable())
+        self.assertEqual(checkpoint.index_base, 'index_1')
+        self.assertEqual(checkpoint.pk_ranges, [(1, 100), (100, 200)])
+        self.assertEqual((checkpoint.get_last_pk(), checkpoint.get_last_pk(1), checkpoint.get_last_pk(100)),
+                         (10, 0, 150))
+
+        self.command.es = StubElasticsearch(True, False)
+        self.assertEqual(self.command.get_resume_index(ContactMapping, checkpoint),
+                         get_index_name('index_1', ContactMapping))
+        self.assertIsNone(self.command.get_resume_index(ContactMapping, checkpoint))
+        self.assertIn('does not exist anymore', self.command.stderr.getvalue())
+
+        watermark = checkpoint.watermark
+        checkpoint.finish()
+        checkpoint = IndexCheckpoint(ContactMapping)
+        self.assertFalse(checkpoint.is_resumable())
+        self.assertEqual(checkpoint.watermark, watermark)
+        self.assertEqual((checkpoint.get_last_pk(), checkpoint.get_last_pk(100)), (0, 0))
+
+        # The checkpoint was evicted from the cache.
+        cache.clear()
+        self.command.stderr = StringIO()
+        self.assertIsNone(self.command.get_resume_index(ContactMapping, IndexCheckpoint(ContactMapping)))
+        self.assertIn('no checkpoint of a previous run was found', self.command.stderr.getvalue())
+
+
+class DriftTests(TestCase):
+    def test_compare_entries(self):
+        """
+        Test that merging the sorted entries of the database and the index finds every difference.
+        """
+        database_entries = [(1, 'a'), (2, 'b'), (4, 'd'), (6, 'f')]
+        index_entries = [(2, 'b'), (3, 'c'), (4, 'x'), (5, 'e')]
+
+        self.assertEqual(list(compare_entries(database_entries, index_entries)), [
+            (MISSING, 1),
+            (ORPHANED, 3),
+            (STALE, 4),
+            (ORPHANED, 5),
+            (MISSING, 6),
+        ])
+
+    def test_find_drift(self):
+        """
+        Test that the instances of a tenant are compared with the scanned documents, and that drift is repaired.
+        """
+        contacts = ContactFactory.create_batch(3, tenant=TenantFactory.create())
+        tenant_id = contacts[0].tenant_id
+        pages = [
+            scroll_response([contacts[0].pk], modified=contacts[0].modified.isoformat()),
+            scroll_response([contacts[1].pk, contacts[2].pk + 1], modified='2015-01-01T00:00:00+00:00'),
+            scroll_response([]),
+        ]
+
+        es_client = StubElasticsearch(*pages)
+        with stub_indexing(es_client):
+            self.assertEqual(find_drift(ContactMapping, tenant_id=tenant_id, chunksize=2), {
+                MISSING: 1, STALE: 1, ORPHANED: 1,
+            })
+        body = es_client.requests[0][1]['body']
+        self.assertEqual(body['query'], {'filtered': {'filter': {'term': {'tenant': tenant_id}}}})
+        self.assertEqual(body['sort'], [{'id': 'asc'}])
+
+        # The pks are repaired per chunk, while the documents are scanned.
+        es_client = StubElasticsearch(pages[0], pages[1], bulk_response, pages[2], bulk_response)
+        with self.settings(ES_DISABLED=False), stub_indexing(es_client):
+            find_drift(ContactMapping, tenant_id=tenant_id, repair=True, chunksize=2)
+        self.assertEqual(get_bulk_ids(es_client), [
+            ('delete', contacts[2].pk + 1), ('index', contacts[1].pk), ('index', contacts[2].pk),
+        ])
+
+
+@override_settings(ES_FINGERPRINTS=True)
+class FingerprintTests(TestCase):
+    def setUp(self):
+        save_fingerprints({get_key('contacts_contact', 1): None})
+
+    def test_skip_unchanged(self):
+        """
+        Test that a document is only written again when its content changed.
+        """
+        action = {'_index': 'main_index', '_type': 'contacts_contact', '_id': 1, '_source': {'id': 1, 'tags': [1, 2]}}
+
+        actions, fingerprints = skip_unchanged([action])
+        self.assertEqual(actions, [action])
+        save_fingerprints(fingerprints)
+
+        reordered = dict(action, _source={'id': 1, 'tags': [2, 1]})
+        self.assertEqual(skip_unchanged([reordered])[0], [])
+
+        changed = dict(action, _source={'id': 1, 'tags': [2]})
+        self.assertEqual(skip_unchanged([changed])[0], [changed])
+
+    def test_unindex_by_query(self):
+        """
+        Test that removing the documents of a tenant forgets their fingerprints, so they are written again.
+        """
+        contact = ContactFactory()
+        key = get_key('contacts_contact', contact.pk)
+        save_fingerprints({key: 'fingerprint'})
+
+        es_client = StubElasticsearch({'count': 1}, {})
+        with stub_indexing(es_client):
+            self.assertEqual(unindex_by_query(ContactMapping, tenant_id=contact.tenant_id), 1)
+
+        self.assertIsNone(cache.get(key))
+        self.assertEqual([method for method, kwargs in es_client.requests], ['count', 'delete_by_query'])
+
+    def test_fingerprint(self):
+        """
+        Test that the fingerprint does not depend on the order of keys and list items.
+        """
+        self.assertEqual(
+            get_fingerprint({'name': 'Lily', 'email_addresses': [{'id': 1}, {'id': 2}]}),
+            get_fingerprint({'email_addresses': [{'id': 2}, {'id': 1}], 'name': 'Lily'}),
+        )
+        self.assertNotEqual(get_fingerprint({'name': 'Lily'}), get_fingerprint({'name': 'Lilly'}))
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        # Write the measurements of earlier tests, e.g. of the bulk indexer, before resetting them.
+        flush_metrics()
+        reset_metrics('contacts_contact')
+
+    def test_record(self):
+        """
+        Test that measurements are added to the counters and histogram of their mapping and stage.
+        """
+        record('contacts_contact', BULK, 0.002, docs=10, size=1000)
+        record('contacts_contact', BULK, 0.2, docs=10, size=3000)
+        flush_metrics()
+
+        values = get_metrics('contacts_contact')[BULK]
+        self.assertEqual((values['calls'], values['docs'], values['bytes']), (2, 20, 4000))
+        self.assertEqual(values['micros'], 202000)
+        self.assertEqual(get_percentile(values, 0.5), 5)
+        self.assertEqual(get_percentile(values, 0.95), 500)
+
+    def test_flush_interval(self):
+        """
+        Test that recording never writes to the cache, and that the measurements are flushed once per interval.
+        """
+        record('contacts_contact', BULK, 0.002, docs=10)
+        self.assertEqual(get_metrics('contacts_contact')[BULK]['calls'], 0)
+
+        with self.settings(ES_METRICS_FLUSH_INTERVAL=60):
+            flush_metrics_if_due()
+            self.assertEqual(get_metrics('contacts_contact')[BULK]['calls'], 0)
+
+            metrics.last_flush[0] -= 60
+            flush_metrics_if_due()
+            self.assertEqual(get_metrics('contacts_contact')[BULK]['calls'], 1)
+
+
+class LilySearchTests(TestCase):
+    def test_aggregate_raw(self):
+        """
+        Test that aggregations are added to the search body, next to the steps elasticutils knows.
+        """
+        search = LilyS().filter_raw({'term': {'tenant': 1}}).aggregate_raw(items={'terms': {'field': 'name_flat'}})
+        body = search.order_by('name')[10:20].build_search()
+
+        self.assertEqual(body['aggs'], {'items': {'terms': {'field': 'name_flat'}}})
+        self.assertEqual(body['filter'], {'term': {'tenant': 1}})
+        self.assertEqual((body['sort'], body['from'], body['size']), (['name'], 10, 10))
+
+    def test_source_filter(self):
+        """
+        Test that only the return fields are fetched, and that large fields are only fetched when asked for.
+        """
+        search = LilySearch(tenant_id=1, model_type='email_emailmessage')
+        self.assertEqual(search.get_source_filter(['sender_email', 'message_id']), {
+            'include': ['id', 'message_id', 'sender_email'],
+        })
+        self.assertEqual(search.get_source_filter(['body']), {'include': ['body', 'id']})
+        self.assertEqual(search.get_source_filter(), {'exclude': ['body']})
+        self.assertEqual(LilySearch(tenant_id=1, model_type='contacts_contact').get_source_filter(), {'exclude': []})
+
+        body = LilyS().source(include=['id', 'subject']).build_search()
+        self.assertEqual(body['_source'], {'include': ['id', 'subject']})
+        self.assertNotIn('_source', LilyS().source(exclude=[]).build_search())
+
+    def test_cursor(self):
+        """
+        Test that a cursor continues after the last result of the previous page, ordered by id on equal values.
+        """
+        cursor = encode_cursor('-sent_date', [1420070400000, 12], 40)
+        self.assertEqual(decode_cursor('-sent_date', cursor), ([1420070400000, 12], 40))
+        self.assertRaises(ValueError, decode_cursor, 'sent_date', cursor)
+        self.assertRaises(ValueError, decode_cursor, '-sent_date', 'invalid')
+
+        search = LilySearch(tenant_id=1, model_type='email_emailmessage', sort='-sent_date', size=20, cursor=cursor)
+        body = search.search.build_search()
+        self.assertEqual((body['sort'], body['size']), ([{'sent_date': 'desc'}, 'id'], 20))
+        self.assertNotIn('from', body)
+        self.assertEqual(search.raw_filters[-1], {
+            'or': [
+                {'range': {'sent_date': {'lt': 1420070400000}}},
+                {'and': [{'term': {'sent_date': 1420070400000}}, {'range': {'id': {'gt': 12}}}]},
+                {'missing': {'field': 'sent_date'}},
+            ]
+        })
+
+        # The sort value of results without a sent date.
+        cursor = encode_cursor('-sent_date', [-2 ** 63, 12])
+        search = LilySearch(tenant_id=1, sort='-sent_date', cursor=cursor)
+        self.assertEqual(search.raw_filters[-1], {
+            'and': [{'missing': {'field': 'sent_date'}}, {'range': {'id': {'gt': 12}}}],
+        })
+
+    def test_cursor_pages(self):
+        """
+        Test that the next cursor continues after the last result of the page, with the total of the first page.
+        """
+        def page_response(hits, total):
+            response = search_response([pk for pk, name in hits], total)
+            for hit, (pk, name) in zip(response['hits']['hits'], hits):
+                hit['sort'] = [name, pk]
+            return response
+
+        es_client = StubElasticsearch(
+            page_response([(3, 'a'), (1, 'b')], total=3),
+            # The results of the first page are filtered out, so they aren't counted either.
+            page_response([(2, 'c')], total=1),
+        )
+        with self.settings(ES_DISABLED=False, ES_RESULT_CACHE=False), stub_search(es_client):
+            search = LilySearch(tenant_id=1, model_type='accounts_account', sort='name', size=2, cursor='')
+            hits, facets, total, took = search.do_search(['id'])
+            self.assertEqual(([hit['id'] for hit in hits], total), ([3, 1], 3))
+            self.assertEqual(decode_cursor('name', search.next_cursor), (['b', 1], 3))
+
+            search = LilySearch(tenant_id=1, model_type='accounts_account', sort='name', size=2,
+                                cursor=search.next_cursor)
+            hits, facets, total, took = search.do_search(['id'])
+            self.assertEqual(([hit['id'] for hit in hits], total), ([2], 3))
+            self.assertIsNone(search.next_cursor)
+
+        body = es_client.requests[1][1]['body']
+        self.assertEqual((body['sort'], body['size']), (['name', 'id'], 2))
+        cursor_filter = {'and': [{'term': {'name': 'b'}}, {'range': {'id': {'gt': 1}}}]}
+        self.assertIn(cursor_filter, body['filter']['and'][-1]['or'])
+
+    def test_cursor_query(self):
+        """
+        Test that a query has to be sorted to paginate it with a cursor, instead of ordering it by id.
+        """
+        request = RequestFactory().get('/', {'q': 'lily', 'cursor': ''})
+        request.user = LilyUserFactory()
+        self.assertEqual(SearchView().get(request).status_code, 400)
+
+    def test_get_facet(self):
+        """
+        Test that buckets are returned as facets, with the latest usage of tags.
+        """
+        search = LilySearch(tenant_id=1, model_type='tags_tag')
+        bucket = {
+            'key': 'Lily',
+            'doc_count': 3,
+            'last_used': {'value': 1420070400000.0, 'value_as_string': '2015-01-01T00:00:00.000Z'},
+        }
+        self.assertEqual(search.get_facet(bucket), {
+            'term': 'Lily',
+            'count': 3,
+            'last_used': '2015-01-01T00:00:00.000Z',
+        })
+        self.assertEqual(search.get_facet({'key': 'Lily', 'doc_count': 3}), {'term': 'Lily', 'count': 3})
+
+
+class MultiSearchTests(TestCase):
+    def setUp(self):
+        self.user = LilyUserFactory()
+
+    def get_view(self, view_class):
+        view = view_class()
+        view.request = RequestFactory().get('/')
+        view.request.user = self.user
+        return view
+
+    def test_multi_search(self):
+        """
+        Test that the searches are sent in one request, and that a failed search has no results.
+        """
+        searches = [LilySearch(tenant_id=1, model_type=model_type) for model_type in ('accounts_account', 'tags_tag')]
+        es_client = StubElasticsearch(msearch_response(
+            search_response([3, 1], total=5),
+            {'error': 'SearchPhaseExecutionException[Failed to execute phase [query]]'},
+        ))
+        with self.settings(ES_DISABLED=False, ES_RESULT_CACHE=False), stub_search(es_client):
+            results = LilySearch.multi_search(searches, ['id'])
+
+        self.assertEqual(results, [([{'id': 3}, {'id': 1}], None, 5, 1), ([], None, 0, 0)])
+        self.assertEqual(len(es_client.requests), 1)
+        body = es_client.requests[0][1]['body']
+        self.assertEqual([line['type'] for line in body[::2]], [['accounts_account'], ['tags_tag']])
+        self.assertEqual(body[1]['_source'], {'include': ['id']})
+
+    def test_search_tiers(self):
+        """
+        Test that the hits of the first search with hits are returned.
+        """
+        searches = [LilySearch(tenant_id=1, model_type='accounts_account') for tier in range(3)]
+        es_client = StubElasticsearch(
+            msearch_response(search_response([]), search_response([2]), search_response([3])),
+            msearch_response(search_response([]), search_response([]), search_response([])),
+        )
+        with self.settings(ES_DISABLED=False, ES_RESULT_CACHE=False), stub_search(es_client):
+            self.assertEqual(LilySearch.search_tiers(searches, ['id']), (1, [{'id': 2}]))
+            self.assertEqual(LilySearch.search_tiers(searches, ['id']), (None, []))
+
+    def test_email_address(self):
+        """
+        Test that an email address is searched as a contact, an account or else the domain of an account.
+        """
+        view = self.get_view(EmailAddressSearchView)
+        es_client = StubElasticsearch(msearch_response(
+            search_response([]), search_response([]), search_response([4]),
+        ))
+        with self.settings(ES_DISABLED=False, ES_RESULT_CACHE=False), stub_search(es_client):
+            self.assertEqual(view._search('info@example.com', False), {
+                'type': 'account',
+                'complete': False,
+                'data': {'id': 4},
+            })
+
+        body = es_client.requests[0][1]['body']
+        self.assertEqual([line['type'] for line in body[::2]], [
+            ['contacts_contact'], ['accounts_account'], ['accounts_account'],
+        ])
+        self.assertIn('email_addresses.email_address:\\"info@example.com\\"', json.dumps(body[1]))
+        self.assertIn('second_level_domain:\\"example\\"', json.dumps(body[5]))
+
+    def test_free_mail_address(self):
+        """
+        Test that a free mail address is only searched as a contact.
+        """
+        view = self.get_view(EmailAddressSearchView)
+        es_client = StubElasticsearch(msearch_response(search_response([5])))
+        with self.settings(ES_DISABLED=False, ES_RESULT_CACHE=False), stub_search(es_client):
+            self.assertEqual(view._search('lily@gmail.com', True), {'type': 'contact', 'data': {'id': 5}})
+        self.assertEqual([line['type'] for line in es_client.requests[0][1]['body'][::2]], [['contacts_contact']])
+
+    def test_domain(self):
+        """
+        Test that an address without a local part is only searched as an account.
+        """
+        view = self.get_view(EmailAddressSearchView)
+        es_client = StubElasticsearch(msearch_response(search_response([6]), search_response([7])))
+        with self.settings(ES_DISABLED=False, ES_RESULT_CACHE=False), stub_search(es_client):
+            self.assertEqual(view._search('@example.com', False), {
+                'type': 'account',
+                'complete': True,
+                'data': {'id': 6},
+            })
+        self.assertEqual([line['type'] for line in es_client.requests[0][1]['body'][::2]], [
+            ['accounts_account'], ['accounts_account'],
+        ])
+
+    def test_phone_number(self):
+        """
+        Test that a number that isn't stored normalized is searched as an account, or else the account of a contact.
+        """
+        view = self.get_view(PhoneNumberSearchView)
+        contact_response = search_response([8])
+        contact_response['hits']['hits'][0]['_source']['accounts'] = [{'id': 9, 'name': 'Lily'}]
+        es_client = StubElasticsearch(
+            msearch_response(search_response([10]), search_response([])),
+            msearch_response(search_response([]), contact_response),
+            # A contact without an account.
+            msearch_response(search_response([]), search_response([8])),
+        )
+        with self.settings(ES_DISABLED=False, ES_RESULT_CACHE=False), stub_search(es_client):
+            self.assertEqual(view._search_number('+31612345678')['data']['id'], 10)
+            self.assertEqual(view._search_number('+31612345678'), {'data': {'id': 9, 'name': 'Lily'}})
+            self.assertEqual(view._search_number('+31612345678'), {})
+
+        body = es_client.requests[0][1]['body']
+        self.assertEqual([line['type'] for line in body[::2]], [['accounts_account'], ['contacts_contact']])
+
+
+class PhoneNumberSearchTests(TestCase):
+    def test_find_number(self):
+        """
+        Test that callers are found by their exact phone number, accounts before the accounts of contacts.
+        """
+        account = AccountFactory()
+        user = LilyUserFactory(tenant=account.tenant)
+        view = PhoneNumberSearchView()
+        view.request = RequestFactory().get('/')
+        view.request.user = user
+
+        contact = ContactFactory(tenant=account.tenant)
+        FunctionFactory(tenant=account.tenant, account=account, contact=contact)
+        contact.phone_numbers.add(PhoneNumberFactory(tenant=account.tenant, number='0612345678'))
+        self.assertEqual(view._find_number('+31612345678'), {
+            'data': {'id': account.id, 'name': account.name, 'customer_id': account.customer_id},
+        })
+
+        other_account = AccountFactory(tenant=account.tenant)
+        other_account.phone_numbers.add(PhoneNumberFactory(tenant=account.tenant, number='+31612345678'))
+        self.assertEqual(view._find_number('+31612345678')['data']['id'], other_account.id)
+
+        self.assertIsNone(view._find_number('+31687654321'))
+
+
+class FilterCacheTests(TestCase):
+    def setUp(self):
+        # The cached results are keyed by ids, which repeat across test databases.
+        cache.clear()
+
+    def test_account_email_addresses(self):
+        """
+        Test that the email addresses of an account and its contacts are cached until they change.
+        """
+        account = AccountFactory()
+        account.email_addresses.add(EmailAddressFactory(tenant=account.tenant, email_address='info@example.com'))
+        contact = ContactFactory(tenant=account.tenant)
+        function = FunctionFactory(tenant=account.tenant, account=account, contact=contact)
+        self.assertEqual(get_account_email_addresses(account.id), ['info@example.com'])
+
+        email_address = EmailAddressFactory(tenant=account.tenant, email_address='Lily@Example.com')
+        contact.email_addresses.add(email_address)
+        self.assertEqual(get_account_email_addresses(account.id), ['info@example.com', 'lily@example.com'])
+
+        email_address.email_address = 'lily@example.org'
+        email_address.save()
+        self.assertEqual(get_account_email_addresses(account.id), ['info@example.com', 'lily@example.org'])
+
+        function.delete()
+        self.assertEqual(get_account_email_addresses(account.id), ['info@example.com'])
+
+        cache.set(get_exact_email_fields_key(), True)
+        search = LilySearch(tenant_id=account.tenant_id)
+        with self.settings(ES_DISABLED=False):
+            search.account_related(account.id)
+        self.assertEqual(search.raw_filters[-1], {
+            'or': [
+                {'terms': {'sender_email.exact': ['info@example.com']}},
+                {'terms': {'received_by_email.exact': ['info@example.com']}},
+                {'terms': {'received_by_cc_email.exact': ['info@example.com']}},
+            ]
+        })
+
+        # Until the email messages are reindexed with the exact subfields, the addresses are searched as before.
+        cache.set(get_exact_email_fields_key(), False)
+        search = LilySearch(tenant_id=account.tenant_id)
+        with self.settings(ES_DISABLED=False):
+            search.account_related(account.id)
+        self.assertEqual(search.raw_filters[-1]['query']['query_string']['query'], (
+            'sender_email:("info@example.com") OR received_by_email:("info@example.com") OR '
+            'received_by_cc_email:("info@example.com")'
+        ))
+
+    def test_exact_email_fields(self):
+        """
+        Test that the exact subfields are looked up in the mapping of the live index.
+        """
+        def mapping_response(fields):
+            return {
+                'main_index_1.email_emailmessage': {
+                    'mappings': {
+                        'email_emailmessage': {
+                            'properties': {
+                                'sender_email': {'type': 'string', 'fields': fields},
+                                'received_by_email': {'type': 'string', 'fields': fields},
+                                'received_by_cc_email': {'type': 'string', 'fields': fields},
+                            }
+                        }
+                    }
+                }
+            }
+
+        self.assertTrue(load_has_exact_email_fields(StubElasticsearch(mapping_response({'exact': {}}))))
+        self.assertFalse(load_has_exact_email_fields(StubElasticsearch(mapping_response({}))))
+        self.assertFalse(load_has_exact_email_fields(StubElasticsearch(TransportError(500, 'error'))))
+
+    def test_visible_email_accounts(self):
+        """
+        Test that the email accounts a user can see are cached until who can see them changes.
+        """
+        owner = LilyUserFactory()
+        user = LilyUserFactory(tenant=owner.tenant)
+        email_account = EmailAccount.objects.create(tenant=owner.tenant, owner=owner, email_address='a@example.com')
+        other_account = EmailAccount.objects.create(tenant=owner.tenant, owner=owner, email_address='b@example.com')
+        self.assertEqual(get_visible_email_account_ids(owner), [email_account.id, other_account.id])
+        self.assertEqual(get_visible_email_account_ids(user), [])
+
+        email_account.shared_with_users.add(user)
+        self.assertEqual(get_visible_email_account_ids(user), [email_account.id])
+
+        SharedEmailConfig.objects.create(tenant=owner.tenant, email_account=email_account, user=user, is_hidden=True)
+        self.assertEqual(get_visible_email_account_ids(user), [])
+
+        other_account.public = True
+        other_account.save()
+        self.assertEqual(get_visible_email_account_ids(user), [other_account.id])
+
+        # Saving an email account without changing who can see it, e.g. when synchronizing, keeps the cache.
+        generation = cache.get(get_email_accounts_generation_key(owner.tenant_id))
+        other_account.history_id = 1
+        other_account.save()
+        self.assertEqual(cache.get(get_email_accounts_generation_key(owner.tenant_id)), generation)
+
+        search = LilySearch(tenant_id=owner.tenant_id)
+        search.user_email_related(user)
+        self.assertEqual(search.raw_filters[-1], {'terms': {'account': [other_account.id]}})
+
+
+@override_settings(ES_RESULT_CACHE=True)
+class ResultCacheTests(TestCase):
+    def setUp(self):
+        # Forget the generations, writes and counts of other tests.
+        cache.clear()
+
+    def test_generations(self):
+        """
+        Test that results are cached until the tenant or all tenants are written to, and not right after a write.
+        """
+        request = {'body': {'query': {'match_all': {}}}}
+        results, key = get_cached_results(1, 'contacts_contact', ['contacts_contact'], request)
+        self.assertIsNone(results)
+        cache_results(key, ([{'id': 1}], None, 1, 3))
+
+        results, key = get_cached_results(1, 'contacts_contact', ['contacts_contact'], request)
+        self.assertEqual(results, ([{'id': 1}], None, 1, 3))
+        self.assertEqual(get_counts('contacts_contact'), {HITS: 1, MISSES: 1})
+
+        # Results of other tenants and types stay cached.
+        bump_generations([{'_type': 'contacts_contact', '_id': 1, '_source': {'tenant': 2}}])
+        bump_generations([{'_type': 'accounts_account', '_id': 1, '_source': {'tenant': 1}}])
+        results, key = get_cached_results(1, 'contacts_contact', ['contacts_contact'], request)
+        self.assertIsNotNone(results)
+
+        # Delete actions don't have a tenant, so they invalidate the results of all tenants.
+        bump_generations([{'_op_type': 'delete', '_type': 'contacts_contact', '_id': 1}])
+        results, key = get_cached_results(1, 'contacts_contact', ['contacts_contact'], request)
+        self.assertIsNone(results)
+        # The write may not be searchable yet.
+        self.assertIsNone(key)
+
+    def test_direct_writes(self):
+        """
+        Test that writes that don't use the bulk api invalidate the results of the tenant as well.
+        """
+        contact = ContactFactory()
+        request = {'body': {'query': {'match_all': {}}}}
+        doc_types = ['contacts_contact']
+
+        def cache_contacts():
+            generations, settled = get_generations(contact.tenant_id, doc_types)
+            cache_results(get_cache_key(contact.tenant_id, 'contacts_contact', generations, request), 'results')
+
+        es_client = StubElasticsearch({'created': True}, {'found': True})
+        with self.settings(ES_DISABLED=False), stub_indexing(es_client):
+            cache_contacts()
+            update_in_index(contact, ContactMapping, defer=False)
+            self.assertIsNone(get_cached_results(contact.tenant_id, 'contacts_contact', doc_types, request)[0])
+
+            cache_contacts()
+            remove_from_index(contact, ContactMapping, defer=False)
+            self.assertIsNone(get_cached_results(contact.tenant_id, 'contacts_contact', doc_types, request)[0])
+
+        self.assertEqual([method for method, kwargs in es_client.requests], ['index', 'delete'])
+
+
+class DualWriteTests(TestCase):
+    def test_bulk_actions(self):
+        """
+        Test that updates of the current index are repeated for the index the dual write alias points to.
+        """
+        alias = get_dual_write_alias(ContactMapping)
+        es_client = StubElasticsearch(
+            {},
+            {'acknowledged': True},
+            {'acknowledged': True},
+            {'index_1.contacts_contact': {'aliases': {alias: {}}}},
+        )
+        with self.settings(ES_DISABLED=False), stub_indexing(es_client):
+            dual_write.dual_write_indexes.clear()
+            self.assertEqual([action['_index'] for action in get_bulk_actions(ContactMapping, [(1, None)])], [
+                'main_index.contacts_contact',
+            ])
+
+            start_dual_write(ContactMapping, 'index_1')
+            self.assertEqual([action['_index'] for action in get_bulk_actions(ContactMapping, [(1, None)])], [
+                'main_index.contacts_contact',
+                'index_1.contacts_contact',
+            ])
+
+            stop_dual_write(ContactMapping)
+            # The alias is looked up again, like other processes do once per interval.
+            self.assertEqual(get_dual_write_index(ContactMapping), 'index_1.contacts_contact')
+            self.assertEqual(get_dual_write_index(ContactMapping), 'index_1.contacts_contact')
+
+        self.assertEqual([method for method, kwargs in es_client.requests], [
+            'get_aliases', 'put_alias', 'delete_alias', 'get_aliases',
+        ])
+        self.assertEqual(es_client.requests[1][1], {'index': 'index_1.contacts_contact', 'name': alias})
+
+
+class ElasticSearchFilterTests(TestCase):
+    def test_get_page(self):
+        """
+        Test that the page Elasticsearch should return follows the pagination of the view.
+        """
+        search_filter = ElasticSearchFilter()
+        view = AccountViewSet()
+        request = Request(RequestFactory().get('/api/accounts/', {'search': 'lily', 'page': 3, 'page_size': 20}))
+        self.assertEqual(search_filter.get_page(request, view), (40, 20))
+
+        request = Request(RequestFactory().get('/api/accounts/', {'search': 'lily', 'page': 'last'}))
+        self.assertEqual(search_filter.get_page(request, view), (0, 100))
+
+        view = AccountViewSet(pagination_class=None)
+        request = Request(RequestFactory().get('/api/accounts/', {'search': 'lily', 'limit': 5}))
+        self.assertEqual(search_filter.get_page(request, view), (0, 5))
+
+    def test_get_objects(self):
+        """
+        Test that the results are read with one query and keep the order of the search.
+        """
+        accounts = AccountFactory.create_batch(3)
+        results = ElasticSearchResults(
+            tenant_id=accounts[0].tenant_id,
+            model_type='accounts_account',
+            query='lily',
+            queryset=Account.objects.filter(id__in=[accounts[0].id, accounts[2].id]).prefetch_related('phone_numbers'),
+        )
+
+        with self.assertNumQueries(2):
+            objects = results.get_objects([accounts[2].id, accounts[1].id, accounts[0].id])
+        self.assertEqual(objects, [accounts[2], accounts[0]])
+
+    @override_settings(ES_DISABLED=True)
+    def test_disabled(self):
+        """
+        Test that there are no results without Elasticsearch.
+        """
+        results = ElasticSearchResults(tenant_id=1, model_type='accounts_account', query='lily', queryset=None)
+        self.assertEqual(results.count(), 0)
+        self.assertEqual(list(results), [])
+        self.assertEqual(results[0:10], [])
+
+
+class ElasticSearchListTests(TestCase):
+    def setUp(self):
+        tenant = TenantFactory.create()
+        user = LilyUser.objects.create_user(email='search@lily.com', password='password', tenant_id=tenant.id)
+        self.client.login(email=user.email, password='password')
+        self.accounts = AccountFactory.create_batch(3, tenant=tenant)
+        self.url = reverse('account-list')
+
+    def test_list(self):
+        """
+        Test that Elasticsearch counts the results and returns the page, which keeps the order of the search.
+        """
+        es_client = StubElasticsearch(search_response([self.accounts[2].id, self.accounts[0].id], total=7))
+        with self.settings(ES_DISABLED=False), stub_search(es_client):
+            response = self.client.get(self.url, {'search': 'name:lily', 'page': 2, 'page_size': 2})
+
+        self.assertEqual([account['id'] for account in response.data['results']], [
+            self.accounts[2].id, self.accounts[0].id,
+        ])
+        self.assertEqual(response.data['pagination']['total'], 7)
+        self.assertEqual(len(es_client.requests), 1)
+        body = es_client.requests[0][1]['body']
+        self.assertEqual((body['from'], body['size']), (2, 2))
+
+    def test_list_ordering(self):
+        """
+        Test that the database orders and counts the results when the list is ordered.
+        """
+        es_client = StubElasticsearch(search_response([self.accounts[0].id, self.accounts[2].id], total=7))
+        with self.settings(ES_DISABLED=False), stub_search(es_client):
+            response = self.client.get(self.url, {'search': 'name:lily', 'ordering': '-id'})
+
+        self.assertEqual([account['id'] for account in response.data['results']], [
+            self.accounts[2].id, self.accounts[0].id,
+        ])
+        self.assertEqual(response.data['pagination']['total'], 2)
+
+    def test_list_filter(self):
+        """
+        Test that the database filters and counts the results when the list is filtered.
+        """
+        es_client = StubElasticsearch(search_response([self.accounts[0].id, self.accounts[2].id], total=7))
+        with self.settings(ES_DISABLED=False), stub_search(es_client):
+            response = self.client.get(self.url, {'search': 'name:lily', 'id': self.accounts[2].id})
+
+        self.assertEqual([account['id'] for account in response.data['results']], [self.accounts[2].id])
+        self.assertEqual(response.data['pagination']['total'], 1)
@@ -1,9 +1,10 @@
-from django.http.response import HttpResponse
+from django.http.response import HttpResponse, HttpResponseBadRequest
 from django.views.generic.base import View
 
 import anyjson
 import freemail
-from lily.accounts.models import Website
+from lily.accounts.models import Account, Website
+from lily.contacts.models import Contact
 from lily.utils.functions import parse_phone_number
 from lily.utils.views.mixins import LoginRequiredMixin
 
@@ -21,8 +22,13 @@ class SearchView(LoginRequiredMixin, View):
         Returns:
             HttpResponse with JSON dict:
                 hits (list): dicts with search results per item
-                total (int): total number of results
+                total (int): total number of results, with a cursor the total of the first page
                 took (int): milliseconds Elastic search took to get the results
+                next_cursor (str): when the cursor parameter is given (empty for the first page),
+                    the cursor of the next page, None on the last page
+
+            A cursor requires a sort when searching with a query, because the results of a cursor
+            are ordered by id instead of by relevance when they're not sorted.
         """
         kwargs = {}
         model_type = request.GET.get('type')
@@ -38,6 +44,14 @@ class SearchView(LoginRequiredMixin, View):
         if size:
             kwargs['size'] = int(size)
 
+        query = request.GET.get('q', '').lower()
+
+        cursor = request.GET.get('cursor')
+        if cursor is not None:
+            if query and not sort:
+                return HttpResponseBadRequest('Searching with a query and a cursor requires a sort')
+            kwargs['cursor'] = cursor
+
         facet_field = request.GET.get('facet_field', '')
         facet_filter = request.GET.get('facet_filter', '')
 
@@ -53,16 +67,18 @@ class SearchView(LoginRequiredMixin, View):
             }
 
         # Passing arguments as **kwargs means we can use the defaults.
-        search = LilySearch(
-            tenant_id=request.user.tenant_id,
-            **kwargs
-        )
+        try:
+            search = LilySearch(
+                tenant_id=request.user.tenant_id,
+                **kwargs
+            )
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
 
         id_arg = request.GET.get('id', '')
         if id_arg:
             search.get_by_id(id_arg)
 
-        query = request.GET.get('q', '').lower()
         if query:
             search.query_common_fields(query)
 
@@ -90,6 +106,9 @@ class SearchView(LoginRequiredMixin, View):
 
         results = {'hits': hits, 'total': total, 'took': took}
 
+        if cursor is not None:
+            results['next_cursor'] = search.next_cursor
+
         if facets:
             results['facets'] = facets
 
@@ -100,101 +119,71 @@ class EmailAddressSearchView(LoginRequiredMixin, View):
 
     def get(self, request, *args, **kwargs):
         email_address = kwargs.get('email_address', None)
+        free_mail = freemail.is_free(email_address)
 
-        results = {}
+        results = self._search(email_address, free_mail)
 
-        # Only search for contacts if a full email is given.
-        if email_address.split('@')[0]:
-            # Search for contact with given email address.
-            results = self._search_contact(email_address)
-
-        # Don't continue search if we're dealing with a free email address.
-        if freemail.is_free(email_address):
+        # Don't search for accounts if we're dealing with a free email address.
+        if free_mail:
             results.update({
                 'free_mail': True,
             })
-        else:
-            # Search for account with given email address.
-            if not results:
-                results = self._search_account(email_address)
 
         return HttpResponse(anyjson.dumps(results), content_type='application/json; charset=utf-8')
 
-    def _search_contact(self, email_address):
+    def _search(self, email_address, free_mail):
         """
-        Search for contact with given email address.
+        Search for a contact with the given email address, or else an account with the email
+        address, or else an account with its domain. All searches are sent in one request.
 
         Args:
             email_address (string): string representation of an email address
+            free_mail (boolean): True to only search for a contact
 
         Returns:
             dict with search results or empty dict
         """
-        search = LilySearch(
-            tenant_id=self.request.user.tenant_id,
-            model_type='contacts_contact',
-            size=1,
-        )
-        # Try to find an contact with the full email address.
-        search.filter_query('email_addresses.email_address:"%s"' % email_address)
+        searches = []
+        results = []
 
-        hits, facets, total, took = search.do_search()
+        # Only search for contacts if a full email is given.
+        if email_address.split('@')[0]:
+            # Try to find an contact with the full email address.
+            searches.append(self._get_search('contacts_contact', 'email_addresses.email_address:"%s"' % email_address))
+            results.append({'type': 'contact'})
+
+        if not free_mail:
+            # Try to find an account with the full email address.
+            searches.append(self._get_search('accounts_account', 'email_addresses.email_address:"%s"' % email_address))
+            results.append({'type': 'account', 'complete': True})
+
+            if '@' in email_address:
+                # If no account with the full email address exist, use the domain for further searching.
+                domain = email_address.split('@')[1]
+                second_level_domain = Website(website=domain).second_level
+
+                # Try to find an account which contains the domain.
+                searches.append(self._get_search(
+                    'accounts_account',
+                    'email_addresses.email_address:"%s" OR second_level_domain:"%s"' % (domain, second_level_domain)
+                ))
+                results.append({'type': 'account', 'complete': False})
+
+        position, hits = LilySearch.search_tiers(searches)
         if hits:
-            return {
-                'type': 'contact',
-                'data': hits[0],
-            }
-        return {}
-
-    def _search_account(self, email_address):
-        """
-        Search for account with given email address.
+            results[position]['data'] = hits[0]
+            return results[position]
 
-        Args:
-            email_address (string): string representation of an email address
+        return {}
 
-        Returns:
-            dict with search results or empty dict
-        """
+    def _get_search(self, model_type, filterquery):
         search = LilySearch(
             tenant_id=self.request.user.tenant_id,
-            model_type='accounts_account',
+            model_type=model_type,
             size=1,
         )
-        # Try to find an account with the full email address.
-        search.filter_query('email_addresses.email_address:"%s"' % email_address)
-
-        hits, facets, total, took = search.do_search()
-        if hits:
-            return {
-                'type': 'account',
-                'data': hits[0],
-                'complete': True,
-            }
-        else:
-            search = LilySearch(
-                tenant_id=self.request.user.tenant_id,
-                model_type='accounts_account',
-                size=1,
-            )
-
-            # No account with the full email address exist, so use the domain for further searching.
-            domain = email_address.split('@')[1]
-            second_level_domain = Website(website=domain).second_level
-
-            # Try to find an account which contains the domain.
-            search.filter_query('email_addresses.email_address:"%s" OR second_level_domain:"%s"' %
-                                (domain, second_level_domain))
-
-            hits, facets, total, took = search.do_search()
-            if hits:
-                return {
-                    'type': 'account',
-                    'data': hits[0],
-                    'complete': False,
-                }
-
-        return {}
+        search.filter_query(filterquery)
+        return search
 
 
 class WebsiteSearchView(LoginRequiredMixin, View):
@@ -238,36 +227,75 @@ class PhoneNumberSearchView(LoginRequiredMixin, View):
         return HttpResponse(anyjson.dumps(results), content_type='application/json; charset=utf-8')
 
     def _search_number(self, number):
-        search = LilySearch(
-            tenant_id=self.request.user.tenant_id,
-            model_type='accounts_account',
-            size=1,
-        )
+        results = self._find_number(number)
+        if results is not None:
+            return results
 
-        # Try to find an account with the given phone number.
-        search.filter_query('phone_numbers.number:"%s"' % number)
-
-        hits, facets, total, took = search.do_search()
-        if hits:
-            return {
-                'data': hits[0],
-            }
-        else:
+        # Try to find an account with the given phone number, or else a contact. Both searches are sent in one request.
+        searches = []
+        for model_type in ('accounts_account', 'contacts_contact'):
             search = LilySearch(
                 tenant_id=self.request.user.tenant_id,
-                model_type='contacts_contact',
+                model_type=model_type,
                 size=1,
             )
-
-            # Try to find a contact with the given phone number.
             search.filter_query('phone_numbers.number:"%s"' % number)
+            searches.append(search)
 
-            hits, facets, total, took = search.do_search()
-            if hits:
-                if hits[0].get('accounts'):
-                    # If the contact has accounts, return the first one.
-                    return {
-                        'data': hits[0].get('accounts')[0],
-                    }
+        position, hits = LilySearch.search_tiers(searches)
+        if position == 0:
+            return {
+                'data': hits[0],
+            }
+        elif position == 1:
+            if hits[0].get('accounts'):
+                # If the contact has accounts, return the first one.
+                return {
+                    'data': hits[0].get('accounts')[0],
+                }
 
         return {}
+
+    def _find_number(self, number):
+        """
+        Find the account with the given phone number, or else the first account of a contact with the
+        phone number, with an exact match on the normalized number in the database. This is much faster
+        than searching, the search is only needed for numbers that weren't stored normalized.
+
+        Args:
+            number (string): normalized phone number, see parse_phone_number
+
+        Returns:
+            dict with the account, empty dict when the contact has no account, None when nothing was found
+        """
+        tenant_id = self.request.user.tenant_id
+        fields = ('id', 'name', 'customer_id')
+
+        account = Account.objects.filter(
+            tenant_id=tenant_id,
+            phone_numbers__number=number,
+            is_deleted=False,
+        ).order_by('pk').values(*fields).first()
+        if account:
+            return {
+                'data': account,
+            }
+
+        contact_id = Contact.objects.filter(
+            tenant_id=tenant_id,
+            phone_numbers__number=number,
+            is_deleted=False,
+        ).order_by('pk').values_list('pk', flat=True).first()
+        if contact_id:
+            account = Account.objects.filter(
+                functions__contact=contact_id,
+                is_deleted=False,
+            ).order_by('functions__pk').values(*fields).first()
+            if account:
+                # If the contact has accounts, return the first one.
+                return {
+                    'data': account,
+                }
+            return {}
+
+        return None
@@ -3,7 +3,7 @@ from datetime import timedelta
 
 from kombu import Queue
 
-from .settings import DEBUG, TIME_ZONE, REDIS_URL
+from .settings import DEBUG, TIME_ZONE, REDIS_URL, ES_DRIFT_CHECK_INTERVAL
 
 
 # The broker env var name to use for fetching the broker url.
@@ -42,6 +42,8 @@ CELERY_QUEUES = (
     Queue('email_scheduled_tasks', routing_key='email_scheduled_tasks'),
     # Initial fetch of messages.
     Queue('email_first_sync', routing_key='email_first_sync'),
+    # Deferred updates of the search index.
+    Queue('search_indexing', routing_key='search_indexing'),
 )
 CELERY_ROUTES = (
     {'synchronize_email_account_scheduler': {
@@ -62,6 +64,18 @@ CELERY_ROUTES = (
         # When task is created in first sync, this task will be routed to email_first_sync.
         'queue': 'email_scheduled_tasks'
     }},
+    {'update_index_for_ids': {
+        'queue': 'search_indexing'
+    }},
+    {'unindex_documents': {
+        'queue': 'search_indexing'
+    }},
+    {'reindex_documents': {
+        'queue': 'search_indexing'
+    }},
+    {'check_index_drift': {
+        'queue': 'search_indexing'
+    }},
 )
 CELERYBEAT_SCHEDULE = {
     'synchronize_email_account_scheduler': {
@@ -69,3 +83,8 @@ CELERYBEAT_SCHEDULE = {
         'schedule': timedelta(seconds=int(os.environ.get('EMAIL_SYNC_INTERVAL', 60))),
     },
 }
+if ES_DRIFT_CHECK_INTERVAL:
+    CELERYBEAT_SCHEDULE['check_index_drift'] = {
+        'task': 'check_index_drift',
+        'schedule': timedelta(seconds=ES_DRIFT_CHECK_INTERVAL),
+    }
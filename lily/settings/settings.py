@@ -184,6 +184,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'lily.tenant.middleware.TenantMiddleware',
+    'lily.search.middleware.IndexQueueMiddleware',
 )
 
 if 'test' in sys.argv:
@@ -531,6 +532,19 @@ ES_URLS = [es_url_to_dict(os.environ.get(ES_PROVIDER_ENV, 'http://es:9200'))]
 # The index Elasticsearch uses (as a prefix).
 ES_INDEXES = {'default': 'main_index'}
 
+# The mappings of the models that are indexed, see lily.search.scan_search.
+ES_MAPPINGS = (
+    'lily.accounts.search.AccountMapping',
+    'lily.cases.search.CaseMapping',
+    'lily.contacts.search.ContactMapping',
+    'lily.deals.search.DealMapping',
+    'lily.messaging.email.search.EmailMessageMapping',
+    'lily.notes.search.NoteMapping',
+    'lily.tags.search.TagMapping',
+    'lily.users.search.LilyUserMapping',
+    'lily.users.search.TeamMapping',
+)
+
 # Default timeout of elasticsearch is to short for bulk updating, so we extend te timeout
 ES_TIMEOUT = os.environ.get('ES_TIMEOUT', 20)  # Default is 5
 
@@ -538,6 +552,54 @@ ES_MAXSIZE = os.environ.get('ES_MAXSIZE', 2)  # Default is 10
 
 ES_BLOCK = os.environ.get('ES_BLOCK', True)  # Default is False
 
+# How writes to the index become visible for searches, one of:
+# 'immediate': refresh the whole index after every write.
+# 'wait_for': the write request refreshes the shards it touched before returning (read-your-write).
+# 'periodic': refresh at most once per ES_REFRESH_INTERVAL seconds per index. Only a write refreshes, so the
+#     last writes of an interval become searchable with a later write, or by the refresh interval of the index.
+# 'none': never refresh, rely on the refresh interval of the index itself.
+# Mappings (refresh_policy attribute) and call sites (refresh kwarg) can override this.
+ES_REFRESH_POLICY = os.environ.get('ES_REFRESH_POLICY', 'wait_for')
+ES_REFRESH_INTERVAL = int(os.environ.get('ES_REFRESH_INTERVAL', 5))
+
+# Limits of the bulk requests when (re)indexing many documents. A bulk request is sent when it reaches either
+# the maximum payload size in bytes or the maximum number of documents. Multiple requests can be in flight while
+# the next documents are extracted. Items rejected because the bulk queue of the cluster is full are retried.
+ES_BULK_MAX_BYTES = int(os.environ.get('ES_BULK_MAX_BYTES', 5 * 1024 * 1024))
+ES_BULK_MAX_DOCS = int(os.environ.get('ES_BULK_MAX_DOCS', 500))
+ES_BULK_MAX_IN_FLIGHT = int(os.environ.get('ES_BULK_MAX_IN_FLIGHT', 2))
+ES_BULK_MAX_RETRIES = int(os.environ.get('ES_BULK_MAX_RETRIES', 3))
+
+# Skip writing documents that did not change since they were last written, by keeping a fingerprint of
+# every document in the cache. Fingerprints expire, so a document is written again at least once per timeout.
+# This keeps a cache key per indexed document (email messages included), so it is disabled unless opted in.
+ES_FINGERPRINTS = boolean(os.environ.get('ES_FINGERPRINTS', 0))
+ES_FINGERPRINT_TIMEOUT = int(os.environ.get('ES_FINGERPRINT_TIMEOUT', 24 * 60 * 60))
+
+# Periodically compare the database with the index, see 'check_index_drift', and fix what drifted when enabled.
+# The check scans every index and table, so it's off (0) unless an interval in seconds is given, e.g. 86400.
+ES_DRIFT_CHECK_INTERVAL = int(os.environ.get('ES_DRIFT_CHECK_INTERVAL', 0))
+ES_DRIFT_REPAIR = boolean(os.environ.get('ES_DRIFT_REPAIR', 0))
+
+# Measure the time spent in every stage of indexing per mapping, see the index_stats command. The measurements
+# of a process are added to the counters in the cache (and logged) by the index commands, and after Celery tasks
+# at most once per flush interval, in seconds. Web requests never flush them.
+ES_METRICS = boolean(os.environ.get('ES_METRICS', 1))
+ES_METRICS_FLUSH_INTERVAL = int(os.environ.get('ES_METRICS_FLUSH_INTERVAL', 10))
+
+# Cache the results of searches per tenant, see lily.search.result_cache. Writes to the index invalidate the
+# cached results of the tenant and type that was written to, the timeout (in seconds) limits how long they're kept.
+ES_RESULT_CACHE = boolean(os.environ.get('ES_RESULT_CACHE', 0))
+ES_RESULT_CACHE_TIMEOUT = int(os.environ.get('ES_RESULT_CACHE_TIMEOUT', 5 * 60))
+
+# How long (in seconds) the filters of searches are cached, e.g. the email addresses related to an account,
+# see lily.search.filter_cache. They're invalidated when what they're built from changes.
+ES_FILTER_CACHE_TIMEOUT = int(os.environ.get('ES_FILTER_CACHE_TIMEOUT', 24 * 60 * 60))
+
+# Hand the index updates collected during a request or task to the 'update_index_for_ids' task,
+# instead of sending them to Elasticsearch before the response is returned.
+ES_INDEX_ASYNC = boolean(os.environ.get('ES_INDEX_ASYNC', 0))
+
 #######################################################################################################################
 # Gmail API settings                                                                                                  #
 #######################################################################################################################
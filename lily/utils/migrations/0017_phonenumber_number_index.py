@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('utils', '0016_remove_historylistitem'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='phonenumber',
+            name='number',
+            field=models.CharField(max_length=40, db_index=True),
+            preserve_default=True,
+        ),
+    ]
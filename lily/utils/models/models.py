@@ -29,7 +29,8 @@ class PhoneNumber(TenantMixin):
         (ACTIVE_STATUS, _('Active')),
     )
 
-    number = models.CharField(max_length=40)
+    # Indexed to look up who is calling, numbers are always stored normalized (see parse_phone_number).
+    number = models.CharField(max_length=40, db_index=True)
     type = models.CharField(
         max_length=15,
         choices=PHONE_TYPE_CHOICES,
@@ -96,6 +96,15 @@ def convert_html_to_text(html, keep_linebreaks=False):
     return body.get_text()
 
 
+def convert_html_to_search_text(html):
+    """
+    Convert an html body to the plain text that is indexed for search, keeping the line breaks.
+    """
+    soup = BeautifulSoup(html, 'lxml', from_encoding='utf-8')
+    soup = convert_br_to_newline(soup)
+    return soup.get_text()
+
+
 def parse_search_keys(search_string):
     TOKENS_START = ['from', 'to', 'cc', 'bcc', 'subject', 'has']
     TOKEN_END = ','